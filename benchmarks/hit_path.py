@@ -0,0 +1,103 @@
+"""Measure latency of fresh cache hits through AsyncCacheControl.
+
+Exits with status 1 if p50/p99 latency is above --max-p50-us/--max-p99-us,
+or more than --tolerance slower than results saved with --output before
+and given as --baseline, so it can guard the hit path in CI.
+
+Usage: python benchmarks/hit_path.py [--requests N] [--body-size BYTES]
+    [--output FILE] [--baseline FILE] [--tolerance SHARE]
+    [--max-p50-us US] [--max-p99-us US]
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, List
+
+from acachecontrol import AsyncCache, AsyncCacheControl, CachedResponse
+
+URL = "http://example.com/"
+QUANTILES = (("p50", 0.5), ("p99", 0.99))
+
+
+async def run(requests: int, body_size: int) -> Dict:
+    cache = AsyncCache()
+    cache.add(
+        ("GET", URL),
+        CachedResponse(200, {"Content-Type": "text/plain"}, b"x" * body_size),
+        {"Cache-Control": "max-age=3600"},
+    )
+    async with AsyncCacheControl(cache=cache) as cached_sess:
+        latencies = []
+        for _ in range(requests):
+            started_at = time.perf_counter()
+            async with cached_sess.get(URL) as resp:
+                await resp.text()
+            latencies.append(time.perf_counter() - started_at)
+
+    latencies.sort()
+    result = {
+        "requests": requests,
+        "body_size": body_size,
+        "requests_per_sec": requests / sum(latencies),
+    }
+    for name, quantile in QUANTILES:
+        latency = latencies[int(quantile * (len(latencies) - 1))]
+        result[f"{name}_us"] = latency * 1e6
+    return result
+
+
+def check(result: Dict, args) -> List[str]:
+    """Get descriptions of exceeded thresholds, empty if there are none."""
+    failures = []
+    limits = {"p50_us": args.max_p50_us, "p99_us": args.max_p99_us}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        for name in limits:
+            limit = baseline[name] * (1 + args.tolerance)
+            if limits[name] is None or limit < limits[name]:
+                limits[name] = limit
+    for name, limit in limits.items():
+        if limit is not None and result[name] > limit:
+            failures.append(f"{name}: {result[name]:.1f} > {limit:.1f}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--body-size", type=int, default=1024)
+    parser.add_argument("--output", help="file to write JSON results to")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed slowdown relative to baseline, 0.25 is 25%%",
+    )
+    parser.add_argument("--max-p50-us", type=float)
+    parser.add_argument("--max-p99-us", type=float)
+    args = parser.parse_args()
+    result = asyncio.run(run(args.requests, args.body_size))
+
+    print(f"fresh hits: {args.requests}, body size: {args.body_size} bytes")
+    print(f"requests/sec: {result['requests_per_sec']:.0f}")
+    for name, _ in QUANTILES:
+        print(f"{name}: {result[f'{name}_us']:.1f} us")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+    failures = check(result, args)
+    for failure in failures:
+        print(f"too slow, {failure} us", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Benchmark AsyncCacheControl against local aiohttp.web origin.
+
+Scenarios:
+    cold_misses   - every request is for a new URL, so it goes to origin
+    warm_hits     - every request is for the same cached URL
+    expiry_churn  - requests for a small set of URLs with max-age=1 during
+                    --duration seconds, so entries expire and are fetched
+                    again all the time
+    stampede      - many concurrent requests for the same uncached URL
+
+Results are printed as JSON (or written to --output), so they can be
+compared between releases.
+
+Usage: python benchmarks/suite.py [--requests N] [--latency SECONDS] ...
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+from typing import Dict, Iterator, List
+
+from aiohttp import web
+
+import acachecontrol
+from acachecontrol import AsyncCache, AsyncCacheControl
+
+SCENARIOS = ("cold_misses", "warm_hits", "expiry_churn", "stampede")
+
+
+async def handle(request: web.Request) -> web.Response:
+    """Respond with payload of `size` bytes after `latency` seconds."""
+    app = request.app
+    app["stats"]["requests"] += 1
+    latency = float(request.query.get("latency", app["latency"]))
+    if latency:
+        await asyncio.sleep(latency)
+    return web.Response(
+        body=app["payload"],
+        headers={
+            "Cache-Control": request.query.get("cache_control", "max-age=3600")
+        },
+    )
+
+
+async def start_origin(latency: float, payload_size: int) -> web.AppRunner:
+    app = web.Application()
+    app["latency"] = latency
+    app["payload"] = b"x" * payload_size
+    app["stats"] = {"requests": 0}
+    app.router.add_get("/{path:.*}", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+def origin_url(runner: web.AppRunner) -> str:
+    host, port = runner.addresses[0][:2]
+    return f"http://{host}:{port}"
+
+
+async def timed_get(cached_sess: AsyncCacheControl, url: str) -> float:
+    started_at = time.perf_counter()
+    async with cached_sess.get(url) as resp:
+        await resp.read()
+    return time.perf_counter() - started_at
+
+
+async def run_workers(
+    cached_sess: AsyncCacheControl, urls: Iterator[str], concurrency: int
+) -> List[float]:
+    """Request URLs with `concurrency` workers, return latencies."""
+    latencies = []  # type: List[float]
+
+    async def worker():
+        for url in urls:
+            latencies.append(await timed_get(cached_sess, url))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict:
+    latencies = sorted(latencies)
+
+    def percentile(q: float) -> float:
+        return latencies[int(q * (len(latencies) - 1))]
+
+    return {
+        "requests": len(latencies),
+        "requests_per_sec": len(latencies) / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(0.5) * 1000,
+        "p99_ms": percentile(0.99) * 1000,
+    }
+
+
+def churn_urls(base_url: str, keys: int, duration: float) -> Iterator[str]:
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        yield f"{base_url}/churn/{random.randrange(keys)}?cache_control=max-age=1"
+
+
+async def run_scenario(name: str, runner: web.AppRunner, args) -> Dict:
+    base_url = origin_url(runner)
+    cache = AsyncCache(config={"capacity": args.capacity})
+    concurrency = args.concurrency
+    async with AsyncCacheControl(cache=cache) as cached_sess:
+        if name == "cold_misses":
+            urls = (
+                f"{base_url}/cold/{index}" for index in range(args.requests)
+            )
+        elif name == "warm_hits":
+            urls = iter([f"{base_url}/warm"] * args.requests)
+            await timed_get(cached_sess, f"{base_url}/warm")
+        elif name == "expiry_churn":
+            urls = churn_urls(base_url, args.keys, args.duration)
+        else:
+            urls = iter([f"{base_url}/stampede"] * args.stampede_size)
+            concurrency = args.stampede_size
+        cache.metrics.reset()
+        stats = runner.app["stats"]
+        stats["requests"] = 0
+        started_at = time.perf_counter()
+        latencies = await run_workers(cached_sess, urls, concurrency)
+        elapsed = time.perf_counter() - started_at
+    result = summarize(latencies, elapsed)
+    result["hit_ratio"] = cache.metrics.hit_ratio
+    result["origin_requests"] = stats["requests"]
+    return result
+
+
+async def main(args) -> Dict:
+    runner = await start_origin(args.latency, args.payload_size)
+    try:
+        results = {}
+        for name in args.scenarios:
+            results[name] = await run_scenario(name, runner, args)
+    finally:
+        await runner.cleanup()
+    return {
+        "acachecontrol": acachecontrol.__version__,
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "params": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "latency": args.latency,
+            "payload_size": args.payload_size,
+            "capacity": args.capacity,
+            "keys": args.keys,
+            "duration": args.duration,
+            "stampede_size": args.stampede_size,
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--latency", type=float, default=0.001, help="origin latency, seconds"
+    )
+    parser.add_argument("--payload-size", type=int, default=4096)
+    parser.add_argument("--capacity", type=int, default=1000)
+    parser.add_argument(
+        "--keys", type=int, default=50, help="URLs in expiry_churn scenario"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=3,
+        help="seconds of expiry_churn scenario",
+    )
+    parser.add_argument("--stampede-size", type=int, default=100)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument("--output", help="file to write JSON results to")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
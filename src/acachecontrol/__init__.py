@@ -2,4 +2,9 @@ __version__ = "0.3.6"
 
 
 from .acachecontrol import AsyncCacheControl  # noqa
+from .backends import AsyncCacheBackend, ExecutorBackend, SQLiteBackend  # noqa
 from .cache import AsyncCache  # noqa
+from .cached_response import CachedResponse  # noqa
+from .keys import KeyBuilder  # noqa
+from .metrics import CacheMetrics  # noqa
+from .sharded import ShardedAsyncCache  # noqa
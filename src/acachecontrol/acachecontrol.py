@@ -14,25 +14,85 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
+from collections import deque
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
 import aiohttp
+import yarl
 
 from .cache import AsyncCache
+from .constants import DEFAULT_FETCH_CONCURRENCY, DEFAULT_SWEEP_BATCH_SIZE
+from .metrics import CacheMetrics
 from .request_context_manager import RequestContextManager
 
 
 class AsyncCacheControl:
     def __init__(
         self,
-        cache: AsyncCache = AsyncCache(),
+        cache: Optional[AsyncCache] = None,
         request_context_manager_cls=RequestContextManager,
+        sweep_interval: Optional[float] = None,
+        sweep_batch_size: int = DEFAULT_SWEEP_BATCH_SIZE,
+        session: Optional[aiohttp.ClientSession] = None,
+        connector: Optional[aiohttp.BaseConnector] = None,
+        connector_params: Optional[Dict[str, Any]] = None,
+        **session_params,
     ):
+        """
+        Args:
+            cache: cache of responses, new AsyncCache() by default
+            sweep_interval: if given, expired entries are purged from cache
+                in background every `sweep_interval` seconds while inside
+                `async with` block
+            sweep_batch_size: max amount of entries purged at once
+            session: existing client session to use, it is not closed
+                on exit. Session is created on first request otherwise
+            connector: connector of created session, e.g. shared one,
+                it is not closed on exit unless `connector_owner=True`
+            connector_params: arguments of aiohttp.TCPConnector for created
+                session, e.g. `{"limit_per_host": 10, "ttl_dns_cache": 300}`
+            session_params: other arguments of aiohttp.ClientSession,
+                e.g. `timeout=aiohttp.ClientTimeout(total=10)`
+        """
         self._request_context_manager_cls = request_context_manager_cls
-        self.cache = cache
-        self._async_client_session = aiohttp.ClientSession()
+        self.cache = cache if cache is not None else AsyncCache()
+        self._async_client_session = session
+        self._own_session = session is None
+        self._connector = connector
+        self._connector_params = connector_params
+        if connector is not None:
+            session_params.setdefault("connector_owner", False)
+        self._session_params = session_params
+        self.sweep_interval = sweep_interval
+        self.sweep_batch_size = sweep_batch_size
+        self._sweeper = None  # type: Optional[asyncio.Future]
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Client session, created on first use inside running event loop."""
+        if self._async_client_session is None:
+            connector = self._connector
+            if connector is None and self._connector_params is not None:
+                connector = aiohttp.TCPConnector(**self._connector_params)
+            self._async_client_session = aiohttp.ClientSession(
+                connector=connector, **self._session_params
+            )
+        return self._async_client_session
 
     def request(self, method, url, **params):
         return self._request_context_manager_cls(
-            self._async_client_session, self.cache, method, url, **params
+            self.session, self.cache, method, url, **params
         )
 
     def head(self, url, allow_redirects=True, **params):
@@ -57,11 +117,167 @@ class AsyncCacheControl:
     def delete(self, url, **params):
         return self.request("DELETE", url, **params)
 
+    async def fetch_many(
+        self,
+        urls: Iterable[str],
+        method: str = "GET",
+        concurrency: int = DEFAULT_FETCH_CONCURRENCY,
+        limit_per_host: Optional[int] = None,
+        return_exceptions: bool = False,
+        **params,
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Request many URLs, yield (url, response) pairs as they are ready.
+
+        Fresh responses are taken from cache in single pass and yielded
+        first, URLs with the same cache key are requested once. Other ones
+        are requested at most `concurrency` at once, at most `limit_per_host`
+        of them to the same host, requests to hosts without free slots don't
+        hold back requests to other hosts.
+
+        Args:
+            urls: URLs to request
+            method: HTTP method of requests
+            concurrency: max amount of concurrent requests
+            limit_per_host: max amount of concurrent requests to one host,
+                no limit by default
+            return_exceptions: if True, exception is yielded instead of
+                response of failed request, otherwise it is raised and
+                other requests are cancelled
+            params: other arguments of every request
+
+        Raises:
+            ValueError: if `concurrency` or `limit_per_host` is not positive
+        """
+        if concurrency < 1 or (
+            limit_per_host is not None and limit_per_host < 1
+        ):
+            raise ValueError("concurrency and limit_per_host must be positive")
+        # primary key -> (URLs, request)
+        misses = {}  # type: Dict[Any, Tuple[List[str], Any]]
+        for url in urls:
+            request = self.request(method, url, **params)
+            if request.primary_key in misses:
+                misses[request.primary_key][0].append(url)
+                continue
+            response = request.get_cached()
+            if response is not None:
+                yield url, response
+            else:
+                misses[request.primary_key] = ([url], request)
+        if not misses:
+            return
+
+        results = self._fetch_pending(
+            misses.values(), concurrency, limit_per_host
+        )
+        try:
+            async for key_urls, response in results:
+                if isinstance(response, Exception) and not return_exceptions:
+                    raise response
+                for url in key_urls:
+                    yield url, response
+        finally:
+            await results.aclose()
+
+    @staticmethod
+    async def _fetch_pending(
+        pending: Iterable[Tuple[List[str], Any]],
+        concurrency: int,
+        limit_per_host: Optional[int],
+    ) -> AsyncGenerator[Tuple[List[str], Any], None]:
+        """Read responses of pending requests for `fetch_many`.
+
+        Yields URLs of each request with its response or exception as soon
+        as it is ready. Requests are queued per host, so the next request is
+        taken from the first host with free slot.
+        """
+        # host -> its pending requests, in order of URLs
+        queues = {}  # type: Dict[Optional[str], Deque[Tuple[List[str], Any]]]
+        for key_urls, request in pending:
+            host = yarl.URL(key_urls[0]).host if limit_per_host else None
+            queues.setdefault(host, deque()).append((key_urls, request))
+        host_limit = limit_per_host or concurrency
+        active = dict.fromkeys(queues, 0)
+        # running request -> its URLs and host
+        running = {}  # type: Dict[asyncio.Future, Tuple[List[str], Any]]
+        try:
+            while queues or running:
+                for host, queue in list(queues.items()):
+                    while (
+                        queue
+                        and active[host] < host_limit
+                        and len(running) < concurrency
+                    ):
+                        key_urls, request = queue.popleft()
+                        task = asyncio.ensure_future(_read_response(request))
+                        running[task] = (key_urls, host)
+                        active[host] += 1
+                    if not queue:
+                        del queues[host]
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    key_urls, host = running.pop(task)
+                    active[host] -= 1
+                    try:
+                        response = task.result()
+                    except Exception as exc:
+                        response = exc
+                    yield key_urls, response
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def get_many(self, urls: Iterable[str], **params) -> Dict[str, Any]:
+        """Request many URLs, get responses by URLs.
+
+        Accepts the same arguments as `fetch_many`.
+        """
+        return {
+            url: response
+            async for url, response in self.fetch_many(urls, **params)
+        }
+
     def clear_cache(self):
         self.cache.clear_cache()
 
+    @property
+    def metrics(self) -> CacheMetrics:
+        """Counters and latency histograms of the cache."""
+        return self.cache.metrics
+
+    async def _sweep_expired_entries(self):
+        """Purge expired entries from cache periodically."""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            # yield to other tasks between batches until everything is purged
+            while (
+                self.cache.purge_expired(self.sweep_batch_size)
+                >= self.sweep_batch_size
+            ):
+                await asyncio.sleep(0)
+
     async def __aenter__(self):
+        if self.sweep_interval is not None:
+            self._sweeper = asyncio.ensure_future(self._sweep_expired_entries())
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._async_client_session.close()
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        await self.close()
+
+    async def close(self):
+        """Close created session, injected one is left open."""
+        if self._own_session and self._async_client_session is not None:
+            await self._async_client_session.close()
+            self._async_client_session = None
+
+
+async def _read_response(request):
+    async with request as resp:
+        await resp.read()
+        return resp.response
@@ -0,0 +1,526 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import ast
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from .cached_response import CachedResponse
+from .compression import CODECS
+
+
+class AsyncCacheBackend:
+    """Interface of asynchronous storage of cached responses.
+
+    Used by AsyncCache as second level of cache, so storage can be slow
+    (disk, network, etc.) without blocking event loop.
+    Bulk methods are implemented via single ones by default, override them
+    if storage can do it more efficiently.
+    """
+
+    async def get(self, key: Hashable) -> Optional[CachedResponse]:
+        """Get entry and mark it as recently used."""
+        raise NotImplementedError
+
+    async def set(self, key: Hashable, entry: CachedResponse) -> None:
+        raise NotImplementedError
+
+    async def delete(self, key: Hashable) -> None:
+        raise NotImplementedError
+
+    async def touch(self, key: Hashable) -> None:
+        """Mark entry as recently used."""
+        raise NotImplementedError
+
+    async def clear(self) -> None:
+        raise NotImplementedError
+
+    async def most_recently_used(
+        self, limit: int
+    ) -> List[Tuple[Hashable, CachedResponse]]:
+        """Get up to `limit` most recently used entries, newest first."""
+        return []
+
+    async def close(self) -> None:
+        pass
+
+    async def get_many(
+        self, keys: Iterable[Hashable]
+    ) -> Dict[Hashable, CachedResponse]:
+        """Get existing entries for given keys."""
+        entries = {}
+        for key in keys:
+            entry = await self.get(key)
+            if entry is not None:
+                entries[key] = entry
+        return entries
+
+    async def set_many(
+        self, items: Iterable[Tuple[Hashable, CachedResponse]]
+    ) -> None:
+        for key, entry in items:
+            await self.set(key, entry)
+
+    async def delete_many(self, keys: Iterable[Hashable]) -> None:
+        for key in keys:
+            await self.delete(key)
+
+    async def touch_many(self, keys: Iterable[Hashable]) -> None:
+        for key in keys:
+            await self.touch(key)
+
+
+class ExecutorBackend(AsyncCacheBackend):
+    """Adapter of blocking storage to AsyncCacheBackend interface.
+
+    Methods of wrapped storage are called in executor, single thread by
+    default, so operations are applied in the same order they were done.
+    Wrapped storage has to implement at least `get`, `set`, `delete`,
+    `touch` and `clear` methods, other ones are used if present.
+    """
+
+    def __init__(self, backend, executor: Optional[Executor] = None):
+        self.backend = backend
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=1)
+
+    def _run(self, func, *args) -> asyncio.Future:
+        return asyncio.get_event_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    async def get(self, key: Hashable) -> Optional[CachedResponse]:
+        return await self._run(self.backend.get, key)
+
+    async def set(self, key: Hashable, entry: CachedResponse) -> None:
+        await self._run(self.backend.set, key, entry)
+
+    async def delete(self, key: Hashable) -> None:
+        await self._run(self.backend.delete, key)
+
+    async def touch(self, key: Hashable) -> None:
+        await self._run(self.backend.touch, key)
+
+    async def clear(self) -> None:
+        await self._run(self.backend.clear)
+
+    async def most_recently_used(
+        self, limit: int
+    ) -> List[Tuple[Hashable, CachedResponse]]:
+        if not hasattr(self.backend, "most_recently_used"):
+            return []
+        return await self._run(self.backend.most_recently_used, limit)
+
+    async def close(self) -> None:
+        if hasattr(self.backend, "close"):
+            await self._run(self.backend.close)
+        if self._own_executor:
+            self._executor.shutdown()
+
+    async def get_many(
+        self, keys: Iterable[Hashable]
+    ) -> Dict[Hashable, CachedResponse]:
+        return await self._run(self._call_many, "get_many", list(keys))
+
+    async def set_many(
+        self, items: Iterable[Tuple[Hashable, CachedResponse]]
+    ) -> None:
+        await self._run(self._call_many, "set_many", list(items))
+
+    async def delete_many(self, keys: Iterable[Hashable]) -> None:
+        await self._run(self._call_many, "delete_many", list(keys))
+
+    async def touch_many(self, keys: Iterable[Hashable]) -> None:
+        await self._run(self._call_many, "touch_many", list(keys))
+
+    def _call_many(self, method: str, items: list):
+        """Call bulk method of wrapped storage or emulate it, in one go."""
+        if hasattr(self.backend, method):
+            return getattr(self.backend, method)(items)
+        if method == "get_many":
+            entries = {}
+            for key in items:
+                entry = self.backend.get(key)
+                if entry is not None:
+                    entries[key] = entry
+            return entries
+        if method == "set_many":
+            for key, entry in items:
+                self.backend.set(key, entry)
+        elif method == "touch_many":
+            for key in items:
+                self.backend.touch(key)
+        else:
+            for key in items:
+                self.backend.delete(key)
+        return None
+
+
+def as_async_backend(backend) -> AsyncCacheBackend:
+    """Wrap blocking storage with ExecutorBackend, if needed."""
+    if isinstance(backend, AsyncCacheBackend):
+        return backend
+    return ExecutorBackend(backend)
+
+
+class SQLiteBackend:
+    """Persistent storage of cached responses in SQLite database.
+
+    Methods are blocking and thread-safe, AsyncCache wraps it with
+    ExecutorBackend, so event loop is not blocked by disk I/O.
+    Least recently used entries are deleted when storage exceeds
+    `max_entries` or `max_bytes` limits.
+    Bodies compressed in memory with one of built-in codecs are stored
+    compressed, so they are not decompressed and compressed again.
+    Bodies in spill files are never read to memory, they are hard linked
+    (or copied, if it is not possible) to `bodies_dir`, `path` with
+    "-bodies" suffix by default, and loaded entries get their own copies.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        bodies_dir: Optional[str] = None,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bodies_dir = bodies_dir or f"{path}-bodies"
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, "
+            "status INTEGER NOT NULL, "
+            "headers TEXT NOT NULL, "
+            "body BLOB NOT NULL, "
+            "url TEXT NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "max_age REAL NOT NULL, "
+            "stale_while_revalidate REAL NOT NULL, "
+            "stale_if_error REAL NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "accessed_at REAL NOT NULL, "
+            "codec TEXT, "
+            "body_length INTEGER, "
+            "variant TEXT, "
+            "body_path TEXT)"
+        )
+        # databases created by previous versions lack newer columns
+        columns = {
+            row[1]
+            for row in self._connection.execute("PRAGMA table_info(entries)")
+        }
+        for column in (
+            "codec TEXT",
+            "body_length INTEGER",
+            "variant TEXT",
+            "body_path TEXT",
+        ):
+            if column.split()[0] not in columns:
+                self._connection.execute(
+                    f"ALTER TABLE entries ADD COLUMN {column}"
+                )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed_at "
+            "ON entries (accessed_at)"
+        )
+        self._connection.commit()
+        (
+            self._count,
+            self.total_bytes,
+            self._last_access,
+        ) = self._connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), "
+            "COALESCE(MAX(accessed_at), 0) FROM entries"
+        ).fetchone()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        """Get entry and mark it as recently used."""
+        return self.get_many([key]).get(key)
+
+    def get_many(
+        self, keys: Iterable[Hashable]
+    ) -> Dict[Hashable, CachedResponse]:
+        """Get existing entries for given keys, mark them as recently used."""
+        entries = {}
+        with self._lock:
+            for key in keys:
+                row = self._connection.execute(
+                    f"SELECT {ENTRY_COLUMNS} FROM entries WHERE key = ?",
+                    (_dump_key(key),),
+                ).fetchone()
+                entry = None if row is None else self._load_entry(row)
+                if entry is not None:
+                    self._touch(key)
+                    entries[key] = entry
+            self._connection.commit()
+        return entries
+
+    def set(self, key: Hashable, entry: CachedResponse) -> None:
+        """Store entry, evict least recently used ones if limits exceeded."""
+        self.set_many([(key, entry)])
+
+    def set_many(
+        self, items: Iterable[Tuple[Hashable, CachedResponse]]
+    ) -> None:
+        """Store entries in single transaction."""
+        with self._lock:
+            for key, entry in items:
+                self._set(key, entry)
+            self._evict()
+            self._connection.commit()
+
+    def delete_many(self, keys: Iterable[Hashable]) -> None:
+        """Delete entries in single transaction."""
+        with self._lock:
+            for key in keys:
+                self._delete(_dump_key(key))
+            self._connection.commit()
+
+    def _set(self, key: Hashable, entry: CachedResponse) -> None:
+        dumped_key = _dump_key(key)
+        self._delete(dumped_key)
+        codec = entry.codec.name if entry.codec is not None else None
+        body_path = None
+        if entry.spill_path is not None:
+            body_path = uuid.uuid4().hex
+            os.makedirs(self.bodies_dir, exist_ok=True)
+            _copy_file(entry.spill_path, self._body_file(body_path))
+            codec, body, body_length = None, b"", entry.spilled_size
+        elif codec in CODECS:
+            body = entry.stored_body
+            body_length = entry.raw_size - entry.size + len(body)
+        else:
+            # custom codec can't be restored, so body is stored decompressed
+            codec = None
+            body = entry.body
+            body_length = len(body)
+        # the same size as in memory, but body in spill file is counted
+        size = entry.size + entry.spilled_size
+        self._connection.execute(
+            "INSERT INTO entries VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                dumped_key,
+                entry.status,
+                json.dumps(list(entry.headers.items())),
+                body,
+                entry.url,
+                entry.created_at,
+                entry.max_age,
+                entry.stale_while_revalidate,
+                entry.stale_if_error,
+                size,
+                self._access_time(),
+                codec,
+                body_length,
+                # names of headers it varies on are in stored Vary header
+                None if entry.variant is None else json.dumps(entry.variant),
+                body_path,
+            ),
+        )
+        self._count += 1
+        self.total_bytes += size
+
+    def delete(self, key: Hashable) -> None:
+        self.delete_many([key])
+
+    def touch(self, key: Hashable) -> None:
+        """Mark entry as recently used."""
+        self.touch_many([key])
+
+    def touch_many(self, keys: Iterable[Hashable]) -> None:
+        """Mark entries as recently used in single transaction."""
+        with self._lock:
+            for key in keys:
+                self._touch(key)
+            self._connection.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            for (body_path,) in self._connection.execute(
+                "SELECT body_path FROM entries WHERE body_path IS NOT NULL"
+            ).fetchall():
+                _remove_file(self._body_file(body_path))
+            self._connection.execute("DELETE FROM entries")
+            self._connection.commit()
+            self._count = self.total_bytes = 0
+
+    def most_recently_used(
+        self, limit: int
+    ) -> List[Tuple[Hashable, CachedResponse]]:
+        """Get up to `limit` most recently used entries, newest first."""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT key, {ENTRY_COLUMNS} "
+                "FROM entries ORDER BY accessed_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        entries = []
+        for row in rows:
+            entry = self._load_entry(row[1:])
+            if entry is not None:
+                entries.append((_load_key(row[0]), entry))
+        return entries
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _touch(self, key: Hashable) -> None:
+        self._connection.execute(
+            "UPDATE entries SET accessed_at = ? WHERE key = ?",
+            (self._access_time(), _dump_key(key)),
+        )
+
+    def _access_time(self) -> float:
+        # strictly increasing, so order of accesses is never ambiguous
+        self._last_access = max(time.time(), self._last_access + 1e-6)
+        return self._last_access
+
+    def _delete(self, dumped_key: str) -> None:
+        row = self._connection.execute(
+            "SELECT size, body_path FROM entries WHERE key = ?", (dumped_key,)
+        ).fetchone()
+        if row is not None:
+            self._connection.execute(
+                "DELETE FROM entries WHERE key = ?", (dumped_key,)
+            )
+            self._count -= 1
+            self.total_bytes -= row[0]
+            if row[1] is not None:
+                _remove_file(self._body_file(row[1]))
+
+    def _evict(self) -> None:
+        excess_entries = 0
+        if self.max_entries is not None:
+            excess_entries = max(0, self._count - self.max_entries)
+        if not excess_entries and (
+            self.max_bytes is None or self.total_bytes <= self.max_bytes
+        ):
+            return
+        rows = self._connection.execute(
+            "SELECT key, size, body_path FROM entries ORDER BY accessed_at"
+        )
+        evicted_keys = []  # type: List[Tuple[str]]
+        for dumped_key, size, body_path in rows:
+            if len(evicted_keys) >= excess_entries and (
+                self.max_bytes is None or self.total_bytes <= self.max_bytes
+            ):
+                break
+            evicted_keys.append((dumped_key,))
+            self.total_bytes -= size
+            if body_path is not None:
+                _remove_file(self._body_file(body_path))
+        rows.close()
+        self._connection.executemany(
+            "DELETE FROM entries WHERE key = ?", evicted_keys
+        )
+        self._count -= len(evicted_keys)
+
+    def _body_file(self, body_path: str) -> str:
+        return os.path.join(self.bodies_dir, body_path)
+
+    def _load_entry(self, row) -> Optional[CachedResponse]:
+        """Load entry from row, None if its body file has gone."""
+        entry = _load_entry(row[:-1])
+        body_length, body_path = row[-3], row[-1]
+        if body_path is not None:
+            # loaded entry owns its spill file, stored one may be evicted
+            spill_path = os.path.join(
+                self.bodies_dir, f"acachecontrol-{uuid.uuid4().hex}"
+            )
+            try:
+                _copy_file(self._body_file(body_path), spill_path)
+            except FileNotFoundError:
+                return None
+            entry.set_body(b"", spill_path, body_length)
+        return entry
+
+
+ENTRY_COLUMNS = (
+    "status, headers, body, url, created_at, max_age, "
+    "stale_while_revalidate, stale_if_error, codec, body_length, variant, "
+    "body_path"
+)
+
+
+def _dump_key(key: Hashable) -> str:
+    # keys are tuples of str and bytes, their repr can be safely parsed back
+    return repr(key)
+
+
+def _load_key(dumped_key: str) -> Hashable:
+    return ast.literal_eval(dumped_key)
+
+
+def _copy_file(source: str, target: str) -> None:
+    """Hard link file, copy it by chunks if link is not possible."""
+    try:
+        os.link(source, target)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _load_entry(row) -> CachedResponse:
+    (
+        status,
+        headers,
+        body,
+        url,
+        created_at,
+        max_age,
+        stale_while_revalidate,
+        stale_if_error,
+        codec,
+        body_length,
+        variant,
+    ) = row
+    entry = CachedResponse(
+        status, json.loads(headers), body, url, created_at, max_age
+    )
+    if codec is not None:
+        entry.set_compressed_body(body, CODECS[codec](), body_length)
+    entry.stale_while_revalidate = stale_while_revalidate
+    entry.stale_if_error = stale_if_error
+    if variant is not None:
+        entry.variant = tuple(json.loads(variant))
+    return entry
@@ -15,19 +15,47 @@ limitations under the License.
 """
 
 import asyncio
+import heapq
+import json
 import logging
 import time
-from collections import OrderedDict
-from typing import Any, Dict, Set, Tuple
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional, Set, Tuple, cast
 
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from .backends import as_async_backend
+from .cache_control import CacheControl, get_cache_control
+from .cached_response import CachedResponse
+from .compression import get_codec
 from .constants import (
     CACHEABLE_METHODS,
+    CACHEABLE_STATUSES,
     DEFAULT_CACHE_CAPACITY,
+    DEFAULT_COMPRESSION_THRESHOLD,
+    DEFAULT_EVICTION_POLICY,
     DEFAULT_MAX_AGE,
-    DEFAULT_SLEEP_TIME,
+    DEFAULT_MAX_BACKGROUND_REFRESHES,
+    DEFAULT_MAX_HEURISTIC_AGE,
+    DEFAULT_MAX_SPILL_BYTES,
+    DEFAULT_MAX_VARIANTS,
+    DEFAULT_REFRESH_AHEAD_MIN_HITS,
+    DEFAULT_SPILL_THRESHOLD,
+    DEFAULT_STALE_IF_ERROR,
+    DEFAULT_STALE_TTL,
+    DEFAULT_STALE_WHILE_REVALIDATE,
     DEFAULT_WAIT_TIMEOUT,
+    HEURISTIC_FRESHNESS,
+    JSON_MEMOIZE_MODES,
+    NOT_UPDATED_HEADERS,
+    TAG_HEADERS,
 )
+from .eviction import get_eviction_policy
 from .exceptions import CacheException, TimeoutException
+from .invalidation import InvalidationIndex
+from .keys import KeyBuilder
+from .metrics import CacheMetrics
 
 logger = logging.getLogger(__name__)
 
@@ -35,156 +63,973 @@ logger = logging.getLogger(__name__)
 class AsyncCache:
     """Asynchronous Cache implementation.
 
-    Current implementation is a wrapper over OrderedDict object, implements LRU cache.
-    Supports any OrderedDict-like object as cache_backend.
+    Current implementation is a wrapper over dict object, entries are evicted
+    according to eviction policy (LRU by default).
+    Supports any dict-like object as cache_backend.
+    Optional storage (AsyncCacheBackend or blocking one like SQLiteBackend)
+    is used as second level of cache: entries are written to it in background
+    and loaded from it when they are not in memory, e.g. after restart.
+
+    Key: Tuple(http_method, canonical url, ...) built by KeyBuilder,
+    value: CachedResponse obj
 
-    Key: Tuple(http_method, url), value: aiohttp response obj
+    Responses with Vary header are stored as variants under the key extended
+    with values of listed request headers, Vary of each URL is remembered,
+    so variant key of the next request is built without extra lookups.
     """
 
-    def __init__(self, config: Dict = None, cache_backend=None):
-        self.cache = (
-            cache_backend if cache_backend is not None else OrderedDict()
+    def __init__(self, config: Dict = None, cache_backend=None, storage=None):
+        self.cache = cache_backend if cache_backend is not None else {}
+        self.storage = (
+            as_async_backend(storage) if storage is not None else None
         )
+        # pending storage updates, applied by single background task in order
+        self._storage_updates = deque()  # type: deque
+        # entries which are not written to storage yet, None for deleted ones
+        self._unsaved = {}  # type: Dict[Tuple[str, str], Any]
+        self._storage_writer = None  # type: Optional[asyncio.Future]
         config = config or {}
-        self._wait_until_completed = set()  # type: Set
+        self.key_builder = config.get("key_builder") or KeyBuilder()
+        self.eviction_policy = get_eviction_policy(
+            config.get("eviction_policy", DEFAULT_EVICTION_POLICY)
+        )
+        # key -> future resolved by the request which is fetching this key
+        self._in_flight = {}  # type: Dict[Tuple[str, str], asyncio.Future]
         self.default_max_age = config.get("max_age", DEFAULT_MAX_AGE)
-        self.sleep_time = config.get("sleep_time", DEFAULT_SLEEP_TIME)
+        self.max_heuristic_age = config.get(
+            "max_heuristic_age", DEFAULT_MAX_HEURISTIC_AGE
+        )
+        # shared cache serves responses to several users, so it prefers
+        # s-maxage and doesn't store private responses
+        self.shared = config.get("shared", False)
+        self.stale_ttl = config.get("stale_ttl", DEFAULT_STALE_TTL)
+        self.stale_while_revalidate = config.get(
+            "stale_while_revalidate", DEFAULT_STALE_WHILE_REVALIDATE
+        )
+        self.stale_if_error = config.get(
+            "stale_if_error", DEFAULT_STALE_IF_ERROR
+        )
         self.cacheable_methods = config.get(
             "cacheable_methods", CACHEABLE_METHODS
         )
+        self.cacheable_statuses = frozenset(
+            config.get("cacheable_statuses", CACHEABLE_STATUSES)
+        )
+        # hot entries are refreshed in background once they are older than
+        # this fraction of their max-age, None disables refresh-ahead
+        self.refresh_ahead = config.get(
+            "refresh_ahead"
+        )  # type: Optional[float]
+        if self.refresh_ahead is not None and not 0 < self.refresh_ahead <= 1:
+            raise ValueError(
+                f"refresh_ahead must be in (0, 1], got {self.refresh_ahead!r}"
+            )
+        self.refresh_ahead_min_hits = config.get(
+            "refresh_ahead_min_hits", DEFAULT_REFRESH_AHEAD_MIN_HITS
+        )
+        self.max_background_refreshes = config.get(
+            "max_background_refreshes", DEFAULT_MAX_BACKGROUND_REFRESHES
+        )
+        # keys which are refreshed ahead of expiration right now
+        self._refreshing_ahead = set()  # type: Set[Tuple]
         self.capacity = config.get("capacity", DEFAULT_CACHE_CAPACITY)
+        # size limits in bytes for whole cache and for a single entry
+        # (including its spill file), None means no limit
+        self.max_bytes = config.get("max_bytes")  # type: Optional[int]
+        self.max_entry_bytes = config.get(
+            "max_entry_bytes"
+        )  # type: Optional[int]
+        # streamed bodies above spill threshold are kept in files in spill
+        # directory, system temporary directory by default
+        self.spill_threshold = config.get(
+            "spill_threshold", DEFAULT_SPILL_THRESHOLD
+        )  # type: Optional[int]
+        self.spill_dir = config.get("spill_dir")  # type: Optional[str]
+        self.max_spill_bytes = config.get(
+            "max_spill_bytes", DEFAULT_MAX_SPILL_BYTES
+        )  # type: Optional[int]
+        # bodies in memory above compression threshold are compressed
+        # with codec, if there is one
+        self.codec = get_codec(config.get("compression"))
+        self.compression_threshold = config.get(
+            "compression_threshold", DEFAULT_COMPRESSION_THRESHOLD
+        )
+        # keep decoded text and parsed json with entries, so cache hits
+        # don't decode and parse the same body again
+        self.memoize_text = config.get("memoize_text", False)
+        self.memoize_json = config.get("memoize_json")  # type: Optional[str]
+        if self.memoize_json and self.memoize_json not in JSON_MEMOIZE_MODES:
+            raise ValueError(
+                f"Unknown memoize_json mode {self.memoize_json!r}, "
+                f"available: {', '.join(JSON_MEMOIZE_MODES)}"
+            )
+        self.json_loads = config.get("json_loads", json.loads)
+        self.metrics = config.get("metrics") or CacheMetrics()
+        # entries are indexed by URL, host and tags listed in tag headers
+        self.tag_headers = tuple(config.get("tag_headers", TAG_HEADERS))
+        self.invalidation_index = InvalidationIndex()
+        # size of entries in memory, actual one and before compression,
+        # and size of their spill files
+        self.total_bytes = 0
+        self.raw_bytes = 0
+        self.spilled_bytes = 0
+        # min-heap of (expiration time, key), may contain outdated items
+        self._expirations = []  # type: List[Tuple[float, Tuple[str, str]]]
+        self.max_variants = config.get("max_variants", DEFAULT_MAX_VARIANTS)
+        # primary key -> names of request headers listed in Vary header
+        self._vary = {}  # type: Dict[Tuple, Tuple[str, ...]]
+        # primary key -> keys of its variants in memory, oldest first
+        self._variants = {}  # type: Dict[Tuple, OrderedDict]
+
+    def get_vary(self, key: Tuple) -> Optional[Tuple[str, ...]]:
+        """Get names of request headers responses for the key vary on.
+
+        Returns None if responses do not vary or they are not known yet.
+        """
+        return self._vary.get(key)
+
+    def get_variant_key(
+        self, key: Tuple, vary: Tuple[str, ...], request_headers: Any
+    ) -> Tuple:
+        """Extend primary key with values of request headers it varies on."""
+        return key + (self.select_variant(vary, request_headers),)
+
+    def register_vary(
+        self, key: Tuple, response: CachedResponse, request_headers: Any
+    ) -> Optional[Tuple]:
+        """Remember Vary header of the response for given primary key.
+
+        Returns:
+            key the response has to be stored with, None if response varies
+            on everything ("Vary: *") and can't be reused
+        """
+        vary = self.parse_vary_header(response.headers)
+        if vary != self._vary.get(key, ()):
+            # variants stored for previous Vary are unreachable now
+            self._drop_variants(key)
+            if vary and "*" not in vary:
+                self._vary[key] = vary
+                self._store_vary(key, vary)
+        if not vary:
+            return key
+        if "*" in vary:
+            return None
+        response.variant = self.select_variant(vary, request_headers)
+        return key + (response.variant,)
+
+    def matches_variant(
+        self, response: CachedResponse, request_headers: Any
+    ) -> bool:
+        """Check if response can be served for request with given headers."""
+        if response.variant is None:
+            return True
+        vary = self.parse_vary_header(response.headers)
+        return self.select_variant(vary, request_headers) == response.variant
+
+    def _store_vary(self, key: Tuple, vary: Tuple[str, ...]) -> None:
+        """Store Vary of primary key under it, so variants in storage
+        can be found after restart without warming up."""
+        if self.storage is None:
+            return
+        marker = CachedResponse(200, {"Vary": ", ".join(vary)}, b"")
+        # variants are never empty, unlike Vary markers
+        marker.variant = ()
+        self._update_storage("set", key, marker)
+
+    def _load_vary(self, key: Tuple, marker: CachedResponse) -> None:
+        """Restore Vary of primary key from its marker in storage."""
+        vary = self.parse_vary_header(marker.headers)
+        if vary:
+            self._vary.setdefault(key, vary)
+
+    def _drop_variants(self, key: Tuple) -> None:
+        if self._vary.pop(key, None) is not None:
+            # Vary marker of previous variants
+            self._update_storage("delete", key)
+        for variant_key in list(self._variants.get(key, ())):
+            self.delete(variant_key)
 
     def has_valid_entry(self, key: Tuple[str, str]) -> bool:
-        """Check if entry exists and not expired, delete expired."""
-        if key in self.cache:
-            if not self.is_cache_entry_expired(key):
-                return True
+        """Check if entry exists and not expired.
+
+        Expired entries are deleted, unless they can be revalidated.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return False
+        now = time.time()
+        if entry.is_fresh(now):
+            return True
 
-            logger.debug(f"Cache entry is expired for {key} key")
+        logger.debug("Cache entry is expired for %s key", key)
+        if self._delete_at(entry) <= now:
             self.delete(key)
+            self.metrics.inc("expirations")
         return False
 
-    def add(self, key: Tuple[str, str], value: Any, headers: Any) -> None:
+    def get_fresh(self, key: Tuple[str, str]) -> Optional[CachedResponse]:
+        """Get entry if it exists and not expired, with single lookup.
+
+        Expired entries are deleted, unless they can be revalidated.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        now = time.time()
+        if entry.is_fresh(now):
+            self.eviction_policy.on_access(key)
+            return entry
+
+        logger.debug("Cache entry is expired for %s key", key)
+        if self._delete_at(entry) <= now:
+            self.delete(key)
+            self.metrics.inc("expirations")
+        return None
+
+    def get_acceptable(
+        self, key: Tuple, max_stale: float = 0, min_fresh: int = 0
+    ) -> Optional[CachedResponse]:
+        """Get entry satisfying max-stale and min-fresh request directives.
+
+        Entry must stay fresh for `min_fresh` more seconds or be expired
+        for less than `max_stale` seconds, if it may be served stale.
+        Expired entries are not deleted, unlike by `get_fresh`.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        now = time.time()
+        if not entry.is_fresh(now + min_fresh) and not (
+            max_stale > 0
+            and entry.is_fresh(now - max_stale)
+            and self._may_serve_stale(entry)
+        ):
+            return None
+        self.eviction_policy.on_access(key)
+        return entry
+
+    def _may_serve_stale(self, entry: CachedResponse) -> bool:
+        """Check if expired entry may be served without revalidation."""
+        cc_header = self.parse_cache_control_header(entry.headers)
+        return not (
+            "no-cache" in cc_header
+            or "must-revalidate" in cc_header
+            or (self.shared and "proxy-revalidate" in cc_header)
+        )
+
+    def get_stale_while_revalidate(
+        self, key: Tuple[str, str]
+    ) -> Optional[CachedResponse]:
+        """Get expired entry which may be served while it is refreshed."""
+        entry = self.cache.get(key)
+        if entry is None or (
+            entry.expires_at + entry.stale_while_revalidate <= time.time()
+        ):
+            return None
+        self.eviction_policy.on_access(key)
+        return entry
+
+    def get_stale_if_error(
+        self, key: Tuple[str, str]
+    ) -> Optional[CachedResponse]:
+        """Get expired entry which may be served when origin fails."""
+        entry = self.cache.get(key)
+        now = time.time()
+        if (
+            entry is None
+            or entry.is_fresh(now)
+            or entry.expires_at + entry.stale_if_error <= now
+        ):
+            return None
+        self.eviction_policy.on_access(key)
+        return entry
+
+    def get_revalidation_headers(self, key: Tuple[str, str]) -> Dict[str, str]:
+        """Get headers of conditional request for expired entry.
+
+        Returns empty dict if there is no entry or it has no validators.
+        """
+        entry = self.cache.get(key)
+        headers = {}
+        if entry is not None:
+            etag = entry.headers.get("ETag")
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            last_modified = entry.headers.get("Last-Modified")
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def refresh(
+        self, key: Tuple[str, str], headers: Any
+    ) -> Optional[CachedResponse]:
+        """Refresh entry in place after 304 Not Modified response.
+
+        Stored headers are updated with given ones of 304 response and
+        entry becomes fresh again.
+
+        Returns:
+            refreshed entry or None if there is no entry for the key anymore
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        updated_headers = CIMultiDict(entry.headers)
+        # age of stored response is superseded by age of 304 response
+        updated_headers.popall("Age", None)
+        for name in headers.keys():
+            if name.lower() not in NOT_UPDATED_HEADERS:
+                updated_headers.popall(name, None)
+        for name, value in headers.items():
+            if name.lower() not in NOT_UPDATED_HEADERS:
+                updated_headers.add(name, value)
+        self._untrack_size(entry)
+        entry.update_headers(updated_headers)
+        entry.hits = 0
+        self._track_size(entry)
+        cc_header = self.parse_cache_control_header(entry.headers)
+        self._set_freshness(entry, cc_header, entry.headers)
+        self.eviction_policy.on_access(key)
+        self._add_expiration(key, entry)
+        # tags may be updated
+        self._index(key, entry)
+        self._update_storage("set", key, entry)
+        self.metrics.inc("revalidations")
+        logger.debug("Refreshed cache entry for %s key", key)
+        return entry
+
+    def add(
+        self, key: Tuple[str, str], value: CachedResponse, headers: Any
+    ) -> None:
         """Add value to the cache.
 
         headers - any dict-like obj
 
         """
+        if not isinstance(headers, (CIMultiDict, CIMultiDictProxy)):
+            headers = CIMultiDict(headers)
         cc_header = self.parse_cache_control_header(headers)
-        if self._is_response_cacheable(key[0], cc_header):
-            self.cache[key] = {
-                "created_at": time.time(),
-                "max-age": cc_header.get("max-age", self.default_max_age),
-                "value": value,
-            }
-            self.cache.move_to_end(key)
-            if len(self.cache) > self.capacity:
-                self.cache.popitem(last=False)
-        self.release_new_key(key)
-        logger.debug(f"Added a new entry to cache for {key} key")
-
-    def get(self, key: Tuple[str, str]) -> Any:
+        if not self._is_response_cacheable(key[0], cc_header, value):
+            return
+        if self.max_entry_bytes is not None and (
+            value.size + value.spilled_size > self.max_entry_bytes
+        ):
+            logger.debug("Entry for %s key is too big to be cached", key)
+            # do not keep previous version of the response either
+            self.delete(key)
+            return
+        self._set_freshness(value, cc_header, headers)
+        self._put(key, value)
+        self._update_storage("set", key, value)
+        self.metrics.inc("bytes_stored", value.size)
+        if value.variant is not None and key in self.cache:
+            self._add_variant(key)
+        logger.debug("Added a new entry to cache for %s key", key)
+
+    def _add_variant(self, key: Tuple) -> None:
+        """Track variant key, delete the oldest variants above the limit."""
+        variants = self._variants.setdefault(key[:-1], OrderedDict())
+        variants[key] = None
+        variants.move_to_end(key)
+        while len(variants) > self.max_variants:
+            self.delete(next(iter(variants)))
+
+    def _put(self, key: Tuple[str, str], value: CachedResponse) -> None:
+        """Put entry to memory, evict other entries if cache is full."""
+        if self.codec is not None:
+            value.compress(self.codec, self.compression_threshold)
+        previous_entry = self.cache.get(key)
+        if previous_entry is not None:
+            self._untrack_size(previous_entry)
+            self.eviction_policy.on_access(key)
+        else:
+            self.eviction_policy.on_insert(key)
+        self.cache[key] = value
+        self._track_size(value)
+        self._add_expiration(key, value)
+        self._index(key, value)
+        self._evict()
+
+    def _evict(self) -> None:
+        """Evict entries until cache fits into its limits."""
+        while (
+            len(self.cache) > self.capacity
+            or (
+                self.max_bytes is not None and self.total_bytes > self.max_bytes
+            )
+            or (
+                self.max_spill_bytes is not None
+                and self.spilled_bytes > self.max_spill_bytes
+            )
+        ):
+            victim = cast(Tuple, self.eviction_policy.victim())
+            if victim not in self.cache:
+                # policy is out of sync with cache, e.g. shared with other
+                # one, removing nothing would loop forever
+                logger.warning("Eviction victim %s is not in cache", victim)
+                break
+            # evicted entries are kept in storage
+            self._remove(victim)
+            self.metrics.inc("evictions")
+
+    def resize(
+        self, key: Tuple, entry: CachedResponse, previous_size: int
+    ) -> None:
+        """Account for changed size of entry, e.g. memoized text or json.
+
+        Other entries are evicted, if cache doesn't fit into `max_bytes`
+        anymore. Nothing is done if entry is not in cache already.
+        """
+        if self.cache.get(key) is not entry:
+            return
+        self.total_bytes += entry.size - previous_size
+        self.raw_bytes += entry.size - previous_size
+        self._evict()
+
+    def get(self, key: Tuple[str, str]) -> CachedResponse:
         """Get entry from cache."""
-        try:
-            cache_entry = self.cache.get(key)
-            if cache_entry:
-                logger.debug(f"Get entry from cache for {key} key")
-                self.cache.move_to_end(key)
-                return cache_entry["value"]
+        cache_entry = self.cache.get(key)
+        if cache_entry is None:
             raise CacheException(f"No cache entry for {key} key")
-        except Exception:
-            raise CacheException(
-                f"Error getting value from cache for {key} key"
+        logger.debug("Get entry from cache for %s key", key)
+        self.eviction_policy.on_access(key)
+        return cache_entry
+
+    def _set_freshness(
+        self, entry: CachedResponse, cc_header: CacheControl, headers: Any
+    ) -> None:
+        """Set freshness of entry according to RFC 9111.
+
+        Response is as old as its Age header says when it is received.
+        Date header is compared only with other headers of the response,
+        so difference between clocks of client and origin doesn't matter.
+        """
+        entry.created_at = time.time() - _parse_age(headers.get("Age"))
+        entry.max_age = self._get_freshness_lifetime(cc_header, headers)
+        if (
+            "no-cache" in cc_header
+            or "must-revalidate" in cc_header
+            or (self.shared and "proxy-revalidate" in cc_header)
+        ):
+            # response must not be served without revalidation, also when
+            # stale windows are given by config
+            entry.stale_while_revalidate = entry.stale_if_error = 0
+            return
+        entry.stale_while_revalidate = cc_header.get(
+            "stale-while-revalidate", self.stale_while_revalidate
+        )
+        entry.stale_if_error = cc_header.get(
+            "stale-if-error", self.stale_if_error
+        )
+
+    def _get_freshness_lifetime(
+        self, cc_header: CacheControl, headers: Any
+    ) -> int:
+        """Get lifetime in seconds of response.
+
+        Lifetime is given by s-maxage (in shared cache only), max-age or
+        Expires directives, in this order. Otherwise it is a fraction of
+        time since Last-Modified or `max_age` config option.
+        """
+        if "no-cache" in cc_header:
+            # response must be revalidated before each use
+            return 0
+        if self.shared and "s-maxage" in cc_header:
+            return cc_header["s-maxage"]
+        if "max-age" in cc_header:
+            return cc_header["max-age"]
+        date = _parse_http_date(headers.get("Date")) or time.time()
+        expires = headers.get("Expires")
+        if expires is not None:
+            expires_at = _parse_http_date(expires)
+            if expires_at is None:
+                # invalid Expires, e.g. "0", means response is expired
+                return 0
+            return max(0, int(expires_at - date))
+        last_modified = _parse_http_date(headers.get("Last-Modified"))
+        if last_modified is not None:
+            return min(
+                int(max(0, date - last_modified) * HEURISTIC_FRESHNESS),
+                self.max_heuristic_age,
             )
+        return self.default_max_age
+
+    def _delete_at(self, entry: CachedResponse) -> float:
+        """Get timestamp after which entry is of no use and can be deleted."""
+        stale_ttl = max(entry.stale_while_revalidate, entry.stale_if_error)
+        if entry.has_validators:
+            stale_ttl = max(stale_ttl, self.stale_ttl)
+        return entry.expires_at + stale_ttl
 
     def delete(self, key: Tuple[str, str]) -> None:
         """Delete entry from cache."""
-        logger.debug(f"Delete entry from cache for {key} key")
-        self.cache.pop(key, None)
+        logger.debug("Delete entry from cache for %s key", key)
+        self._remove(key)
+        self._update_storage("delete", key)
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        """Remove entry from memory."""
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self._untrack_size(entry)
+            self.eviction_policy.on_remove(key)
+            self.invalidation_index.remove(key)
+            if entry.variant is not None:
+                self._remove_variant(key)
+
+    def _track_size(self, entry: CachedResponse) -> None:
+        self.total_bytes += entry.size
+        self.raw_bytes += entry.raw_size
+        self.spilled_bytes += entry.spilled_size
+
+    def _untrack_size(self, entry: CachedResponse) -> None:
+        self.total_bytes -= entry.size
+        self.raw_bytes -= entry.raw_size
+        self.spilled_bytes -= entry.spilled_size
+
+    def _remove_variant(self, key: Tuple) -> None:
+        variants = self._variants.get(key[:-1])
+        if variants is None:
+            return
+        variants.pop(key, None)
+        if not variants:
+            # nothing to select from, Vary is learned again on next response
+            del self._variants[key[:-1]]
+            self._vary.pop(key[:-1], None)
+
+    def _index(self, key: Tuple, entry: CachedResponse) -> None:
+        """Index entry by its URL and tags."""
+        if len(key) > 1 and isinstance(key[1], str):
+            url = key[1]  # type: Optional[str]
+        elif entry.url:
+            # key is a digest
+            url = self.key_builder.canonical_url(entry.url)
+        else:
+            url = None
+        tags = []
+        for name in self.tag_headers:
+            for value in entry.headers.getall(name, ()):
+                tags.extend(value.replace(",", " ").split())
+        self.invalidation_index.add(key, url, tags)
+
+    def invalidate_url(self, url: str, params: Any = None) -> int:
+        """Delete entries of URL with all their variants.
+
+        Returns amount of deleted entries in memory. Entries in storage,
+        which are not loaded to memory, are deleted only if their keys
+        don't depend on request headers.
+        """
+        canonical_url = self.key_builder.canonical_url(url, params)
+        keys = self.invalidation_index.keys_for_url(canonical_url)
+        if self.storage is not None:
+            for method in self.cacheable_methods:
+                key = self.key_builder(method, url, params)
+                if key not in self.cache:
+                    self._update_storage("delete", key)
+        return self._invalidate(keys)
+
+    def invalidate_prefix(self, prefix: str) -> int:
+        """Delete entries in memory which URL starts with `prefix`.
+
+        Prefix is compared with canonical URLs, see KeyBuilder.
+        """
+        return self._invalidate(
+            self.invalidation_index.keys_for_prefix(
+                self.key_builder.canonical_url(prefix)
+            )
+        )
+
+    def invalidate_host(self, host: str) -> int:
+        """Delete entries in memory of URLs with given host."""
+        return self._invalidate(self.invalidation_index.keys_for_host(host))
+
+    def invalidate_tag(self, tag: str) -> int:
+        """Delete entries in memory tagged with `tag` by tag headers."""
+        return self._invalidate(self.invalidation_index.keys_for_tag(tag))
+
+    def _invalidate(self, keys: List[Tuple]) -> int:
+        for key in keys:
+            self.delete(key)
+        if keys:
+            self.metrics.inc("invalidations", len(keys))
+            logger.debug("Invalidated %d cache entries", len(keys))
+        return len(keys)
 
     def clear_cache(self) -> None:
         """Delete everything from cache."""
         self.cache.clear()
+        self.eviction_policy.clear()
+        self.total_bytes = self.raw_bytes = self.spilled_bytes = 0
+        self._expirations.clear()
+        self._vary.clear()
+        self._variants.clear()
+        self.invalidation_index.clear()
+        self._update_storage("clear")
+
+    async def load_from_storage(
+        self, key: Tuple[str, str]
+    ) -> Optional[CachedResponse]:
+        """Load entry from storage to memory, if it is not there yet."""
+        entry = self.cache.get(key)
+        if entry is not None or self.storage is None:
+            return entry
+        if key in self._unsaved:
+            entry = self._unsaved[key]
+        else:
+            entry = await self.storage.get(key)
+        if entry is not None and entry.variant == ():
+            # responses vary, caller has to load variant key now
+            self._load_vary(key, entry)
+            return None
+        # entry could be added to memory while storage was accessed
+        if entry is not None and key not in self.cache:
+            self._put_loaded(key, entry)
+            logger.debug("Loaded entry from storage for %s key", key)
+        return self.cache.get(key)
+
+    async def warm_up(self, limit: Optional[int] = None) -> int:
+        """Load most recently used entries from storage to memory.
+
+        Should be called on start, so cache is not empty after restart.
+        Returns amount of loaded entries.
+        """
+        if self.storage is None:
+            return 0
+        if limit is None or limit > self.capacity:
+            limit = self.capacity
+        entries = await self.storage.most_recently_used(limit)
+        loaded = 0
+        # put the oldest first, so eviction policy sees the right order
+        for key, entry in reversed(entries):
+            if entry.variant == ():
+                self._load_vary(cast(Tuple, key), entry)
+            elif key not in self.cache:
+                self._put_loaded(cast(Tuple, key), entry)
+                loaded += 1
+        return loaded
+
+    def _put_loaded(self, key: Tuple, entry: CachedResponse) -> None:
+        """Put entry loaded from storage to memory, restore its Vary."""
+        if entry.variant is not None:
+            vary = self.parse_vary_header(entry.headers)
+            # request headers the variant was selected for
+            request_headers = CIMultiDict(
+                (name, value)
+                for name, value in zip(vary, entry.variant)
+                if value is not None
+            )
+            self.register_vary(key[:-1], entry, request_headers)
+        self._put(key, entry)
+        if entry.variant is not None and key in self.cache:
+            self._add_variant(key)
+
+    async def close(self) -> None:
+        """Wait for pending storage updates and close storage."""
+        if self.storage is None:
+            return
+        if self._storage_writer is not None:
+            await self._storage_writer
+        await self.storage.close()
+
+    def touch(self, key: Tuple) -> None:
+        """Mark entry as recently used in storage, in background.
+
+        Called on cache hits served from memory, so storage evicts entries
+        which are cold in memory too.
+        """
+        self._update_storage("touch", key)
+
+    def _update_storage(self, method: str, *args) -> None:
+        """Update storage in background, if there is any."""
+        if self.storage is None:
+            return
+        if method == "set":
+            self._unsaved[args[0]] = args[1]
+        elif method == "delete":
+            self._unsaved[args[0]] = None
+        elif method == "clear":
+            self._unsaved.clear()
+        self._storage_updates.append((method, args))
+        if self._storage_writer is None or self._storage_writer.done():
+            self._storage_writer = asyncio.ensure_future(
+                self._write_to_storage()
+            )
+
+    async def _write_to_storage(self) -> None:
+        """Apply pending storage updates in order, consecutive sets,
+        deletes and touches are applied in bulk."""
+        storage = self.storage
+        if storage is None:
+            return
+        updates = self._storage_updates
+        while updates:
+            method, args = updates.popleft()
+            batch = [args]
+            while method != "clear" and updates and updates[0][0] == method:
+                batch.append(updates.popleft()[1])
+            try:
+                if method == "set":
+                    await storage.set_many(batch)
+                elif method == "delete":
+                    await storage.delete_many([key for key, in batch])
+                elif method == "touch":
+                    # hot entries are touched many times in a row
+                    await storage.touch_many(
+                        dict.fromkeys(key for key, in batch)
+                    )
+                else:
+                    await storage.clear()
+            except Exception as exc:
+                logger.warning("Failed to update cache storage: %r", exc)
+            if method in ("set", "delete"):
+                self._forget_saved(batch)
+
+    def _forget_saved(self, batch: List[tuple]) -> None:
+        for key, *entry in batch:
+            saved_entry = entry[0] if entry else None
+            # entry could be changed again while it was being written
+            if key in self._unsaved and self._unsaved[key] is saved_entry:
+                del self._unsaved[key]
 
     def is_cache_entry_expired(self, key: Tuple[str, str]) -> bool:
         """Check if cache entry is expired."""
-        entry = self.cache[key]
-        return entry["created_at"] + entry["max-age"] < time.time()
+        return not self.cache[key].is_fresh(time.time())
+
+    def purge_expired(self, limit: Optional[int] = None) -> int:
+        """Delete expired entries which can't be revalidated anymore,
+        at most `limit` of them.
+
+        Returns amount of deleted entries.
+        """
+        now = time.time()
+        purged = 0
+        expirations = self._expirations
+        while expirations and expirations[0][0] < now:
+            if limit is not None and purged >= limit:
+                break
+            expires_at, key = heapq.heappop(expirations)
+            # skip items left from replaced or deleted entries
+            if self._is_current_expiration(expires_at, key):
+                self.delete(key)
+                purged += 1
+        if purged:
+            self.metrics.inc("expirations", purged)
+        return purged
+
+    def _add_expiration(self, key: Tuple[str, str], entry: Any) -> None:
+        heapq.heappush(self._expirations, (self._delete_at(entry), key))
+        # drop outdated items when they take most of the index
+        if len(self._expirations) > 2 * len(self.cache) + 64:
+            self._expirations = [
+                item
+                for item in self._expirations
+                if self._is_current_expiration(*item)
+            ]
+            heapq.heapify(self._expirations)
+
+    def _is_current_expiration(
+        self, expires_at: float, key: Tuple[str, str]
+    ) -> bool:
+        entry = self.cache.get(key)
+        return entry is not None and self._delete_at(entry) == expires_at
+
+    def try_register_new_key(self, key: Tuple[str, str]) -> bool:
+        """Register new key without waiting.
+
+        Returns:
+            False if key is already registered by another request
+        """
+        if key in self._in_flight:
+            return False
+        self._in_flight[key] = self._create_future()
+        return True
+
+    def try_register_refresh_ahead(
+        self, key: Tuple, entry: CachedResponse
+    ) -> bool:
+        """Count hit of fresh entry and register its key, if it is time to
+        refresh the entry ahead of expiration.
+
+        Entry is refreshed once it is older than `refresh_ahead` fraction
+        of its max-age and has been hit at least `refresh_ahead_min_hits`
+        times, at most `max_background_refreshes` entries at once.
+        Immutable entries are not refreshed, nothing is refreshed if
+        refresh-ahead is disabled.
+        Key is registered as by `try_register_new_key`, caller must refresh
+        the entry and release the key.
+        """
+        if self.refresh_ahead is None:
+            return False
+        entry.hits += 1
+        if (
+            entry.hits < self.refresh_ahead_min_hits
+            or len(self._refreshing_ahead) >= self.max_background_refreshes
+            or time.time()
+            < entry.created_at + entry.max_age * self.refresh_ahead
+            or "immutable" in self.parse_cache_control_header(entry.headers)
+            or not self.try_register_new_key(key)
+        ):
+            return False
+        self._refreshing_ahead.add(key)
+        self.metrics.inc("refreshes_ahead")
+        return True
+
+    def _create_future(self) -> Any:
+        """Create future which is resolved by request of registered key."""
+        future = asyncio.get_event_loop().create_future()
+        # do not complain about exception nobody has been waiting for
+        future.add_done_callback(_retrieve_exception)
+        return future
 
     async def register_new_key(
         self, key: Tuple[str, str], timeout=DEFAULT_WAIT_TIMEOUT
-    ):
+    ) -> Optional[Any]:
         """Register new key before actual request, so all subsequent requests
-        will know and wait until this one returned a result.
+        for the same key will wait for this one instead of doing their own.
 
         This should avoid dog-piling problem.
         More details here: https://en.wikipedia.org/wiki/Cache_stampede
+
+        Returns:
+            None if caller has registered the key and must do the request
+            and then call `release_new_key`, otherwise the response produced
+            by concurrent request for the same key. If concurrent request
+            failed, its exception is raised.
         """
-        total_wait_time = 0.0
-        while True:
-            if key not in self._wait_until_completed:
-                break
-            await asyncio.sleep(self.sleep_time)
-            total_wait_time += self.sleep_time
-            if total_wait_time >= timeout:
+        if key[0] not in self.cacheable_methods:
+            return None
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while key in self._in_flight:
+            try:
+                value = await asyncio.wait_for(
+                    asyncio.shield(self._in_flight[key]),
+                    deadline - loop.time(),
+                )
+            except asyncio.TimeoutError:
                 raise TimeoutException(f"Timeout exceeded for {key}")
-        if key not in self.cache:
-            self._wait_until_completed.add(key)
-
-    def release_new_key(self, key: Tuple[str, str]):
-        """Release previously registered key, so all subsequent requests can use it."""
-        try:
-            self._wait_until_completed.remove(key)
-        except Exception:
-            # TODO: consider adding debug log here
-            pass
-
-    def _is_response_cacheable(self, method, cc_header):
+            if value is not None:
+                self.metrics.inc("coalesced")
+                return value
+            # request was cancelled without result, try to take it over
+        self.try_register_new_key(key)
+        return None
+
+    def release_new_key(
+        self,
+        key: Tuple[str, str],
+        value: Any = None,
+        exception: Optional[BaseException] = None,
+    ) -> None:
+        """Release previously registered key and wake up all waiters.
+
+        Waiters receive given value or exception. If neither is given, one
+        of the waiters takes over the key and repeats the request.
+        """
+        future = self._in_flight.pop(key, None)
+        self._refreshing_ahead.discard(key)
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(value)
+
+    def _is_response_cacheable(self, method, cc_header, response):
         """Check if response can be cached."""
         if method not in self.cacheable_methods:
             return False
-        # Although, no-cache means "The response may be stored by any cache,
-        # but MUST always go through validation with the origin server first
-        # before using it", we won't cache it for simplicity for now.
-        if "no-cache" in cc_header or "no-store" in cc_header:
+        if response.status not in self.cacheable_statuses:
+            return False
+        if "no-store" in cc_header:
+            return False
+        if self.shared and "private" in cc_header:
+            return False
+        # no-cache means "The response may be stored by any cache, but MUST
+        # always go through validation with the origin server first before
+        # using it", so there is no point to store it without validators.
+        if "no-cache" in cc_header and not response.has_validators:
             return False
         return True
 
     @staticmethod
-    def parse_cache_control_header(headers) -> Dict:
-        """Parse cache-control header, get max-age value.
+    def parse_cache_control_header(headers) -> CacheControl:
+        """Parse cache-control header, get its directives.
 
         Args:
             headers: any dict-like object
 
         Returns:
-            dict: parsed cache-control header
+            CacheControl: immutable mapping of directives, it is shared
+            by all headers with the same value
 
         Example:
             >>> headers = {"Cache-Control": "max-age=604800",
                            "Content-Type": "application/json"}
             >>> self.parse_cache_control_header(headers)
-            {"max-age": 604800}
+            <CacheControl {"max-age": 604800}>
         """
-        cache_control_header = headers.get(
-            "cache-control",
-            headers.get("Cache-Control", headers.get("CACHE-CONTROL", "")),
-        )
+        return get_cache_control(headers)
+
+    @staticmethod
+    def parse_vary_header(headers) -> Tuple[str, ...]:
+        """Get sorted lowercase names of headers listed in Vary header.
+
+        Args:
+            headers: CIMultiDictProxy of the response
+        """
+        names = set()  # type: Set[str]
+        for value in headers.getall("Vary", ()):
+            names.update(
+                name.strip().lower()
+                for name in value.split(",")
+                if name.strip()
+            )
+        return tuple(sorted(names))
+
+    @staticmethod
+    def select_variant(
+        vary: Tuple[str, ...], request_headers: Any
+    ) -> Tuple[Optional[str], ...]:
+        """Get normalized values of request headers listed in Vary header.
+
+        Args:
+            vary: names of headers
+            request_headers: any dict-like object, None for no headers
+        """
+        if not isinstance(request_headers, (CIMultiDict, CIMultiDictProxy)):
+            request_headers = CIMultiDict(request_headers or {})
+        values = []  # type: List[Optional[str]]
+        for name in vary:
+            header_values = request_headers.getall(name, None)
+            if header_values is None:
+                values.append(None)
+            else:
+                # whitespace is not significant when values are compared
+                values.append(" ".join(", ".join(header_values).split()))
+        return tuple(values)
+
+
+def _parse_http_date(value: Optional[str]) -> Optional[float]:
+    """Get timestamp of HTTP date, None if it is missing or invalid."""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _parse_age(value: Optional[str]) -> int:
+    """Get value of Age header, 0 if it is missing or invalid."""
+    if value is None:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return 0
+
 
-        # Currently, parse the most important directives
-        # TODO: consider parse all possible directives
-        parsed_header = {}  # type: Dict[str, Any]
-        for directive in cache_control_header.split(","):
-            cleaned_directive = directive.strip().lower()
-            # get directives without values
-            if cleaned_directive in ("no-cache", "no-store"):
-                parsed_header[cleaned_directive] = True
-            elif "=" in cleaned_directive:
-                key, value = cleaned_directive.split("=", 1)
-                if "max-age" == key:
-                    try:
-                        parsed_header["max-age"] = int(value)
-                    except ValueError:
-                        logger.debug('Failed to parse "max-age" directive.')
-            # ignore all other directives except no-cache, no-store, max-age
-        return parsed_header
+def _retrieve_exception(future: asyncio.Future) -> None:
+    if not future.cancelled():
+        future.exception()
@@ -0,0 +1,105 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Any, Dict, Iterator, Union
+
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from .constants import CACHE_CONTROL_SECONDS, DEFAULT_CACHE_CONTROL_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class CacheControl(Mapping):
+    """Parsed Cache-Control header, immutable mapping of its directives.
+
+    Names of directives are lowercase. Values of known directives with
+    seconds, e.g. max-age, are ints, directives without value are True,
+    values of other directives are strings without quotes. Qualified
+    no-cache and private, e.g. private="Set-Cookie", are True as well,
+    as they are applied to the whole response.
+    """
+
+    __slots__ = ("_directives",)
+
+    def __init__(self, directives: Dict[str, Any]):
+        self._directives = directives
+
+    def __getitem__(self, name: str) -> Any:
+        return self._directives[name]
+
+    def __contains__(self, name: Any) -> bool:
+        return name in self._directives
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._directives)
+
+    def __len__(self) -> int:
+        return len(self._directives)
+
+    def __repr__(self) -> str:
+        return f"<CacheControl {self._directives!r}>"
+
+
+EMPTY_CACHE_CONTROL = CacheControl({})
+
+
+def get_cache_control(headers: Any) -> CacheControl:
+    """Get parsed Cache-Control header of any dict-like headers object."""
+    if isinstance(headers, (CIMultiDict, CIMultiDictProxy)):
+        values = headers.getall("Cache-Control", ())
+        # repeated header is the same as single one with joined values
+        value = values[0] if len(values) == 1 else ", ".join(values)
+    else:
+        value = next(
+            (
+                value
+                for name, value in headers.items()
+                if name.lower() == "cache-control"
+            ),
+            "",
+        )
+    return parse_cache_control(value)
+
+
+@lru_cache(maxsize=DEFAULT_CACHE_CONTROL_CACHE_SIZE)
+def parse_cache_control(value: Union[str, bytes]) -> CacheControl:
+    """Parse value of Cache-Control header.
+
+    Results are memoized, origins tend to send the same few values.
+    """
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+    directives = {}  # type: Dict[str, Any]
+    for directive in value.split(","):
+        name, has_value, directive_value = directive.partition("=")
+        name = name.strip().lower()
+        if not name:
+            continue
+        directive_value = directive_value.strip().strip('"')
+        if name in CACHE_CONTROL_SECONDS:
+            try:
+                directives[name] = int(directive_value)
+            except ValueError:
+                logger.debug('Failed to parse "%s" directive.', name)
+        elif name in ("no-cache", "private") or not has_value:
+            directives[name] = True
+        else:
+            directives[name] = directive_value
+    return CacheControl(directives)
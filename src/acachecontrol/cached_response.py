@@ -0,0 +1,403 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import copy
+import json
+import os
+import tempfile
+import weakref
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Optional, Tuple
+
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from .compression import Codec
+
+DEFAULT_ENCODING = "utf-8"
+
+
+class CachedResponse:
+    """Compact snapshot of aiohttp response, which is stored in cache.
+
+    Holds only data needed to serve the response again, so cache entries
+    do not keep connections, request info or event loop alive.
+    Provides the same reading interface as aiohttp.ClientResponse.
+    Body of big streamed response is kept in spill file, which is removed
+    together with the response. Body in memory may be compressed with codec,
+    it is decompressed on read.
+    """
+
+    __slots__ = (
+        "status",
+        "headers",
+        "url",
+        "created_at",
+        "max_age",
+        "stale_while_revalidate",
+        "stale_if_error",
+        "size",
+        "hits",
+        "variant",
+        "codec",
+        "_body",
+        "_body_length",
+        "_path",
+        "_text",
+        "_json",
+        "__weakref__",
+    )
+
+    def __init__(
+        self,
+        status: int,
+        headers: Any,
+        body: bytes,
+        url: str = "",
+        created_at: float = 0.0,
+        max_age: int = 0,
+    ):
+        self.status = status
+        self.url = url
+        self.created_at = created_at
+        self.max_age = max_age
+        # how long in seconds response can be served after expiration
+        # while it is refreshed in background or when origin fails
+        self.stale_while_revalidate = 0
+        self.stale_if_error = 0
+        # fresh hits since response was stored or refreshed, counted only
+        # if cache refreshes hot entries ahead of expiration
+        self.hits = 0
+        # values of request headers listed in Vary header, which response
+        # was selected for, None if response does not vary
+        self.variant = None  # type: Optional[Tuple[Optional[str], ...]]
+        self.codec = None  # type: Optional[Codec]
+        self._body = body
+        self._body_length = len(body)
+        self._path = None  # type: Optional[str]
+        self.update_headers(headers)
+
+    @classmethod
+    def from_client_response(cls, response, body: bytes) -> "CachedResponse":
+        """Create snapshot from aiohttp.ClientResponse and its read body."""
+        return cls(response.status, response.headers, body, str(response.url))
+
+    def __repr__(self):
+        return f"<CachedResponse({self.url}) [{self.status}]>"
+
+    def update_headers(self, headers: Any) -> None:
+        """Replace headers, e.g. with ones of 304 Not Modified response."""
+        if not isinstance(headers, CIMultiDictProxy):
+            headers = CIMultiDictProxy(CIMultiDict(headers))
+        self.headers = headers
+        # decoded body depends on charset from headers
+        self._text = None  # type: Optional[str]
+        self._json = None  # type: Optional[Tuple[Callable, Any]]
+        # approximate amount of memory taken by response data, in bytes,
+        # body in spill file is not counted, memoized text and json are
+        # counted as much as body each
+        self.size = len(self._body) + sum(
+            len(name) + len(value) for name, value in headers.items()
+        )
+
+    def set_body(
+        self, body: bytes, path: Optional[str] = None, spilled_size: int = 0
+    ) -> None:
+        """Replace body, e.g. once streamed response is read.
+
+        Args:
+            body: body in memory, ignored if `path` is given
+            path: spill file with body, owned by the response from now on
+            spilled_size: size in bytes of body in spill file
+        """
+        self.size -= len(self._body) + self._memoized_size()
+        self._body = b"" if path is not None else body
+        self._body_length = spilled_size if path is not None else len(body)
+        self._path = path
+        self.codec = None
+        self._text = self._json = None
+        self.size += len(self._body)
+        if path is not None:
+            weakref.finalize(self, _remove_file, path)
+
+    def set_compressed_body(
+        self, body: bytes, codec: Codec, body_length: int
+    ) -> None:
+        """Replace body with one compressed by `codec`, e.g. from storage.
+
+        Args:
+            body: compressed body
+            codec: codec the body is compressed with
+            body_length: size in bytes of body before compression
+        """
+        self.set_body(body)
+        self._body_length = body_length
+        self.codec = codec
+
+    def compress(self, codec: Codec, threshold: int = 0) -> bool:
+        """Compress body in memory, if it is worth it.
+
+        Bodies smaller than `threshold` bytes or not shrinking after
+        compression are kept as is. Body is always stored decoded, since
+        aiohttp decompresses it on read, so Content-Encoding header of origin
+        doesn't matter here.
+
+        Returns:
+            True if body has been compressed
+        """
+        if (
+            self.codec is not None
+            or self._path is not None
+            or len(self._body) < threshold
+        ):
+            return False
+        compressed_body = codec.compress(self._body)
+        if len(compressed_body) >= len(self._body):
+            return False
+        self.size -= len(self._body) - len(compressed_body)
+        self._body = compressed_body
+        self.codec = codec
+        return True
+
+    @property
+    def raw_size(self) -> int:
+        """Size in bytes as if body was not compressed."""
+        if self._path is not None:
+            return self.size
+        return self.size - len(self._body) + self._body_length
+
+    @property
+    def spilled_size(self) -> int:
+        """Size in bytes of body in spill file."""
+        return self._body_length if self._path is not None else 0
+
+    def _memoized_size(self) -> int:
+        """Size in bytes counted for memoized text and json."""
+        memoized = (self._text is not None) + (self._json is not None)
+        return memoized * self._body_length
+
+    @property
+    def spill_path(self) -> Optional[str]:
+        """Path of spill file with body, None if body is in memory."""
+        return self._path
+
+    @property
+    def stored_body(self) -> bytes:
+        """Body as it is kept, compressed if response has codec.
+
+        Blocks to read spill file if there is one.
+        """
+        if self._path is not None:
+            return _read_file(self._path)
+        return self._body
+
+    @property
+    def body(self) -> bytes:
+        """Response body, blocks to read spill file if there is one."""
+        if self._path is not None:
+            return _read_file(self._path)
+        if self.codec is not None:
+            return self.codec.decompress(self._body)
+        return self._body
+
+    @property
+    def expires_at(self) -> float:
+        """Timestamp when response becomes stale."""
+        return self.created_at + self.max_age
+
+    def is_fresh(self, now: float) -> bool:
+        """Check if response is not expired at given timestamp."""
+        return self.created_at + self.max_age > now
+
+    @property
+    def has_validators(self) -> bool:
+        """Check if response can be revalidated with conditional request."""
+        return "ETag" in self.headers or "Last-Modified" in self.headers
+
+    def get_encoding(self) -> str:
+        """Get encoding from Content-Type header, utf-8 by default."""
+        content_type = self.headers.get("Content-Type", "")
+        for param in content_type.split(";")[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "charset" and value.strip():
+                return value.strip().strip('"')
+        return DEFAULT_ENCODING
+
+    async def read(self) -> bytes:
+        """Return response body."""
+        if self._path is not None:
+            # worker thread must not hold the response, so spill file is
+            # removed as soon as the response is dropped
+            return await _run_in_executor(_read_file, self._path)
+        return self.body
+
+    async def iter_chunked(self, n: int) -> AsyncIterator[bytes]:
+        """Iterate over response body by chunks of `n` bytes."""
+        if self._path is None:
+            body = self.body
+            for start in range(0, len(body), n):
+                yield body[start : start + n]
+            return
+        body_file = await _run_in_executor(open, self._path, "rb")
+        try:
+            while True:
+                chunk = await _run_in_executor(body_file.read, n)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body_file.close()
+
+    async def text(
+        self,
+        encoding: Optional[str] = None,
+        errors: str = "strict",
+        memoize: bool = False,
+    ) -> str:
+        """Return response body decoded to str.
+
+        If `memoize` is True, text decoded with default arguments is kept
+        with the response, so body is decoded once for all reads.
+        Body in spill file is never memoized, it is too big for memory.
+        """
+        if encoding is not None or errors != "strict":
+            body = await self.read()
+            return body.decode(encoding or self.get_encoding(), errors)
+        if self._text is not None:
+            return self._text
+        text = (await self.read()).decode(self.get_encoding())
+        if memoize and self._path is None and self._text is None:
+            self._text = text
+            self.size += self._body_length
+        return text
+
+    async def json(
+        self,
+        encoding: Optional[str] = None,
+        loads: Callable[[str], Any] = json.loads,
+        memoize: Optional[str] = None,
+    ) -> Any:
+        """Return response body parsed as json, None for empty body.
+
+        Args:
+            encoding: encoding of body, taken from Content-Type by default
+            loads: function which parses json
+            memoize: keep parsed object with the response, so body is parsed
+                once for all reads with default encoding and the same `loads`.
+                "shared" returns the same object, it must not be modified,
+                "copy" returns its deep copy, body in spill file is never
+                memoized
+        """
+        if not memoize or encoding is not None or self._path is not None:
+            return _loads(await self.text(encoding), loads)
+        if self._json is None or self._json[0] is not loads:
+            value = _loads(await self.text(), loads)
+            if self._json is None:
+                self.size += self._body_length
+            self._json = (loads, value)
+        value = self._json[1]
+        return copy.deepcopy(value) if memoize == "copy" else value
+
+
+class BodyWriter:
+    """Collect body of streamed response.
+
+    Body is kept in memory until it exceeds `spill_threshold` bytes, then
+    it is moved to temporary file in `spill_dir`, so big bodies are never
+    held in memory. File is written in executor, not to block event loop.
+    Once body exceeds `max_size` bytes, it is dropped and writer stops,
+    see `exceeded`.
+    """
+
+    def __init__(
+        self,
+        spill_threshold: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        max_size: Optional[int] = None,
+    ):
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.max_size = max_size
+        # amount of written bytes
+        self.length = 0
+        self.exceeded = False
+        self._buffer = bytearray()
+        self._file = None  # type: Any
+
+    async def write(self, chunk: bytes) -> None:
+        if self.exceeded:
+            return
+        self.length += len(chunk)
+        if self.max_size is not None and self.length > self.max_size:
+            self.abort()
+            self.exceeded = True
+            return
+        if self._file is None:
+            self._buffer += chunk
+            if (
+                self.spill_threshold is None
+                or len(self._buffer) <= self.spill_threshold
+            ):
+                return
+            self._file = await _run_in_executor(
+                partial(
+                    tempfile.NamedTemporaryFile,
+                    prefix="acachecontrol-",
+                    dir=self.spill_dir,
+                    delete=False,
+                )
+            )
+            chunk, self._buffer = bytes(self._buffer), bytearray()
+        await _run_in_executor(self._file.write, chunk)
+
+    async def close(self) -> Tuple[bytes, Optional[str]]:
+        """Finish writing.
+
+        Returns:
+            body in memory and None or empty body and path of spill file
+        """
+        if self._file is None:
+            return bytes(self._buffer), None
+        await _run_in_executor(self._file.close)
+        return b"", self._file.name
+
+    def abort(self) -> None:
+        """Drop written body, e.g. when it was not read till the end."""
+        self._buffer = bytearray()
+        if self._file is not None:
+            self._file.close()
+            _remove_file(self._file.name)
+            self._file = None
+
+
+def _loads(text: str, loads: Callable[[str], Any]) -> Any:
+    return loads(text) if text.strip() else None
+
+
+def _run_in_executor(func: Callable, *args) -> asyncio.Future:
+    return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as body_file:
+        return body_file.read()
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
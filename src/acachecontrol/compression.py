@@ -0,0 +1,83 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import lzma
+import zlib
+from typing import Optional, Union
+
+
+class Codec:
+    """Interface of codec which compresses bodies of cached responses.
+
+    Bodies are compressed when they are put to memory and decompressed
+    when they are read, so codec has to be fast on both sides.
+    """
+
+    name = ""
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    """Fast compression with decent ratio."""
+
+    name = "zlib"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class LZMACodec(Codec):
+    """Better compression ratio at cost of more CPU time."""
+
+    name = "lzma"
+
+    def __init__(self, preset: int = 1):
+        self.preset = preset
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(data, preset=self.preset)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data)
+
+
+CODECS = {
+    "zlib": ZlibCodec,
+    "lzma": LZMACodec,
+}
+
+
+def get_codec(codec: Union[None, str, Codec]) -> Optional[Codec]:
+    """Get codec instance by its name or return given instance or None."""
+    if codec is None or isinstance(codec, Codec):
+        return codec
+    try:
+        return CODECS[codec.lower()]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown codec {codec!r}, available: {', '.join(CODECS)}"
+        )
@@ -15,10 +15,88 @@ limitations under the License.
 """
 
 CACHEABLE_METHODS = ("HEAD", "GET")
+# methods which don't change resources, responses of other ones with
+# non-error status invalidate cached responses of the same resource
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "TRACE"))
+# response headers listing tags of response, e.g. for bulk invalidation
+TAG_HEADERS = ("Surrogate-Key", "Cache-Tag")
+# response statuses which are cached, heuristically cacheable ones of RFC 9111
+# except 206 Partial Content, including 404 and 410 for negative caching
+CACHEABLE_STATUSES = frozenset(
+    (200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501)
+)
 
 # Values below provided in seconds
 DEFAULT_MAX_AGE = 120
 DEFAULT_WAIT_TIMEOUT = 60 * 5  # same value as in aiohttp library
-DEFAULT_SLEEP_TIME = 0.1
+# how long expired responses with ETag or Last-Modified are kept to be
+# revalidated with conditional request instead of full one
+DEFAULT_STALE_TTL = 60 * 60
+# default stale-while-revalidate and stale-if-error windows, see RFC 5861
+DEFAULT_STALE_WHILE_REVALIDATE = 0
+DEFAULT_STALE_IF_ERROR = 0
+# heuristic lifetime of responses with Last-Modified is a fraction of time
+# since their last modification, but not longer than max heuristic age
+HEURISTIC_FRESHNESS = 0.1
+DEFAULT_MAX_HEURISTIC_AGE = 60 * 60 * 24
 
 DEFAULT_CACHE_CAPACITY = 100  # max amount of records in cache
+DEFAULT_EVICTION_POLICY = "lru"
+DEFAULT_KEY_CACHE_SIZE = 1024  # max amount of memoized canonical URLs
+# max amount of memoized parsed Cache-Control headers
+DEFAULT_CACHE_CONTROL_CACHE_SIZE = 256
+DEFAULT_SWEEP_BATCH_SIZE = 1000  # max amount of expired records purged at once
+DEFAULT_FETCH_CONCURRENCY = 10  # max amount of concurrent requests of batch
+DEFAULT_MAX_VARIANTS = 8  # max amount of Vary variants stored per URL
+DEFAULT_SHARDS = 16  # amount of shards of ShardedAsyncCache
+# hits needed before entry is refreshed ahead of expiration
+DEFAULT_REFRESH_AHEAD_MIN_HITS = 2
+DEFAULT_MAX_BACKGROUND_REFRESHES = 10
+# bodies of streamed responses above this size in bytes are kept in file
+DEFAULT_SPILL_THRESHOLD = 1024 * 1024
+# max total size in bytes of spill files of cached responses
+DEFAULT_MAX_SPILL_BYTES = 1024**3
+DEFAULT_CHUNK_SIZE = 64 * 1024  # chunk size in bytes for reading streams
+# bodies smaller than this size in bytes are not compressed
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+# upper bounds in seconds of latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (
+    0.00001,
+    0.0001,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+)
+# modes of keeping parsed json with cached response
+JSON_MEMOIZE_MODES = ("shared", "copy")
+
+# Cache-Control directives with value in seconds
+CACHE_CONTROL_SECONDS = frozenset(
+    (
+        "max-age",
+        "s-maxage",
+        "min-fresh",
+        "stale-while-revalidate",
+        "stale-if-error",
+    )
+)
+
+# stored headers which are not updated by 304 Not Modified response
+NOT_UPDATED_HEADERS = frozenset(
+    (
+        "content-length",
+        "content-encoding",
+        "transfer-encoding",
+        "connection",
+        "keep-alive",
+    )
+)
+
+# response statuses considered as errors by stale-if-error directive
+STALE_IF_ERROR_STATUSES = frozenset((500, 502, 503, 504))
@@ -0,0 +1,311 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Union, cast
+
+# translation table which halves every counter of the frequency sketch
+_HALVE_TABLE = bytes(value >> 1 for value in range(256))
+
+
+class EvictionPolicy:
+    """Interface of eviction policy used by AsyncCache.
+
+    Policy tracks only keys, cache calls its hooks when entries are added,
+    read and removed, and asks it which key to evict when cache is full.
+    """
+
+    def on_insert(self, key: Hashable) -> None:
+        """New key has been added to cache."""
+        raise NotImplementedError
+
+    def on_access(self, key: Hashable) -> None:
+        """Existing key has been read or updated."""
+        raise NotImplementedError
+
+    def on_remove(self, key: Hashable) -> None:
+        """Key has been removed from cache."""
+        raise NotImplementedError
+
+    def victim(self) -> Hashable:
+        """Return key which should be evicted next.
+
+        Cache removes returned key itself, which triggers `on_remove`.
+        """
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        """Forget all keys."""
+        raise NotImplementedError
+
+
+class LRUPolicy(EvictionPolicy):
+    """Evict least recently used key."""
+
+    def __init__(self):
+        self._keys = OrderedDict()  # type: OrderedDict
+
+    def on_insert(self, key: Hashable) -> None:
+        self._keys[key] = None
+
+    def on_access(self, key: Hashable) -> None:
+        self._keys.move_to_end(key)
+
+    def on_remove(self, key: Hashable) -> None:
+        self._keys.pop(key, None)
+
+    def victim(self) -> Hashable:
+        return next(iter(self._keys))
+
+    def clear(self) -> None:
+        self._keys.clear()
+
+
+class LFUPolicy(EvictionPolicy):
+    """Evict least frequently used key, least recently used among equals.
+
+    All operations are O(1), keys are grouped by their access counts.
+    """
+
+    def __init__(self):
+        self._frequencies = {}  # type: Dict[Hashable, int]
+        self._buckets = {}  # type: Dict[int, OrderedDict]
+        self._min_frequency = 0
+
+    def on_insert(self, key: Hashable) -> None:
+        self._frequencies[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_frequency = 1
+
+    def on_access(self, key: Hashable) -> None:
+        frequency = self._frequencies[key]
+        self._remove_from_bucket(key, frequency)
+        self._frequencies[key] = frequency + 1
+        self._buckets.setdefault(frequency + 1, OrderedDict())[key] = None
+
+    def on_remove(self, key: Hashable) -> None:
+        frequency = self._frequencies.pop(key, None)
+        if frequency is not None:
+            self._remove_from_bucket(key, frequency)
+
+    def victim(self) -> Hashable:
+        if self._min_frequency not in self._buckets:
+            self._min_frequency = min(self._buckets)
+        return next(iter(self._buckets[self._min_frequency]))
+
+    def clear(self) -> None:
+        self._frequencies.clear()
+        self._buckets.clear()
+        self._min_frequency = 0
+
+    def _remove_from_bucket(self, key: Hashable, frequency: int) -> None:
+        bucket = self._buckets[frequency]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[frequency]
+
+
+class SIEVEPolicy(EvictionPolicy):
+    """SIEVE eviction, see https://cachemon.github.io/SIEVE-website/
+
+    Hit only marks key as visited without any reordering, so reads are
+    cheaper than in LRU. Eviction hand moves from the oldest keys to the
+    newest ones, evicting the first not visited key and resetting marks of
+    visited keys on its way.
+    """
+
+    # node fields
+    _NEWER, _OLDER, _KEY, _VISITED = range(4)
+
+    def __init__(self):
+        self._nodes = {}  # type: Dict[Hashable, List]
+        self._newest = None  # type: Optional[List]
+        self._oldest = None  # type: Optional[List]
+        self._hand = None  # type: Optional[List]
+
+    def on_insert(self, key: Hashable) -> None:
+        node = [None, self._newest, key, False]
+        if self._newest is not None:
+            self._newest[self._NEWER] = node
+        else:
+            self._oldest = node
+        self._newest = node
+        self._nodes[key] = node
+
+    def on_access(self, key: Hashable) -> None:
+        self._nodes[key][self._VISITED] = True
+
+    def on_remove(self, key: Hashable) -> None:
+        node = self._nodes.pop(key, None)
+        if node is None:
+            return
+        newer, older = node[self._NEWER], node[self._OLDER]
+        if self._hand is node:
+            self._hand = newer
+        if newer is not None:
+            newer[self._OLDER] = older
+        else:
+            self._newest = older
+        if older is not None:
+            older[self._NEWER] = newer
+        else:
+            self._oldest = newer
+
+    def victim(self) -> Hashable:
+        # victim is requested only when there are keys, so there is
+        # the oldest node, the hand wraps around to it
+        oldest = cast(List, self._oldest)
+        node = self._hand or oldest
+        while node[self._VISITED]:
+            node[self._VISITED] = False
+            node = node[self._NEWER] or oldest
+        self._hand = node
+        return node[self._KEY]
+
+    def clear(self) -> None:
+        self._nodes.clear()
+        self._newest = self._oldest = self._hand = None
+
+
+class FrequencySketch:
+    """Count-Min sketch with 4-bit counters which estimates how often keys
+    were seen recently.
+
+    Counters are halved after `sample_size` increments, so old popularity
+    fades away.
+    """
+
+    depth = 4
+    max_count = 15
+
+    def __init__(self, width: int = 1 << 14, sample_size: int = 0):
+        # round width up to a power of two to use bit mask instead of modulo
+        self._mask = (1 << max(width - 1, 1).bit_length()) - 1
+        self._table = bytearray((self._mask + 1) * self.depth)
+        self._sample_size = sample_size or 10 * (self._mask + 1)
+        self._additions = 0
+
+    def _indexes(self, key: Hashable):
+        key_hash = hash(key)
+        step = (key_hash >> 17) | 1
+        row_size = self._mask + 1
+        for row in range(self.depth):
+            yield row * row_size + ((key_hash + row * step) & self._mask)
+
+    def increment(self, key: Hashable) -> None:
+        table = self._table
+        for index in self._indexes(key):
+            if table[index] < self.max_count:
+                table[index] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._table = self._table.translate(_HALVE_TABLE)
+            self._additions //= 2
+
+    def estimate(self, key: Hashable) -> int:
+        table = self._table
+        return min(table[index] for index in self._indexes(key))
+
+    def clear(self) -> None:
+        self._table = bytearray(len(self._table))
+        self._additions = 0
+
+
+class WTinyLFUPolicy(EvictionPolicy):
+    """W-TinyLFU, see https://arxiv.org/abs/1512.00727
+
+    New keys get into a small LRU window. When cache is full, the oldest
+    key of the window competes with the LRU victim of the main segment and
+    only the one which was seen more often by the frequency sketch stays.
+    This way one-off keys (e.g. from crawling) cannot flush popular ones.
+    """
+
+    def __init__(self, window_ratio: float = 0.01, sketch_width: int = 1 << 14):
+        self.window_ratio = window_ratio
+        self._window = OrderedDict()  # type: OrderedDict
+        self._main = OrderedDict()  # type: OrderedDict
+        self._sketch = FrequencySketch(sketch_width)
+
+    def on_insert(self, key: Hashable) -> None:
+        self._sketch.increment(key)
+        self._window[key] = None
+
+    def on_access(self, key: Hashable) -> None:
+        self._sketch.increment(key)
+        if key in self._window:
+            self._window.move_to_end(key)
+        else:
+            self._main.move_to_end(key)
+
+    def on_remove(self, key: Hashable) -> None:
+        if key in self._window:
+            del self._window[key]
+        else:
+            self._main.pop(key, None)
+
+    def victim(self) -> Hashable:
+        window, main = self._window, self._main
+        max_window_size = max(
+            1, int((len(window) + len(main)) * self.window_ratio)
+        )
+        # keys collected while cache was not full go to main segment as is
+        while len(window) > max_window_size + 1:
+            main[window.popitem(last=False)[0]] = None
+        if not main:
+            return next(iter(window))
+        main_victim = next(iter(main))
+        if len(window) <= max_window_size:
+            return main_victim
+        # window is overflown, its oldest key has to compete for a place
+        candidate = next(iter(window))
+        if self._sketch.estimate(candidate) > self._sketch.estimate(
+            main_victim
+        ):
+            del window[candidate]
+            main[candidate] = None
+            return main_victim
+        return candidate
+
+    def clear(self) -> None:
+        self._window.clear()
+        self._main.clear()
+        self._sketch.clear()
+
+
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "sieve": SIEVEPolicy,
+    "w-tinylfu": WTinyLFUPolicy,
+}
+
+
+def get_eviction_policy(
+    policy: Union[str, EvictionPolicy, Callable[[], EvictionPolicy]],
+) -> EvictionPolicy:
+    """Get eviction policy instance by its name, class or factory,
+    or return given instance."""
+    if isinstance(policy, EvictionPolicy):
+        return policy
+    if callable(policy):
+        return policy()
+    try:
+        return EVICTION_POLICIES[policy.lower()]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown eviction policy {policy!r}, "
+            f"available: {', '.join(EVICTION_POLICIES)}"
+        )
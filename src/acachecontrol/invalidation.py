@@ -0,0 +1,163 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from yarl import URL
+
+# canonical URL and tags of indexed key
+IndexedEntry = Tuple[Optional[str], Tuple[str, ...]]
+
+
+class InvalidationIndex:
+    """Secondary index of cache keys by URL, host and tag.
+
+    Lets cache invalidate entries in bulk without scanning all of them.
+    URLs are sorted, so entries with URL starting with given prefix
+    are found with binary search. Added and removed URLs are merged into
+    sorted ones on the next prefix lookup, not on every change.
+    """
+
+    def __init__(self):
+        self._url_keys = {}  # type: Dict[str, Set[Tuple]]
+        # sorted URLs of indexed keys, without pending changes
+        self._urls = []  # type: List[str]
+        self._added_urls = set()  # type: Set[str]
+        self._removed_urls = set()  # type: Set[str]
+        self._host_urls = {}  # type: Dict[str, Set[str]]
+        # URL -> its host, URLs are parsed once
+        self._url_hosts = {}  # type: Dict[str, str]
+        self._tag_keys = {}  # type: Dict[str, Set[Tuple]]
+        # key -> its URL and tags, to unindex it
+        self._entries = {}  # type: Dict[Tuple, IndexedEntry]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(
+        self, key: Tuple, url: Optional[str], tags: Iterable[str] = ()
+    ) -> None:
+        """Index key by its canonical URL and tags."""
+        tags = tuple(tags)
+        if self._entries.get(key) == (url, tags):
+            # e.g. refreshed entry, nothing to reindex
+            return
+        self.remove(key)
+        if url is None and not tags:
+            return
+        self._entries[key] = (url, tags)
+        if url is not None:
+            keys = self._url_keys.get(url)
+            if keys is None:
+                keys = self._url_keys[url] = set()
+                self._add_url(url)
+            keys.add(key)
+        for tag in tags:
+            self._tag_keys.setdefault(tag, set()).add(key)
+
+    def remove(self, key: Tuple) -> None:
+        """Unindex key, if it is indexed."""
+        indexed = self._entries.pop(key, None)
+        if indexed is None:
+            return
+        url, tags = indexed
+        if url is not None:
+            keys = self._url_keys[url]
+            keys.discard(key)
+            if not keys:
+                del self._url_keys[url]
+                self._remove_url(url)
+        for tag in tags:
+            keys = self._tag_keys[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tag_keys[tag]
+
+    def clear(self) -> None:
+        self._url_keys.clear()
+        self._urls.clear()
+        self._added_urls.clear()
+        self._removed_urls.clear()
+        self._host_urls.clear()
+        self._url_hosts.clear()
+        self._tag_keys.clear()
+        self._entries.clear()
+
+    def _add_url(self, url: str) -> None:
+        if url in self._removed_urls:
+            self._removed_urls.discard(url)
+        else:
+            self._added_urls.add(url)
+        host = self._url_hosts[url] = _host(url)
+        self._host_urls.setdefault(host, set()).add(url)
+
+    def _remove_url(self, url: str) -> None:
+        if url in self._added_urls:
+            self._added_urls.discard(url)
+        else:
+            self._removed_urls.add(url)
+        host = self._url_hosts.pop(url)
+        host_urls = self._host_urls[host]
+        host_urls.discard(url)
+        if not host_urls:
+            del self._host_urls[host]
+
+    def _sorted_urls(self) -> List[str]:
+        """Get sorted URLs, merging pending changes."""
+        if self._removed_urls:
+            removed = self._removed_urls
+            self._urls = [url for url in self._urls if url not in removed]
+            removed.clear()
+        if self._added_urls:
+            # sort merges the sorted run with added URLs cheaply
+            self._urls.extend(self._added_urls)
+            self._urls.sort()
+            self._added_urls.clear()
+        return self._urls
+
+    def keys_for_url(self, url: str) -> List[Tuple]:
+        return list(self._url_keys.get(url, ()))
+
+    def keys_for_prefix(self, prefix: str) -> List[Tuple]:
+        keys = []  # type: List[Tuple]
+        urls = self._sorted_urls()
+        for index in range(bisect_left(urls, prefix), len(urls)):
+            url = urls[index]
+            if not url.startswith(prefix):
+                break
+            keys.extend(self._url_keys[url])
+        return keys
+
+    def keys_for_host(self, host: str) -> List[Tuple]:
+        keys = []  # type: List[Tuple]
+        for url in self._host_urls.get(host.lower(), ()):
+            keys.extend(self._url_keys[url])
+        return keys
+
+    def keys_for_tag(self, tag: str) -> List[Tuple]:
+        return list(self._tag_keys.get(tag, ()))
+
+
+def _host(url: str) -> str:
+    """Get host of canonical URL, without parsing it whole."""
+    netloc = url.partition("://")[2].partition("/")[0].rpartition("@")[2]
+    if "xn--" in netloc:
+        # internationalized host is decoded like yarl does
+        return URL(url).host or ""
+    if netloc.startswith("["):
+        return netloc[1:].partition("]")[0]
+    return netloc.partition(":")[0].lower()
@@ -0,0 +1,147 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Iterable, Optional, Tuple, Union
+from urllib.parse import unquote_plus
+
+from multidict import CIMultiDict
+from yarl import URL
+
+from .constants import DEFAULT_KEY_CACHE_SIZE
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "ws": 80, "wss": 443}
+
+
+class KeyBuilder:
+    """Build cache keys from request data.
+
+    Key is a tuple (http_method, canonical_url), so requests which differ
+    only in form of URL share the same cache entry:
+
+    - `params` are merged into URL query
+    - query arguments are sorted, ignored ones (e.g. tracking) are dropped
+    - scheme and host are lowercased, default port and fragment are dropped
+
+    Values of `key_headers` request headers (e.g. Authorization) are added to
+    the key, so different clients don't share responses.
+    If `digest` is True, canonical URL and headers are replaced with
+    16-byte digest to save memory.
+    """
+
+    def __init__(
+        self,
+        ignored_params: Iterable[str] = (),
+        key_headers: Iterable[str] = (),
+        digest: bool = False,
+    ):
+        """
+        Args:
+            ignored_params: names of query arguments which are not part of
+                the key, name ending with "*" is a prefix, e.g. "utm_*"
+            key_headers: names of request headers, which are part of the key
+            digest: store digest of URL and headers instead of them
+        """
+        ignored_params = tuple(ignored_params)
+        self.ignored_params = frozenset(
+            name for name in ignored_params if not name.endswith("*")
+        )
+        self.ignored_prefixes = tuple(
+            name[:-1] for name in ignored_params if name.endswith("*")
+        )
+        self.key_headers = tuple(key_headers)
+        self.digest = digest
+        self._canonical_url = lru_cache(maxsize=DEFAULT_KEY_CACHE_SIZE)(
+            self._build_canonical_url
+        )
+
+    def __call__(
+        self,
+        method: str,
+        url: Union[str, URL],
+        params: Any = None,
+        headers: Any = None,
+    ) -> Tuple:
+        canonical_url = self.canonical_url(url, params)
+        if not self.key_headers and not self.digest:
+            return (method, canonical_url)
+
+        key = (canonical_url,)  # type: Tuple
+        if self.key_headers:
+            headers = CIMultiDict(headers or {})
+            key += tuple(headers.get(name) for name in self.key_headers)
+        if self.digest:
+            return (method, _digest(key))
+        return (method,) + key
+
+    def canonical_url(self, url: Union[str, URL], params: Any = None) -> str:
+        """Get canonical form of URL with `params` merged into its query."""
+        if params:
+            url = URL(url).extend_query(params)
+        return self._canonical_url(str(url))
+
+    def _build_canonical_url(self, url: str) -> str:
+        parsed_url = URL(url)
+        if not parsed_url.is_absolute():
+            return str(parsed_url.with_fragment(None))
+        if parsed_url.explicit_port is not None and (
+            DEFAULT_PORTS.get(parsed_url.scheme) == parsed_url.port
+        ):
+            parsed_url = parsed_url.with_port(None)
+        # path and query are kept encoded, so e.g. "a%2Fb" and "a/b" differ
+        # and "?flag" is not turned into "?flag="
+        url = str(
+            parsed_url.with_path(parsed_url.raw_path or "/", encoded=True)
+            .with_query(None)
+            .with_fragment(None)
+        )
+        # sort by name only, order of repeated arguments may be meaningful
+        query = sorted(
+            (
+                (name, arg)
+                for name, arg in (
+                    (arg.partition("=")[0], arg)
+                    for arg in parsed_url.raw_query_string.split("&")
+                    if arg
+                )
+                if not self._is_ignored_param(unquote_plus(name))
+            ),
+            key=itemgetter(0),
+        )
+        if not query:
+            return url
+        return url + "?" + "&".join(arg for _, arg in query)
+
+    def _is_ignored_param(self, name: str) -> bool:
+        return name in self.ignored_params or (
+            bool(self.ignored_prefixes)
+            and name.startswith(self.ignored_prefixes)
+        )
+
+
+def _digest(key: Tuple[Optional[str], ...]) -> bytes:
+    hash_obj = hashlib.blake2b(digest_size=16)
+    for part in key:
+        if part is None:
+            hash_obj.update(b"\xff\xff\xff\xff")
+            continue
+        data = part.encode()
+        # prefix with length, so ("ab", "c") and ("a", "bc") differ
+        hash_obj.update(len(data).to_bytes(4, "big"))
+        hash_obj.update(data)
+    return hash_obj.digest()
@@ -0,0 +1,163 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List
+
+from .constants import DEFAULT_LATENCY_BUCKETS
+
+COUNTERS = (
+    "hits",  # fresh responses served from cache
+    "misses",  # responses of cacheable methods requested from origin
+    "stale_hits",  # expired responses served by stale-* directives
+    "coalesced",  # requests which waited for concurrent one for the same key
+    "revalidations",  # expired responses refreshed with 304 Not Modified
+    "refreshes_ahead",  # hot entries refreshed in background before expiry
+    "expirations",  # expired entries deleted from cache
+    "evictions",  # entries evicted from memory to free space
+    "invalidations",  # entries deleted by unsafe requests or invalidate_*
+    "bytes_stored",  # total size of entries added to cache
+)
+HISTOGRAMS = (
+    "fetch_latency",  # seconds spent on requests to origin
+    "hit_latency",  # seconds spent on serving fresh responses from cache
+)
+
+
+class Histogram:
+    """Histogram with fixed buckets, compatible with Prometheus ones.
+
+    `counts[i]` is amount of observed values which are less or equal to
+    `bounds[i]` and greater than previous bound, last one is for values
+    above all bounds.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "total")
+
+    def __init__(self, bounds: Iterable[float] = DEFAULT_LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float:
+        """Get upper bound of bucket containing `q` quantile, e.g. 0.99.
+
+        Returns 0 if there are no values, inf if it is above all bounds.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def as_dict(self) -> Dict:
+        """Get cumulative buckets, count and sum, as Prometheus does."""
+        buckets = {}
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            buckets[bound] = seen
+        return {"buckets": buckets, "count": self.count, "sum": self.total}
+
+    def reset(self) -> None:
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+
+class CacheMetrics:
+    """Counters and latency histograms of cache usage.
+
+    Updating them costs a dict update, so metrics are always on.
+    Callbacks added with `add_callback` are called with name and value
+    of every update, e.g. to export metrics to Prometheus or OpenTelemetry.
+    If metrics are updated from several threads, pass `thread_safe=True`.
+    """
+
+    def __init__(
+        self,
+        latency_buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS,
+        thread_safe: bool = False,
+    ):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.histograms = {
+            name: Histogram(latency_buckets) for name in HISTOGRAMS
+        }
+        self._callbacks = []  # type: List[Callable[[str, float], None]]
+        self._lock = threading.Lock() if thread_safe else None
+
+    def add_callback(self, callback: Callable[[str, float], None]) -> None:
+        """Call `callback(name, value)` on every update.
+
+        Value is increment for counters and observed value for histograms.
+        """
+        self._callbacks.append(callback)
+
+    def inc(self, name: str, value: int = 1) -> None:
+        if self._lock is None:
+            self.counters[name] += value
+        else:
+            with self._lock:
+                self.counters[name] += value
+        for callback in self._callbacks:
+            callback(name, value)
+
+    def observe(self, name: str, value: float) -> None:
+        if self._lock is None:
+            self.histograms[name].observe(value)
+        else:
+            with self._lock:
+                self.histograms[name].observe(value)
+        for callback in self._callbacks:
+            callback(name, value)
+
+    @property
+    def hit_ratio(self) -> float:
+        """Share of requests of cacheable methods served from cache.
+
+        Stale hits and requests coalesced with concurrent ones for the same
+        key count as served from cache, they didn't reach origin.
+        """
+        served = (
+            self.counters["hits"]
+            + self.counters["stale_hits"]
+            + self.counters["coalesced"]
+        )
+        total = served + self.counters["misses"]
+        return served / total if total else 0.0
+
+    def as_dict(self) -> Dict:
+        """Get snapshot of all counters and histograms."""
+        snapshot = dict(self.counters)  # type: Dict
+        for name, histogram in self.histograms.items():
+            snapshot[name] = histogram.as_dict()
+        return snapshot
+
+    def reset(self) -> None:
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        for histogram in self.histograms.values():
+            histogram.reset()
@@ -14,58 +14,492 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from .constants import DEFAULT_WAIT_TIMEOUT
+import asyncio
+import logging
+import math
+import time
+from collections.abc import Mapping
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, Optional, Set
+
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from .cache_control import EMPTY_CACHE_CONTROL, get_cache_control
+from .cached_response import BodyWriter, CachedResponse
+from .constants import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_WAIT_TIMEOUT,
+    SAFE_METHODS,
+    STALE_IF_ERROR_STATUSES,
+)
+from .exceptions import CacheException
+
+logger = logging.getLogger(__name__)
+
+# keep references to background tasks, so they are not garbage collected
+_background_tasks = set()  # type: Set[asyncio.Future]
 
 
 class RequestContextManager:
-    """Wrapper around _RequestContextManager from aiohttp."""
+    """Wrapper around _RequestContextManager from aiohttp.
+
+    With `stream=True` response of origin is returned as soon as its headers
+    are received, body is stored in cache while caller reads it with
+    `iter_chunked`, `read`, `text` or `json`.
+
+    Cache-Control directives of request are honored, keyword options take
+    precedence over them:
+
+    - `max_stale` - expired response is served, if it has been expired for
+      less than given amount of seconds, `math.inf` for any time
+    - `min_fresh` - response is served only if it stays fresh for at least
+      given amount of seconds
+    - `only_if_cached` - origin is not requested, 504 Gateway Timeout
+      response is returned if there is no suitable response in cache
+    - `no_cache` - response is always requested from origin
+    """
 
-    def __init__(self, client_session, cache, method, url, **params):
+    def __init__(
+        self,
+        client_session,
+        cache,
+        method,
+        url,
+        stream=False,
+        max_stale=None,
+        min_fresh=None,
+        only_if_cached=False,
+        no_cache=False,
+        **params,
+    ):
         self.cache = cache
         self.method = method
         self.url = url
+        self.stream = stream
         self.params = params
         self.client_session = client_session
         self.timeout = params.get("timeout", DEFAULT_WAIT_TIMEOUT)
-        # TODO: consider canonify url
-        self.key = (method, url)
+        # key of the resource, variant keys are built from it for responses
+        # which vary on request headers
+        self.primary_key = cache.key_builder(
+            method, url, params.get("params"), params.get("headers")
+        )
+        self.key = self.primary_key
+        self._request_headers = None  # type: Optional[CIMultiDict[str]]
+        cache_control = self._get_request_cache_control()
+        if max_stale is None:
+            max_stale = _parse_max_stale(cache_control.get("max-stale"))
+        self.max_stale = max_stale  # type: Optional[float]
+        if min_fresh is None:
+            min_fresh = cache_control.get("min-fresh")
+        self.min_fresh = min_fresh  # type: Optional[int]
+        self.only_if_cached = (
+            only_if_cached or "only-if-cached" in cache_control
+        )
+        self.no_cache = no_cache or "no-cache" in cache_control
+        # origin request, kept open while its body is streamed
+        self._origin = None  # type: Optional[AsyncExitStack]
+        self._origin_response = None
+        self._body_writer = None  # type: Optional[BodyWriter]
+        # streamed body was too big to be kept after it was read
+        self._body_dropped = False
+        # response is fetched in background, nothing is served by it
+        self._refreshing = False
         self.response = None
         self.headers = None
 
     async def __aenter__(self):
-        await self.cache.register_new_key(self.key, self.timeout)
-
-        if not self.cache.has_valid_entry(self.key):
-            async with self.client_session.request(
-                self.method, self.url, **self.params
-            ) as response:
-                await response.read()
-                self.response = response
-        else:
-            self.response = self.cache.get(self.key)
-
-        self.headers = self.response.headers
-        self.status = self.response.status
+        # fresh entry in memory is served right away, without awaiting;
+        # response is pinned, so it doesn't matter if entry expires or
+        # is evicted before body is read
+        response = self.get_cached()
+        if response is None:
+            response = await self._get_response()
+        self.response = response
+        self.headers = response.headers
+        self.status = response.status
         return self
 
+    def get_cached(self) -> Optional[CachedResponse]:
+        """Get fresh response from memory, if there is one."""
+        started_at = time.perf_counter()
+        self.key = self._get_variant_key()
+        response = self._lookup()
+        if response is not None:
+            self.cache.metrics.observe(
+                "hit_latency", time.perf_counter() - started_at
+            )
+            self._hit(response)
+        return response
+
+    async def _get_response(self):
+        """Get response from storage or origin."""
+        while True:
+            self.key = self._get_variant_key()
+            response = self._lookup()
+            if (
+                response is None
+                and not self.no_cache
+                and self.cache.storage is not None
+            ):
+                await self.cache.load_from_storage(self.key)
+                if self.key is self.primary_key and self.cache.get_vary(
+                    self.primary_key
+                ):
+                    # Vary is restored from storage, load the variant
+                    continue
+                response = self._lookup()
+            if response is not None:
+                self._hit(response)
+                return response
+            if self.only_if_cached:
+                return self._gateway_timeout()
+
+            response = self._get_stale_while_revalidate()
+            if response is not None:
+                return response
+
+            response = await self.cache.register_new_key(self.key, self.timeout)
+            if response is None:
+                # requests of other methods are never served from cache
+                if self.method in self.cache.cacheable_methods:
+                    self.cache.metrics.inc("misses")
+                return await self._fetch(self.stream)
+            if self.cache.matches_variant(response, self.request_headers):
+                return response
+            # concurrent request got variant for other request headers,
+            # Vary is known now, so look up the right variant
+
+    def _get_stale_while_revalidate(self) -> Optional[CachedResponse]:
+        """Get stale response and refresh it in background, if allowed."""
+        # stale-while-revalidate doesn't override limits of request
+        if (
+            self.no_cache
+            or self.max_stale is not None
+            or self.min_fresh is not None
+        ):
+            return None
+        response = self.cache.get_stale_while_revalidate(self.key)
+        if response is not None:
+            self.cache.metrics.inc("stale_hits")
+            if self.cache.try_register_new_key(self.key):
+                self._refresh_in_background()
+        return response
+
+    def _hit(self, response: CachedResponse) -> None:
+        """Count cache hit, keep entry hot in storage, refresh it ahead."""
+        self.cache.metrics.inc("hits")
+        if self.cache.storage is not None:
+            self.cache.touch(self.key)
+        if self.cache.refresh_ahead is not None:
+            self._refresh_ahead(response)
+
+    def _lookup(self) -> Optional[CachedResponse]:
+        """Get response from memory, which satisfies request directives."""
+        if self.no_cache:
+            return None
+        if self.max_stale is None and self.min_fresh is None:
+            return self.cache.get_fresh(self.key)
+        return self.cache.get_acceptable(
+            self.key, self.max_stale or 0, self.min_fresh or 0
+        )
+
+    def _gateway_timeout(self) -> CachedResponse:
+        """Get response for only-if-cached request missing in cache."""
+        logger.debug("No cached response for %s key", self.key)
+        return CachedResponse(
+            504, CIMultiDictProxy(CIMultiDict()), b"", str(self.url)
+        )
+
+    def _get_request_cache_control(self):
+        """Parse Cache-Control header of request, if there is one."""
+        session_headers = getattr(self.client_session, "headers", None)
+        if not self.params.get("headers") and not (
+            isinstance(session_headers, Mapping) and session_headers
+        ):
+            # do not merge headers on hot path, if there is nothing to merge
+            return EMPTY_CACHE_CONTROL
+        return get_cache_control(self.request_headers)
+
+    def _get_variant_key(self):
+        vary = self.cache.get_vary(self.primary_key)
+        if vary is None:
+            return self.primary_key
+        return self.cache.get_variant_key(
+            self.primary_key, vary, self.request_headers
+        )
+
+    @property
+    def request_headers(self) -> CIMultiDict:
+        """Request headers merged with default headers of the session."""
+        if self._request_headers is None:
+            headers = CIMultiDict()  # type: CIMultiDict[str]
+            session_headers = getattr(self.client_session, "headers", None)
+            if isinstance(session_headers, Mapping):
+                headers.update(session_headers)
+            headers.update(self.params.get("headers") or {})
+            self._request_headers = headers
+        return self._request_headers
+
+    def _refresh_ahead(self, response):
+        """Refresh hot response in background, if it expires soon."""
+        if self.cache.try_register_refresh_ahead(self.key, response):
+            self._refresh_in_background()
+
+    def _refresh_in_background(self):
+        """Fetch fresh response for the registered key in background."""
+        self._refreshing = True
+        task = asyncio.ensure_future(self._fetch())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_task_done)
+
+    async def _fetch(self, stream=False):
+        """Do the actual request and share its result with concurrent
+        requests waiting for the same key."""
+        started_at = time.perf_counter()
+        try:
+            cached_response = await self._request(stream)
+            self.cache.metrics.observe(
+                "fetch_latency", time.perf_counter() - started_at
+            )
+        except asyncio.CancelledError:
+            self.cache.release_new_key(self.key)
+            raise
+        except Exception as exc:
+            cached_response = self._get_stale_if_error()
+            if cached_response is None:
+                self.cache.release_new_key(self.key, exception=exc)
+                raise
+            logger.debug("Serve stale response for %s key: %r", self.key, exc)
+        if self._origin is not None:
+            # key is released once streamed body is read and stored
+            return cached_response
+        self.cache.release_new_key(self.key, cached_response)
+        return cached_response
+
+    async def _request(self, stream=False):
+        """Request origin and store its response in cache.
+
+        Expired entry with validators is revalidated with conditional request.
+        If origin fails, expired entry may be returned instead according to
+        stale-if-error directive.
+        If `stream` is True, response is returned without body, which is
+        read and stored later, see `iter_chunked`.
+        """
+        params = self.params
+        revalidation_headers = self._get_revalidation_headers()
+        if revalidation_headers is not None:
+            params = dict(params, headers=revalidation_headers)
+        async with AsyncExitStack() as stack:
+            response = await stack.enter_async_context(
+                self.client_session.request(self.method, self.url, **params)
+            )
+            if self.method not in SAFE_METHODS and response.status < 400:
+                self._invalidate(response)
+            if response.status == 304 and revalidation_headers is not None:
+                refreshed_response = self.cache.refresh(
+                    self.key, response.headers
+                )
+                if refreshed_response is not None:
+                    return refreshed_response
+                body = None
+            elif stream and (
+                response.status not in STALE_IF_ERROR_STATUSES
+                or self._get_stale_if_error(serve=False) is None
+            ):
+                self._origin = stack.pop_all()
+                self._origin_response = response
+                self._body_writer = BodyWriter(
+                    self.cache.spill_threshold,
+                    self.cache.spill_dir,
+                    self.cache.max_entry_bytes,
+                )
+                return CachedResponse.from_client_response(response, b"")
+            else:
+                body = await response.read()
+        if body is None:
+            # entry has gone while it was revalidated, request it again
+            return await self._request(stream)
+
+        cached_response = CachedResponse.from_client_response(response, body)
+        if cached_response.status in STALE_IF_ERROR_STATUSES:
+            stale_response = self._get_stale_if_error()
+            if stale_response is not None:
+                logger.debug("Serve stale response for %s key", self.key)
+                return stale_response
+        self._store(cached_response)
+        return cached_response
+
+    def _get_stale_if_error(
+        self, serve: bool = True
+    ) -> Optional[CachedResponse]:
+        """Get expired response which may be served instead of failed one.
+
+        Args:
+            serve: response is going to be served, count it as stale hit
+        """
+        # no-cache request must not get stored response in any case
+        if self.no_cache:
+            return None
+        response = self.cache.get_stale_if_error(self.key)
+        if response is not None and serve and not self._refreshing:
+            self.cache.metrics.inc("stale_hits")
+        return response
+
+    def _invalidate(self, response):
+        """Invalidate cached responses of resource changed by request.
+
+        Resources in Location and Content-Location headers are invalidated
+        too, if they have the same origin as request URL.
+        """
+        self.cache.invalidate_url(self.url, self.params.get("params"))
+        target = URL(str(self.url))
+        for name in ("Location", "Content-Location"):
+            location = response.headers.get(name)
+            if location is None:
+                continue
+            location_url = target.join(URL(location))
+            if target.is_absolute() and (
+                location_url.origin() == target.origin()
+            ):
+                self.cache.invalidate_url(location_url)
+
+    def _store(self, cached_response):
+        key = self.cache.register_vary(
+            self.primary_key, cached_response, self.request_headers
+        )
+        if key is not None:
+            self.cache.add(key, cached_response, cached_response.headers)
+
+    async def iter_chunked(self, n: int) -> AsyncIterator[bytes]:
+        """Iterate over response body by chunks of `n` bytes.
+
+        Streamed response is stored in cache once its body is read till
+        the end, otherwise it is dropped on exit. Body bigger than
+        `max_entry_bytes` is neither stored nor kept, so it can be
+        iterated only once.
+        """
+        writer = self._body_writer
+        if self._origin is None or writer is None:
+            self._check_body()
+            async for chunk in self.response.iter_chunked(n):
+                yield chunk
+            return
+        async for chunk in self._origin_response.content.iter_chunked(n):
+            await writer.write(chunk)
+            yield chunk
+        await self._finish_streaming(writer)
+
+    async def _finish_streaming(self, writer: BodyWriter):
+        body, path = await writer.close()
+        await self._close_origin()
+        if writer.exceeded:
+            logger.debug("Entry for %s key is too big to be cached", self.key)
+            self._body_dropped = True
+            # waiters repeat the request, body is not kept for them either
+            self.cache.release_new_key(self.key)
+            return
+        self.response.set_body(body, path, writer.length)
+        self._store(self.response)
+        self.cache.release_new_key(self.key, self.response)
+
+    def _check_body(self):
+        if self._body_dropped:
+            raise CacheException(
+                f"Body of {self.url} is bigger than max_entry_bytes, "
+                "it can be iterated only once"
+            )
+
+    async def _abort_streaming(self):
+        self._body_writer.abort()
+        await self._close_origin()
+        # one of waiters takes over the key and repeats the request
+        self.cache.release_new_key(self.key)
+
+    async def _close_origin(self):
+        origin = self._origin
+        self._origin = self._origin_response = self._body_writer = None
+        await origin.aclose()
+
+    async def _read_stream(self):
+        """Read the rest of streamed body, if there is one."""
+        self._check_body()
+        if self._origin is not None and self._body_writer is not None:
+            if not self._body_writer.length:
+                # whole body is read to memory anyway, keep it even if it
+                # is too big to be cached
+                self._body_writer.max_size = None
+            async for _ in self.iter_chunked(DEFAULT_CHUNK_SIZE):
+                pass
+
+    def _get_revalidation_headers(self):
+        """Get request headers with validators of expired entry.
+
+        Returns None if entry can't be revalidated.
+        """
+        request_headers = CIMultiDict(self.params.get("headers") or {})
+        if "If-None-Match" in request_headers or (
+            "If-Modified-Since" in request_headers
+        ):
+            # caller does conditional request on their own
+            return None
+        revalidation_headers = self.cache.get_revalidation_headers(self.key)
+        if not revalidation_headers:
+            return None
+        request_headers.update(revalidation_headers)
+        return request_headers
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._origin is not None:
+            # streamed body was not read till the end, it can't be cached
+            await self._abort_streaming()
         self.response = None
         self.headers = None
 
+    async def read(self):
+        """Return response body."""
+        await self._read_stream()
+        return await self.response.read()
+
     async def text(self):
         """Return response in plain str format."""
-        if not self.cache.has_valid_entry(self.key):
-            response = await self.response.text()
-            self.cache.add(self.key, self.response, self.headers)
-        else:
-            response = await self.cache.get(self.key).text()
-        return response
+        await self._read_stream()
+        size = self.response.size
+        text = await self.response.text(memoize=self.cache.memoize_text)
+        self._resize(size)
+        return text
 
     async def json(self):
         """Return response in json format."""
-        if not self.cache.has_valid_entry(self.key):
-            response = await self.response.json()
-            self.cache.add(self.key, self.response, self.headers)
-        else:
-            response = await self.cache.get(self.key).json()
-        return response
+        await self._read_stream()
+        size = self.response.size
+        value = await self.response.json(
+            loads=self.cache.json_loads, memoize=self.cache.memoize_json
+        )
+        self._resize(size)
+        return value
+
+    def _resize(self, previous_size: int) -> None:
+        """Count memoized text or json in size of cached response."""
+        if self.response.size != previous_size:
+            self.cache.resize(self.key, self.response, previous_size)
+
+
+def _parse_max_stale(value) -> Optional[float]:
+    """Get seconds of max-stale directive, which may have no value."""
+    if value is None:
+        return None
+    if value is True:
+        return math.inf
+    try:
+        return int(value)
+    except ValueError:
+        logger.debug('Failed to parse "max-stale" directive.')
+        return None
+
+
+def _background_task_done(task: asyncio.Future) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.debug("Background refresh failed: %r", task.exception())
@@ -0,0 +1,292 @@
+"""
+Copyright 2021 - Present Serhii Buniak
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from .cache import AsyncCache
+from .cached_response import CachedResponse
+from .constants import (
+    DEFAULT_MAX_SPILL_BYTES,
+    DEFAULT_SHARDS,
+    DEFAULT_WAIT_TIMEOUT,
+)
+from .eviction import EvictionPolicy
+from .exceptions import TimeoutException
+from .keys import KeyBuilder
+from .metrics import CacheMetrics
+
+# settings which are the same for all shards, read by request context manager
+SHARED_SETTINGS = (
+    "cacheable_methods",
+    "refresh_ahead",
+    "spill_threshold",
+    "spill_dir",
+    "max_entry_bytes",
+    "memoize_text",
+    "memoize_json",
+    "json_loads",
+)
+
+
+class CacheShard(AsyncCache):
+    """AsyncCache which is used from several threads under its lock.
+
+    Registered keys are resolved with concurrent.futures.Future, so
+    requests from different event loops can wait for each other.
+    """
+
+    def __init__(self, config: Dict = None):
+        super().__init__(config)
+        self.lock = threading.RLock()
+
+    def _create_future(self) -> Any:
+        return concurrent.futures.Future()
+
+    async def register_new_key(
+        self, key: Tuple[str, str], timeout=DEFAULT_WAIT_TIMEOUT
+    ) -> Optional[Any]:
+        if key[0] not in self.cacheable_methods:
+            return None
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self.lock:
+                future = self._in_flight.get(key)
+                if future is None:
+                    self.try_register_new_key(key)
+                    return None
+            try:
+                value = await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(future)),
+                    deadline - loop.time(),
+                )
+            except asyncio.TimeoutError:
+                raise TimeoutException(f"Timeout exceeded for {key}")
+            if value is not None:
+                self.metrics.inc("coalesced")
+                return value
+            # request was cancelled without result, try to take it over
+
+
+class ShardedAsyncCache:
+    """Thread-safe cache shared by event loops running in several threads.
+
+    Keys are hashed to `shards` shards, each one has its own lock, eviction
+    order and part of `capacity` and `max_bytes`, so threads rarely wait
+    for each other. Concurrent requests for the same key are coalesced
+    across event loops. Accepts the same config as AsyncCache, except
+    persistent storage, which is not supported, and instance of eviction
+    policy: pass its class or factory, so every shard gets its own one.
+    """
+
+    storage = None
+
+    def __init__(self, config: Dict = None, shards: int = DEFAULT_SHARDS):
+        config = dict(config or {})
+        if isinstance(config.get("eviction_policy"), EvictionPolicy):
+            # policy of one shard would pick victims from other ones
+            raise ValueError(
+                "Eviction policy instance can't be shared by shards, "
+                "pass its name, class or factory instead"
+            )
+        config.setdefault("metrics", CacheMetrics(thread_safe=True))
+        config.setdefault("key_builder", KeyBuilder())
+        config.setdefault("max_spill_bytes", DEFAULT_MAX_SPILL_BYTES)
+        for name in (
+            "capacity",
+            "max_bytes",
+            "max_spill_bytes",
+            "max_background_refreshes",
+        ):
+            if config.get(name) is not None:
+                # round up, so small caches are not left without space
+                config[name] = -(-config[name] // shards)
+        self.shards = [CacheShard(config) for _ in range(shards)]
+        self.metrics = config["metrics"]  # type: CacheMetrics
+        self.key_builder = config["key_builder"]  # type: KeyBuilder
+        for name in SHARED_SETTINGS:
+            setattr(self, name, getattr(self.shards[0], name))
+
+    def _shard(self, key: Tuple) -> CacheShard:
+        # variants are stored in the shard of their primary key
+        if key and isinstance(key[-1], tuple):
+            key = key[:-1]
+        return self.shards[hash(key) % len(self.shards)]
+
+    def __len__(self) -> int:
+        return sum(len(shard.cache) for shard in self.shards)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(shard.total_bytes for shard in self.shards)
+
+    @property
+    def raw_bytes(self) -> int:
+        return sum(shard.raw_bytes for shard in self.shards)
+
+    @property
+    def spilled_bytes(self) -> int:
+        return sum(shard.spilled_bytes for shard in self.shards)
+
+    def get_vary(self, key: Tuple) -> Optional[Tuple[str, ...]]:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.get_vary(key)
+
+    def get_variant_key(
+        self, key: Tuple, vary: Tuple[str, ...], request_headers: Any
+    ) -> Tuple:
+        return self.shards[0].get_variant_key(key, vary, request_headers)
+
+    def register_vary(
+        self, key: Tuple, response: CachedResponse, request_headers: Any
+    ) -> Optional[Tuple]:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.register_vary(key, response, request_headers)
+
+    def matches_variant(
+        self, response: CachedResponse, request_headers: Any
+    ) -> bool:
+        return self.shards[0].matches_variant(response, request_headers)
+
+    def has_valid_entry(self, key: Tuple) -> bool:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.has_valid_entry(key)
+
+    def get_fresh(self, key: Tuple) -> Optional[CachedResponse]:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.get_fresh(key)
+
+    def get_acceptable(
+        self, key: Tuple, max_stale: float = 0, min_fresh: int = 0
+    ) -> Optional[CachedResponse]:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.get_acceptable(key, max_stale, min_fresh)
+
+    def get_stale_while_revalidate(
+        self, key: Tuple
+    ) -> Optional[CachedResponse]:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.get_stale_while_revalidate(key)
+
+    def get_stale_if_error(self, key: Tuple) -> Optional[CachedResponse]:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.get_stale_if_error(key)
+
+    def get_revalidation_headers(self, key: Tuple) -> Dict[str, str]:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.get_revalidation_headers(key)
+
+    def refresh(self, key: Tuple, headers: Any) -> Optional[CachedResponse]:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.refresh(key, headers)
+
+    def add(self, key: Tuple, value: CachedResponse, headers: Any) -> None:
+        shard = self._shard(key)
+        with shard.lock:
+            shard.add(key, value, headers)
+
+    def resize(
+        self, key: Tuple, entry: CachedResponse, previous_size: int
+    ) -> None:
+        shard = self._shard(key)
+        with shard.lock:
+            shard.resize(key, entry, previous_size)
+
+    def get(self, key: Tuple) -> CachedResponse:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.get(key)
+
+    def delete(self, key: Tuple) -> None:
+        shard = self._shard(key)
+        with shard.lock:
+            shard.delete(key)
+
+    def invalidate_url(self, url: str, params: Any = None) -> int:
+        return self._invalidate("invalidate_url", url, params)
+
+    def invalidate_prefix(self, prefix: str) -> int:
+        return self._invalidate("invalidate_prefix", prefix)
+
+    def invalidate_host(self, host: str) -> int:
+        return self._invalidate("invalidate_host", host)
+
+    def invalidate_tag(self, tag: str) -> int:
+        return self._invalidate("invalidate_tag", tag)
+
+    def _invalidate(self, method: str, *args) -> int:
+        # entries of the same URL are spread over shards
+        invalidated = 0
+        for shard in self.shards:
+            with shard.lock:
+                invalidated += getattr(shard, method)(*args)
+        return invalidated
+
+    def clear_cache(self) -> None:
+        for shard in self.shards:
+            with shard.lock:
+                shard.clear_cache()
+
+    def purge_expired(self, limit: Optional[int] = None) -> int:
+        """Delete expired entries from all shards, at most `limit` of them."""
+        purged = 0
+        for shard in self.shards:
+            with shard.lock:
+                purged += shard.purge_expired(
+                    None if limit is None else limit - purged
+                )
+            if limit is not None and purged >= limit:
+                break
+        return purged
+
+    def try_register_new_key(self, key: Tuple) -> bool:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.try_register_new_key(key)
+
+    def try_register_refresh_ahead(
+        self, key: Tuple, entry: CachedResponse
+    ) -> bool:
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.try_register_refresh_ahead(key, entry)
+
+    async def register_new_key(
+        self, key: Tuple, timeout=DEFAULT_WAIT_TIMEOUT
+    ) -> Optional[Any]:
+        return await self._shard(key).register_new_key(key, timeout)
+
+    def release_new_key(
+        self,
+        key: Tuple,
+        value: Any = None,
+        exception: Optional[BaseException] = None,
+    ) -> None:
+        shard = self._shard(key)
+        with shard.lock:
+            shard.release_new_key(key, value, exception)
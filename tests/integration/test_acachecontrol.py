@@ -14,9 +14,10 @@ class CacheObserver(AsyncCache):
         super().add(key, value, headers)
         self.add_calls.append((key, value, headers))
 
-    def get(self, key):
-        value = self.cache.get(key)["value"]
-        self.get_calls.append(key)
+    def get_fresh(self, key):
+        value = super().get_fresh(key)
+        if value is not None:
+            self.get_calls.append(key)
         return value
 
 
@@ -66,7 +67,9 @@ async def test_hit_cache():
             assert resp.status == 200
             assert "Example Domain" in resp_text
 
-        assert ("GET", "http://example.com") in cache_observer.get_calls
+        # response varies on Accept-Encoding, which was not set by caller
+        variant_key = ("GET", "http://example.com/", (None,))
+        assert variant_key in cache_observer.get_calls
 
 
 @pytest.mark.vcr()
@@ -94,9 +97,9 @@ async def test_no_hit_cache():
         assert len(cache_observer.get_calls) == 0
 
 
-@pytest.mark.vcr()
+@pytest.mark.vcr(allow_playback_repeats=True)
 @pytest.mark.asyncio
-async def test_hit_cache_json():
+async def test_hit_cache_json(vcr_cassette):
     # response from given url contains 'no-cache' directive
     url = "https://my-json-server.typicode.com/typicode/demo/posts"
     expected_json = [
@@ -107,8 +110,6 @@ async def test_hit_cache_json():
     cache_observer = CacheObserver()
     async with AsyncCacheControl(cache=cache_observer) as cached_sess:
         async with cached_sess.get(url) as resp:
-            # clean headers to force cache response
-            resp.headers = {}
             resp_json = await resp.json()
             assert resp.status == 200
             assert resp_json == expected_json
@@ -118,4 +119,7 @@ async def test_hit_cache_json():
             assert resp.status == 200
             assert resp_json == expected_json
 
-        assert ("GET", url) in cache_observer.get_calls
+        # stored response is not served without revalidation, it has no
+        # validators, so it is requested again
+        assert cache_observer.get_calls == []
+        assert vcr_cassette.play_count == 2
@@ -1,4 +1,10 @@
+import asyncio
+import contextlib
+
+import aiohttp
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
 from acachecontrol import AsyncCache, AsyncCacheControl
 
@@ -142,3 +148,155 @@ async def test_clear_cashe(mocker):
     ) as cached_sess:
         cached_sess.clear_cache()
         mock_cache.clear_cache.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_sweep_expired_entries(mocker):
+    """Verify AsyncCacheControl purges expired entries in background."""
+    mock_cache = mocker.Mock()
+    mock_cache.purge_expired.return_value = 0
+    async with AsyncCacheControl(
+        cache=mock_cache, sweep_interval=0.01, sweep_batch_size=10
+    ) as cached_sess:
+        await asyncio.sleep(0.05)
+        sweeper = cached_sess._sweeper
+        mock_cache.purge_expired.assert_called_with(10)
+    await asyncio.sleep(0)
+    assert sweeper.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_session():
+    """Verify session is created lazily and injected one is not closed."""
+    first, second = AsyncCacheControl(), AsyncCacheControl()
+    assert first.cache is not second.cache
+
+    async with AsyncCacheControl(
+        connector_params={"limit_per_host": 5}
+    ) as cached_sess:
+        assert cached_sess._async_client_session is None
+        session = cached_sess.session
+        assert session.connector.limit_per_host == 5
+    assert session.closed
+
+    async with aiohttp.ClientSession() as session:
+        async with AsyncCacheControl(session=session) as cached_sess:
+            assert cached_sess.session is session
+        assert not session.closed
+
+        connector = aiohttp.TCPConnector()
+        async with AsyncCacheControl(connector=connector) as cached_sess:
+            assert cached_sess.session.connector is connector
+        assert not connector.closed
+        await connector.close()
+
+
+class UrlSession:
+    """Client session which responds by URL, tracks concurrent requests."""
+
+    def __init__(self, mocker):
+        self.mocker = mocker
+        self.requests = []
+        self.active = self.max_active = 0
+
+    def request(self, method, url, **params):
+        self.requests.append(url)
+        return self._respond(url)
+
+    @contextlib.asynccontextmanager
+    async def _respond(self, url):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.01)
+            if url.endswith("/error"):
+                raise ConnectionError("origin is down")
+            response = self.mocker.Mock(
+                status=200, headers={"Cache-Control": "max-age=60"}, url=url
+            )
+            response.read = self.mocker.AsyncMock(return_value=url.encode())
+            yield response
+        finally:
+            self.active -= 1
+
+
+@pytest.mark.asyncio
+async def test_fetch_many(mocker):
+    """Verify AsyncCacheControl.fetch_many dedups and limits requests."""
+    session = UrlSession(mocker)
+    cached_sess = AsyncCacheControl(session=session)
+    async with cached_sess.get("http://a.com/cached"):
+        pass
+    urls = [f"http://a.com/{index}" for index in range(6)]
+    urls += ["http://a.com/cached", "http://A.com/0", "http://a.com/error"]
+
+    results = []
+    async for url, response in cached_sess.fetch_many(
+        urls, concurrency=4, limit_per_host=2, return_exceptions=True
+    ):
+        results.append((url, response))
+
+    # fresh response is yielded first, without request
+    assert results[0][0] == "http://a.com/cached"
+    assert len(results) == len(urls)
+    assert session.requests.count("http://a.com/0") == 1
+    assert session.max_active == 2
+    responses = dict(results)
+    assert responses["http://A.com/0"] is responses["http://a.com/0"]
+    assert await responses["http://a.com/5"].text() == "http://a.com/5"
+    assert isinstance(responses["http://a.com/error"], ConnectionError)
+
+    with pytest.raises(ConnectionError):
+        await cached_sess.get_many(["http://a.com/error", "http://b.com/"])
+    responses = await cached_sess.get_many(["http://a.com/1"])
+    assert responses["http://a.com/1"].status == 200
+
+
+@pytest.mark.asyncio
+async def test_fetch_many_hosts(mocker):
+    """Verify busy host doesn't hold back requests to other hosts."""
+    session = UrlSession(mocker)
+    cached_sess = AsyncCacheControl(session=session)
+    urls = [f"http://a.com/{index}" for index in range(20)]
+    urls += [f"http://b.com/{index}" for index in range(5)]
+
+    results = [
+        url
+        async for url, _ in cached_sess.fetch_many(
+            urls, concurrency=10, limit_per_host=2
+        )
+    ]
+    assert len(results) == len(urls)
+    assert session.max_active == 4
+    # b.com is requested together with the first requests to a.com
+    assert {url[:12] for url in results[:4]} == {"http://a.com", "http://b.com"}
+
+    with pytest.raises(ValueError):
+        await cached_sess.get_many(urls, concurrency=0)
+    with pytest.raises(ValueError):
+        await cached_sess.get_many(urls, limit_per_host=0)
+
+
+@pytest.mark.asyncio
+async def test_hit_cache_json():
+    expected_json = [{"id": 1, "title": "Post 1"}]
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        return web.json_response(
+            expected_json, headers={"Cache-Control": "max-age=60"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/posts", handler)
+    async with TestServer(app) as server:
+        url = str(server.make_url("/posts"))
+        async with AsyncCacheControl(cache=AsyncCache()) as cached_sess:
+            for _ in range(2):
+                async with cached_sess.get(url) as resp:
+                    assert resp.status == 200
+                    assert await resp.json() == expected_json
+
+    # the second response is served from cache
+    assert len(requests) == 1
@@ -0,0 +1,341 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from acachecontrol.backends import (
+    AsyncCacheBackend,
+    ExecutorBackend,
+    SQLiteBackend,
+    as_async_backend,
+)
+from acachecontrol.cache import AsyncCache
+from acachecontrol.cached_response import CachedResponse
+from acachecontrol.compression import ZlibCodec
+
+
+def make_entry(body=b"test_response"):
+    entry = CachedResponse(
+        200,
+        [("Content-Type", "text/plain"), ("Set-Cookie", "a=1")],
+        body,
+        "http://example.com",
+        created_at=time.time(),
+        max_age=60,
+    )
+    entry.stale_if_error = 30
+    return entry
+
+
+def test_sqlite_backend(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.db"))
+    key = ("GET", "http://example.com")
+    entry = make_entry()
+    backend.set(key, entry)
+    assert len(backend) == 1
+    assert backend.total_bytes == entry.size
+
+    stored_entry = backend.get(key)
+    assert stored_entry.status == 200
+    assert stored_entry.body == b"test_response"
+    assert stored_entry.url == "http://example.com"
+    assert list(stored_entry.headers.items()) == list(entry.headers.items())
+    assert stored_entry.created_at == entry.created_at
+    assert stored_entry.max_age == 60
+    assert stored_entry.stale_if_error == 30
+    backend.close()
+
+    # data survives reopening
+    backend = SQLiteBackend(str(tmp_path / "cache.db"))
+    assert backend.total_bytes == entry.size
+    assert backend.most_recently_used(10)[0][0] == key
+    backend.delete(key)
+    assert backend.get(key) is None
+    assert len(backend) == 0
+    assert backend.total_bytes == 0
+
+
+def test_sqlite_backend_stores_compressed_body(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.db"))
+    body = b"test_response" * 100
+    compressed_entry = make_entry(body)
+    assert compressed_entry.compress(ZlibCodec())
+    spill_path = tmp_path / "spill"
+    spill_path.write_bytes(body)
+    spilled_entry = make_entry()
+    spilled_entry.set_body(b"", str(spill_path), len(body))
+
+    backend.set(("GET", "compressed"), compressed_entry)
+    backend.set(("GET", "spilled"), spilled_entry)
+    # size matches the stored blobs
+    assert backend.total_bytes == (
+        compressed_entry.size + spilled_entry.size + len(body)
+    )
+
+    stored_entry = backend.get(("GET", "compressed"))
+    assert stored_entry.codec.name == "zlib"
+    assert stored_entry.size == compressed_entry.size
+    assert stored_entry.raw_size == compressed_entry.raw_size
+    assert stored_entry.body == body
+    stored_entry = backend.get(("GET", "spilled"))
+    assert stored_entry.codec is None
+    # spilled body is restored spilled to its own file
+    assert stored_entry.spilled_size == len(body)
+    assert stored_entry.spill_path != str(spill_path)
+    assert stored_entry.body == body
+    backend.close()
+
+
+def test_sqlite_backend_removes_body_files(tmp_path):
+    bodies_dir = tmp_path / "bodies"
+    backend = SQLiteBackend(
+        str(tmp_path / "cache.db"), max_entries=2, bodies_dir=str(bodies_dir)
+    )
+    for index in range(4):
+        spill_path = tmp_path / f"spill_{index}"
+        spill_path.write_bytes(b"test_response")
+        entry = make_entry()
+        entry.set_body(b"", str(spill_path), 13)
+        backend.set(("GET", f"url_{index}"), entry)
+    # spill files of stored entries stay with them
+    assert len(list(bodies_dir.iterdir())) == 2
+
+    backend.delete(("GET", "url_2"))
+    assert len(list(bodies_dir.iterdir())) == 1
+    backend.clear()
+    assert list(bodies_dir.iterdir()) == []
+    backend.close()
+
+
+def test_sqlite_backend_migrates_schema(tmp_path):
+    path = str(tmp_path / "cache.db")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE entries (key TEXT PRIMARY KEY, status INTEGER NOT NULL, "
+        "headers TEXT NOT NULL, body BLOB NOT NULL, url TEXT NOT NULL, "
+        "created_at REAL NOT NULL, max_age REAL NOT NULL, "
+        "stale_while_revalidate REAL NOT NULL, stale_if_error REAL NOT NULL, "
+        "size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    connection.execute(
+        "INSERT INTO entries VALUES "
+        "(?, 200, '[]', X'6F6B', '', 0, 60, 0, 0, 2, 1)",
+        (repr(("GET", "old")),),
+    )
+    connection.commit()
+    connection.close()
+
+    backend = SQLiteBackend(path)
+    assert backend.get(("GET", "old")).body == b"ok"
+    backend.set(("GET", "new"), make_entry())
+    assert len(backend) == 2
+    backend.close()
+
+
+def test_sqlite_backend_limits(tmp_path):
+    entry_size = make_entry().size
+    backend = SQLiteBackend(
+        str(tmp_path / "cache.db"), max_entries=3, max_bytes=2 * entry_size
+    )
+    for index in range(3):
+        backend.set(("GET", f"url_{index}"), make_entry())
+    assert len(backend) == 2
+    assert backend.get(("GET", "url_0")) is None
+
+    backend.touch(("GET", "url_1"))
+    backend.set(("GET", "url_3"), make_entry())
+    assert backend.get(("GET", "url_1")) is not None
+    assert backend.get(("GET", "url_2")) is None
+
+    backend.clear()
+    assert len(backend) == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_with_storage(tmp_path):
+    path = str(tmp_path / "cache.db")
+    acache = AsyncCache(config={"capacity": 1}, storage=SQLiteBackend(path))
+    headers = {"Cache-Control": "max-age=60"}
+    acache.add(("GET", "url_1"), make_entry(b"first"), headers)
+    acache.add(("GET", "url_2"), make_entry(b"second"), headers)
+
+    # evicted from memory, but still in storage
+    assert ("GET", "url_1") not in acache.cache
+    entry = await acache.load_from_storage(("GET", "url_1"))
+    assert await entry.read() == b"first"
+    assert acache.has_valid_entry(("GET", "url_1"))
+    await acache.close()
+
+    # warm start after restart
+    acache = AsyncCache(config={"capacity": 10}, storage=SQLiteBackend(path))
+    assert await acache.warm_up() == 2
+    assert acache.has_valid_entry(("GET", "url_2"))
+
+    acache.delete(("GET", "url_2"))
+    await acache.close()
+    assert SQLiteBackend(path).get(("GET", "url_2")) is None
+
+
+@pytest.mark.asyncio
+async def test_cache_with_storage_restores_vary(tmp_path):
+    path = str(tmp_path / "cache.db")
+    acache = AsyncCache(storage=SQLiteBackend(path))
+    key = ("GET", "url")
+    for language in ("en", "uk"):
+        entry = make_entry(language.encode())
+        entry.update_headers(
+            {"Cache-Control": "max-age=60", "Vary": "Accept-Language"}
+        )
+        request_headers = {"Accept-Language": language}
+        variant_key = acache.register_vary(key, entry, request_headers)
+        acache.add(variant_key, entry, entry.headers)
+    await acache.close()
+
+    # variants are found by request headers after restart
+    acache = AsyncCache(storage=SQLiteBackend(path))
+    assert await acache.warm_up() == 2
+    assert acache.get_vary(key) == ("accept-language",)
+    variant_key = acache.get_variant_key(
+        key, ("accept-language",), {"Accept-Language": "uk"}
+    )
+    assert acache.get_fresh(variant_key).body == b"uk"
+    assert acache.get_fresh(variant_key).variant == ("uk",)
+    await acache.close()
+
+    acache = AsyncCache(storage=SQLiteBackend(path))
+    entry = await acache.load_from_storage(key + (("en",),))
+    assert entry.body == b"en"
+    assert acache.get_vary(key) == ("accept-language",)
+    # variant is tracked, so it is dropped together with its primary key
+    acache.invalidate_url("url")
+    assert len(acache.cache) == 0
+    await acache.close()
+
+
+@pytest.mark.asyncio
+async def test_cache_with_storage_stores_vary(tmp_path):
+    path = str(tmp_path / "cache.db")
+    acache = AsyncCache(storage=SQLiteBackend(path))
+    key = ("GET", "url")
+    entry = make_entry(b"en")
+    entry.update_headers(
+        {"Cache-Control": "max-age=60", "Vary": "Accept-Language"}
+    )
+    variant_key = acache.register_vary(key, entry, {"Accept-Language": "en"})
+    acache.add(variant_key, entry, entry.headers)
+    await acache.close()
+
+    # Vary of primary key is known after restart without warming up
+    acache = AsyncCache(storage=SQLiteBackend(path))
+    assert await acache.load_from_storage(key) is None
+    assert acache.get_vary(key) == ("accept-language",)
+    entry = await acache.load_from_storage(variant_key)
+    assert entry.body == b"en"
+
+    # Vary marker is dropped with variants, when responses stop varying
+    entry = make_entry(b"any")
+    entry.update_headers({"Cache-Control": "max-age=60"})
+    assert acache.register_vary(key, entry, {}) == key
+    await acache.close()
+    backend = SQLiteBackend(path)
+    assert backend.get(key) is None
+    assert backend.get(variant_key) is None
+    backend.close()
+
+
+class DictBackend:
+    """Blocking storage without bulk methods."""
+
+    def __init__(self):
+        self.storage = {}
+        self.threads = set()
+
+    def get(self, key):
+        self.threads.add(threading.get_ident())
+        return self.storage.get(key)
+
+    def set(self, key, entry):
+        self.threads.add(threading.get_ident())
+        self.storage[key] = entry
+
+    def delete(self, key):
+        self.storage.pop(key, None)
+
+    def touch(self, key):
+        pass
+
+    def clear(self):
+        self.storage.clear()
+
+
+class RecordingBackend(AsyncCacheBackend):
+    """Asynchronous storage which records bulk calls."""
+
+    def __init__(self):
+        self.storage = {}
+        self.calls = []
+
+    async def get(self, key):
+        return self.storage.get(key)
+
+    async def set_many(self, items):
+        items = list(items)
+        self.calls.append(("set_many", [key for key, _ in items]))
+        self.storage.update(items)
+
+    async def delete_many(self, keys):
+        keys = list(keys)
+        self.calls.append(("delete_many", keys))
+        for key in keys:
+            self.storage.pop(key, None)
+
+    async def touch_many(self, keys):
+        self.calls.append(("touch_many", list(keys)))
+
+
+@pytest.mark.asyncio
+async def test_executor_backend():
+    sync_backend = DictBackend()
+    backend = ExecutorBackend(sync_backend)
+    entry = make_entry()
+    await backend.set_many([("key_1", entry), ("key_2", entry)])
+    assert await backend.get("key_1") is entry
+    assert await backend.get_many(["key_1", "key_3"]) == {"key_1": entry}
+    await backend.delete_many(["key_1"])
+    assert await backend.get("key_1") is None
+    assert await backend.most_recently_used(10) == []
+    await backend.close()
+    # blocking calls are done outside of event loop thread
+    assert sync_backend.threads
+    assert threading.get_ident() not in sync_backend.threads
+
+    assert isinstance(as_async_backend(DictBackend()), ExecutorBackend)
+    async_backend = RecordingBackend()
+    assert as_async_backend(async_backend) is async_backend
+
+
+@pytest.mark.asyncio
+async def test_cache_storage_updates_in_bulk():
+    storage = RecordingBackend()
+    acache = AsyncCache(storage=storage)
+    headers = {"Cache-Control": "max-age=60"}
+    acache.add(("GET", "url_1"), make_entry(), headers)
+    acache.add(("GET", "url_2"), make_entry(), headers)
+    acache.touch(("GET", "url_2"))
+    acache.touch(("GET", "url_2"))
+    acache.delete(("GET", "url_1"))
+    # pending updates are visible before they reach storage
+    acache.cache.clear()
+    acache.eviction_policy.clear()
+    assert await acache.load_from_storage(("GET", "url_2")) is not None
+    assert await acache.load_from_storage(("GET", "url_1")) is None
+    await acache.close()
+
+    assert storage.calls == [
+        ("set_many", [("GET", "url_1"), ("GET", "url_2")]),
+        ("touch_many", [("GET", "url_2")]),
+        ("delete_many", [("GET", "url_1")]),
+    ]
+    assert list(storage.storage) == [("GET", "url_2")]
+    assert acache._unsaved == {}
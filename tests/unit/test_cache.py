@@ -1,6 +1,13 @@
+import asyncio
 import time
 
+import pytest
+
+from acachecontrol import invalidation
 from acachecontrol.cache import AsyncCache
+from acachecontrol.cached_response import CachedResponse
+from acachecontrol.exceptions import TimeoutException
+from acachecontrol.keys import KeyBuilder
 
 
 def test_add_happy_path(monkeypatch):
@@ -9,7 +16,7 @@ def test_add_happy_path(monkeypatch):
     acache = AsyncCache()
     acache.add(
         key=("GET", "test_url"),
-        value="test_response",
+        value=CachedResponse(200, {}, b"test_response"),
         headers={
             "Cache-Control": "max-age=604800",
             "Content-Type": "text/html; charset=UTF-8",
@@ -17,16 +24,16 @@ def test_add_happy_path(monkeypatch):
     )
     cache_key = ("GET", "test_url")
     assert cache_key in acache.cache
-    assert acache.cache[cache_key]["created_at"] == current_timestamp
-    assert acache.cache[cache_key]["max-age"] == 604800
-    assert acache.cache[cache_key]["value"] == "test_response"
+    assert acache.cache[cache_key].created_at == current_timestamp
+    assert acache.cache[cache_key].max_age == 604800
+    assert acache.cache[cache_key]._body == b"test_response"
 
 
 def test_non_cacheable_method():
     acache = AsyncCache()
     acache.add(
         key=("test_method", "test_url"),
-        value="test_response",
+        value=CachedResponse(200, {}, b"test_response"),
         headers={
             "Cache-Control": "max-age=604800",
             "Content-Type": "text/html; charset=UTF-8",
@@ -39,7 +46,7 @@ def test_add_no_cache():
     acache = AsyncCache()
     acache.add(
         key=("GET", "test_url"),
-        value="test_response",
+        value=CachedResponse(200, {}, b"test_response"),
         headers={
             "Cache-Control": "max-age=604800,no-cache",
             "Content-Type": "text/html; charset=UTF-8",
@@ -49,7 +56,7 @@ def test_add_no_cache():
 
     acache.add(
         key=("GET", "test_url"),
-        value="test_response",
+        value=CachedResponse(200, {}, b"test_response"),
         headers={
             "Cache-Control": "max-age=604800,no-store",
             "Content-Type": "text/html; charset=UTF-8",
@@ -67,7 +74,7 @@ def test_cache_capacity(monkeypatch):
         monkeypatch.setattr(time, "time", lambda: current_timestamp)
         acache.add(
             key=("GET", url),
-            value="test_response",
+            value=CachedResponse(200, {}, b"test_response"),
             headers={
                 "Cache-Control": "max-age=604800",
                 "Content-Type": "text/html; charset=UTF-8",
@@ -99,7 +106,26 @@ def test_parse_cache_control_header():
         "cache-control": "public, max-age=3600",
         "content-type": "application/json",
     }
-    expected = {"max-age": 3600}
+    expected = {"public": True, "max-age": 3600}
+    assert AsyncCache.parse_cache_control_header(headers) == expected
+
+    # check stale-* extensions
+    headers = {
+        "cache-control": "max-age=60, stale-while-revalidate=30, "
+        "stale-if-error=600",
+    }
+    expected = {
+        "max-age": 60,
+        "stale-while-revalidate": 30,
+        "stale-if-error": 600,
+    }
+    assert AsyncCache.parse_cache_control_header(headers) == expected
+
+    # check qualified and quoted directives
+    headers = {
+        "cache-control": 'private="Set-Cookie", s-maxage="30", immutable',
+    }
+    expected = {"private": True, "s-maxage": 30, "immutable": True}
     assert AsyncCache.parse_cache_control_header(headers) == expected
 
     # check if max-age is not a number
@@ -114,3 +140,447 @@ def test_parse_cache_control_header():
     headers = {"content-type": "application/json"}
     expected = {}
     assert AsyncCache.parse_cache_control_header(headers) == expected
+
+
+@pytest.mark.asyncio
+async def test_register_new_key_coalesces_requests():
+    acache = AsyncCache()
+    key = ("GET", "test_url")
+    assert await acache.register_new_key(key) is None
+
+    waiters = [
+        asyncio.ensure_future(acache.register_new_key(key)) for _ in range(3)
+    ]
+    await asyncio.sleep(0)
+    assert not any(waiter.done() for waiter in waiters)
+
+    acache.release_new_key(key, "test_response")
+    assert await asyncio.gather(*waiters) == ["test_response"] * 3
+    assert key not in acache._in_flight
+
+
+@pytest.mark.asyncio
+async def test_register_new_key_propagates_exception():
+    acache = AsyncCache()
+    key = ("GET", "test_url")
+    await acache.register_new_key(key)
+    waiter = asyncio.ensure_future(acache.register_new_key(key))
+    await asyncio.sleep(0)
+
+    acache.release_new_key(key, exception=ValueError("origin failed"))
+    with pytest.raises(ValueError, match="origin failed"):
+        await waiter
+
+
+@pytest.mark.asyncio
+async def test_register_new_key_takeover_and_timeout():
+    acache = AsyncCache()
+    key = ("GET", "test_url")
+    await acache.register_new_key(key)
+    waiter = asyncio.ensure_future(acache.register_new_key(key))
+    await asyncio.sleep(0)
+
+    # released without result, waiter becomes responsible for the request
+    acache.release_new_key(key)
+    assert await waiter is None
+    assert key in acache._in_flight
+
+    with pytest.raises(TimeoutException):
+        await acache.register_new_key(key, timeout=0.01)
+
+
+@pytest.mark.asyncio
+async def test_register_new_key_non_cacheable_method():
+    acache = AsyncCache()
+    key = ("POST", "test_url")
+    assert await acache.register_new_key(key) is None
+    assert await acache.register_new_key(key) is None
+    assert key not in acache._in_flight
+
+
+def test_cache_max_bytes():
+    acache = AsyncCache(config={"max_bytes": 250, "max_entry_bytes": 150})
+    headers = {"Cache-Control": "max-age=604800"}
+
+    acache.add(("GET", "url_1"), CachedResponse(200, {}, b"1" * 100), headers)
+    acache.add(("GET", "url_2"), CachedResponse(200, {}, b"2" * 100), headers)
+    assert acache.total_bytes == 200
+
+    # replacing an entry accounts only the new size
+    acache.add(("GET", "url_2"), CachedResponse(200, {}, b"2" * 50), headers)
+    assert acache.total_bytes == 150
+
+    # least recently used entries are evicted until cache fits the budget
+    acache.add(("GET", "url_3"), CachedResponse(200, {}, b"3" * 120), headers)
+    assert ("GET", "url_1") not in acache.cache
+    assert acache.total_bytes == 170
+
+    # entries bigger than max_entry_bytes are not cached at all
+    acache.add(("GET", "url_2"), CachedResponse(200, {}, b"2" * 151), headers)
+    assert ("GET", "url_2") not in acache.cache
+    assert acache.total_bytes == 120
+
+    acache.delete(("GET", "url_3"))
+    assert acache.total_bytes == 0
+
+
+def test_purge_expired(monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    acache = AsyncCache()
+    for index, max_age in enumerate((10, 20, 30, 40)):
+        acache.add(
+            ("GET", f"test_url_{index}"),
+            CachedResponse(200, {}, b"test_response"),
+            {"Cache-Control": f"max-age={max_age}"},
+        )
+    # replaced entry must be purged according to its new expiration time
+    acache.add(
+        ("GET", "test_url_0"),
+        CachedResponse(200, {}, b"test_response"),
+        {"Cache-Control": "max-age=100"},
+    )
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 35)
+    assert acache.purge_expired(limit=1) == 1
+    assert ("GET", "test_url_1") not in acache.cache
+    assert acache.purge_expired() == 1
+    assert set(acache.cache) == {("GET", "test_url_0"), ("GET", "test_url_3")}
+    assert acache.purge_expired() == 0
+
+
+def test_keep_expired_entry_with_validators(monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    acache = AsyncCache(config={"stale_ttl": 100})
+    with_validators = ("GET", "with_validators")
+    without_validators = ("GET", "without_validators")
+    acache.add(
+        with_validators,
+        CachedResponse(200, {"ETag": '"v1"'}, b"test_response"),
+        {"Cache-Control": "max-age=10"},
+    )
+    acache.add(
+        without_validators,
+        CachedResponse(200, {}, b"test_response"),
+        {"Cache-Control": "max-age=10"},
+    )
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 50)
+    assert not acache.has_valid_entry(with_validators)
+    assert not acache.has_valid_entry(without_validators)
+    assert with_validators in acache.cache
+    assert without_validators not in acache.cache
+    assert acache.get_revalidation_headers(with_validators) == {
+        "If-None-Match": '"v1"'
+    }
+    assert acache.get_revalidation_headers(without_validators) == {}
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 111)
+    assert acache.purge_expired() == 1
+    assert with_validators not in acache.cache
+
+
+def test_add_no_cache_with_validators():
+    acache = AsyncCache()
+    key = ("GET", "test_url")
+    acache.add(
+        key,
+        CachedResponse(200, {"ETag": '"v1"'}, b"test_response"),
+        {"Cache-Control": "max-age=604800,no-cache"},
+    )
+    # stored, but has to be revalidated before use
+    assert key in acache.cache
+    assert not acache.has_valid_entry(key)
+
+
+def test_refresh():
+    acache = AsyncCache()
+    key = ("GET", "test_url")
+    acache.add(
+        key,
+        CachedResponse(
+            200,
+            {"ETag": '"v1"', "Content-Length": "13", "X-Header": "old"},
+            b"test_response",
+        ),
+        {"Cache-Control": "no-cache"},
+    )
+    entry = acache.refresh(
+        key,
+        {
+            "Cache-Control": "max-age=60",
+            "Content-Length": "0",
+            "X-Header": "new",
+        },
+    )
+    assert entry is acache.cache[key]
+    assert entry.headers["Content-Length"] == "13"
+    assert entry.headers["X-Header"] == "new"
+    assert entry.max_age == 60
+    assert acache.has_valid_entry(key)
+    assert acache.total_bytes == entry.size
+
+    assert acache.refresh(("GET", "other_url"), {}) is None
+
+
+@pytest.mark.parametrize(
+    "headers, max_age, created_at",
+    [
+        # max-age takes precedence over Expires
+        (
+            {
+                "Cache-Control": "max-age=60, s-maxage=600",
+                "Date": "Wed, 22 Sep 2021 09:00:00 GMT",
+                "Expires": "Wed, 22 Sep 2021 10:00:00 GMT",
+                "Age": "20",
+            },
+            60,
+            -20,
+        ),
+        # Expires is relative to Date, not to local clock
+        (
+            {
+                "Date": "Wed, 22 Sep 2021 09:00:00 GMT",
+                "Expires": "Wed, 22 Sep 2021 10:00:00 GMT",
+            },
+            3600,
+            0,
+        ),
+        ({"Expires": "0"}, 0, 0),
+        # heuristic freshness is 10% of time since last modification
+        (
+            {
+                "Date": "Wed, 22 Sep 2021 09:00:00 GMT",
+                "Last-Modified": "Wed, 22 Sep 2021 08:00:00 GMT",
+            },
+            360,
+            0,
+        ),
+        (
+            {
+                "Date": "Wed, 22 Sep 2021 09:00:00 GMT",
+                "Last-Modified": "Wed, 22 Sep 2011 09:00:00 GMT",
+            },
+            60 * 60 * 24,
+            0,
+        ),
+        ({"Last-Modified": "yesterday", "Age": "age"}, 120, 0),
+    ],
+)
+def test_freshness_lifetime(monkeypatch, headers, max_age, created_at):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    acache = AsyncCache()
+    acache.add(("GET", "test_url"), CachedResponse(200, {}, b""), headers)
+    entry = acache.cache[("GET", "test_url")]
+    assert entry.max_age == max_age
+    assert entry.created_at == current_timestamp + created_at
+
+
+def test_shared_cache():
+    acache = AsyncCache(
+        config={"shared": True, "stale_if_error": 60, "capacity": 10}
+    )
+    headers = {"Cache-Control": "max-age=60, s-maxage=600"}
+    acache.add(("GET", "shared"), CachedResponse(200, {}, b""), headers)
+    assert acache.cache[("GET", "shared")].max_age == 600
+
+    headers = {"Cache-Control": "private, max-age=60"}
+    acache.add(("GET", "private"), CachedResponse(200, {}, b""), headers)
+    assert ("GET", "private") not in acache.cache
+
+    headers = {"Cache-Control": "max-age=60, proxy-revalidate"}
+    acache.add(("GET", "revalidated"), CachedResponse(200, {}, b""), headers)
+    assert acache.cache[("GET", "revalidated")].stale_if_error == 0
+
+
+def test_cacheable_statuses():
+    acache = AsyncCache(config={"stale_if_error": 60})
+    for status in (404, 410, 500):
+        acache.add(
+            ("GET", str(status)),
+            CachedResponse(status, {}, b""),
+            {"Cache-Control": "max-age=60"},
+        )
+    assert list(acache.cache) == [("GET", "404"), ("GET", "410")]
+
+    headers = {"Cache-Control": "max-age=60, must-revalidate"}
+    acache.add(("GET", "404"), CachedResponse(404, {}, b""), headers)
+    assert acache.cache[("GET", "404")].stale_if_error == 0
+
+    acache = AsyncCache(config={"cacheable_statuses": (200,)})
+    acache.add(
+        ("GET", "404"),
+        CachedResponse(404, {}, b""),
+        {"Cache-Control": "max-age=60"},
+    )
+    assert len(acache.cache) == 0
+
+
+def test_no_cache_is_never_served_stale(monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    acache = AsyncCache(
+        config={"stale_while_revalidate": 60, "stale_if_error": 60}
+    )
+    key = ("GET", "test_url")
+    headers = {"Cache-Control": "no-cache", "ETag": '"v1"'}
+    acache.add(key, CachedResponse(200, headers, b""), headers)
+    entry = acache.cache[key]
+    assert entry.stale_while_revalidate == entry.stale_if_error == 0
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 1)
+    assert acache.get_stale_while_revalidate(key) is None
+    assert acache.get_stale_if_error(key) is None
+    assert acache.get_revalidation_headers(key) == {"If-None-Match": '"v1"'}
+
+
+def test_get_acceptable(monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    acache = AsyncCache()
+    for key, cache_control in (
+        ("stale", "max-age=10"),
+        ("revalidated", "max-age=10, must-revalidate"),
+    ):
+        acache.add(
+            ("GET", key),
+            CachedResponse(200, {"Cache-Control": cache_control}, b""),
+            {"Cache-Control": cache_control},
+        )
+
+    assert acache.get_acceptable(("GET", "stale"), min_fresh=5) is not None
+    assert acache.get_acceptable(("GET", "stale"), min_fresh=10) is None
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 15)
+    assert acache.get_acceptable(("GET", "stale"), max_stale=10) is not None
+    assert acache.get_acceptable(("GET", "stale"), max_stale=5) is None
+    assert acache.get_acceptable(("GET", "revalidated"), max_stale=10) is None
+    assert acache.get_acceptable(("GET", "missing"), max_stale=10) is None
+
+
+def test_invalidation():
+    acache = AsyncCache(config={"capacity": 5})
+    for url, tags in (
+        ("http://a.com/items/1", "items item-1"),
+        ("http://a.com/items/1?page=2", "items, item-1"),
+        ("http://a.com/items/2", "items"),
+        ("http://a.com/users/1", ""),
+        ("http://b.com/items/1", ""),
+    ):
+        acache.add(
+            ("GET", url),
+            CachedResponse(200, {"Surrogate-Key": tags}, b""),
+            {"Cache-Control": "max-age=60"},
+        )
+
+    assert acache.invalidate_tag("item-1") == 2
+    assert acache.invalidate_url("http://A.com:80/items/2#top") == 1
+    assert acache.invalidate_prefix("http://a.com/items") == 0
+    assert acache.invalidate_host("A.COM") == 1
+    assert list(acache.cache) == [("GET", "http://b.com/items/1")]
+    assert acache.metrics.counters["invalidations"] == 4
+
+    # evicted and deleted entries are unindexed
+    for i in range(6):
+        acache.add(
+            ("GET", f"http://a.com/{i}"),
+            CachedResponse(200, {}, b""),
+            {"Cache-Control": "max-age=60"},
+        )
+    acache.delete(("GET", "http://a.com/5"))
+    assert len(acache.invalidation_index) == 4
+    assert acache.invalidate_prefix("http://a.com/") == 4
+
+    # URL of digest keys is taken from response
+    acache = AsyncCache(config={"key_builder": KeyBuilder(digest=True)})
+    key = acache.key_builder("GET", "http://a.com/items/1")
+    acache.add(
+        key,
+        CachedResponse(200, {}, b"", "http://a.com/items/1"),
+        {"Cache-Control": "max-age=60"},
+    )
+    assert acache.invalidate_url("http://a.com/items/1") == 1
+    assert len(acache.cache) == 0
+
+
+def test_invalidation_reindex(monkeypatch):
+    acache = AsyncCache()
+    key = ("GET", "http://a.com/items/1")
+
+    def add(tags):
+        acache.add(
+            key,
+            CachedResponse(200, {"Surrogate-Key": tags}, b""),
+            {"Cache-Control": "max-age=60"},
+        )
+
+    add("items")
+    with monkeypatch.context() as patch:
+        # unchanged URL and tags are not indexed again
+        patch.setattr(invalidation, "_host", None)
+        add("items")
+    add("item-1")
+    assert acache.invalidate_tag("items") == 0
+    assert acache.invalidate_host("a.com") == 1
+
+    # prefix lookups see URLs added and removed since the last one
+    for path in ("b", "a", "c", "b"):
+        add(path)
+        acache.add(
+            ("GET", f"http://a.com/{path}"),
+            CachedResponse(200, {}, b""),
+            {"Cache-Control": "max-age=60"},
+        )
+        assert acache.invalidate_prefix("http://a.com/") == 2
+
+
+def test_vary_variants():
+    acache = AsyncCache(config={"max_variants": 2})
+    key = ("GET", "test_url")
+    headers = {"Cache-Control": "max-age=60", "Vary": "Accept-Language"}
+    for language in ("en", "de", "fr"):
+        entry = CachedResponse(200, headers, language.encode())
+        variant_key = acache.register_vary(
+            key, entry, {"Accept-Language": language}
+        )
+        assert variant_key == key + ((language,),)
+        acache.add(variant_key, entry, headers)
+
+    vary = acache.get_vary(key)
+    assert vary == ("accept-language",)
+    # the oldest variant is deleted above the limit
+    assert acache.get_variant_key(key, vary, {}) == key + ((None,),)
+    assert key + (("en",),) not in acache.cache
+    de_key = acache.get_variant_key(key, vary, {"accept-language": " de "})
+    assert acache.get(de_key).body == b"de"
+
+    # responses do not vary anymore, variants are dropped
+    entry = CachedResponse(200, {"Cache-Control": "max-age=60"}, b"any")
+    assert acache.register_vary(key, entry, {}) == key
+    assert acache.get_vary(key) is None
+    assert de_key not in acache.cache
+
+    entry = CachedResponse(200, {"Vary": "*"}, b"any")
+    assert acache.register_vary(key, entry, {}) is None
+
+
+def test_memoize_json_mode():
+    assert AsyncCache(config={"memoize_json": "copy"}).memoize_json == "copy"
+    with pytest.raises(ValueError):
+        AsyncCache(config={"memoize_json": "always"})
+
+
+def test_get_fresh(monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    acache = AsyncCache()
+    key = ("GET", "test_url")
+    assert acache.get_fresh(key) is None
+    entry = CachedResponse(200, {}, b"test_response")
+    acache.add(key, entry, {"Cache-Control": "max-age=10"})
+    assert acache.get_fresh(key) is entry
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 10)
+    assert acache.get_fresh(key) is None
+    assert key not in acache.cache
@@ -0,0 +1,40 @@
+import pytest
+from multidict import CIMultiDict
+
+from acachecontrol.cache_control import (
+    CacheControl,
+    get_cache_control,
+    parse_cache_control,
+)
+
+
+def test_parse_cache_control():
+    cache_control = parse_cache_control(
+        'Max-Age=60, no-cache="Set-Cookie", community="UCI", ext, '
+        "s-maxage=invalid,,"
+    )
+    assert isinstance(cache_control, CacheControl)
+    assert dict(cache_control) == {
+        "max-age": 60,
+        "no-cache": True,
+        "community": "UCI",
+        "ext": True,
+    }
+    with pytest.raises(TypeError):
+        cache_control["max-age"] = 0
+
+    # the same values share parsed header
+    assert parse_cache_control("max-age=60") is parse_cache_control(
+        "max-age=60"
+    )
+
+
+def test_get_cache_control():
+    headers = CIMultiDict(
+        [("cache-control", "max-age=60"), ("Cache-Control", "immutable")]
+    )
+    assert get_cache_control(headers) == {"max-age": 60, "immutable": True}
+    assert get_cache_control({"CACHE-CONTROL": "no-store"}) == {
+        "no-store": True
+    }
+    assert get_cache_control({}) == {}
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from acachecontrol.cached_response import CachedResponse
+
+
+@pytest.mark.asyncio
+async def test_read_text_json():
+    response = CachedResponse(
+        200,
+        {"Content-Type": "application/json; charset=latin-1"},
+        '{"name": "caf\xe9"}'.encode("latin-1"),
+        "http://example.com",
+    )
+    assert response.status == 200
+    assert response.headers["content-type"].startswith("application/json")
+    assert await response.read() == '{"name": "caf\xe9"}'.encode("latin-1")
+    assert await response.text() == '{"name": "caf\xe9"}'
+    assert await response.json() == {"name": "caf\xe9"}
+
+    empty_response = CachedResponse(204, {}, b"")
+    assert await empty_response.text() == ""
+    assert await empty_response.json() is None
+
+
+def test_compact_and_immutable():
+    response = CachedResponse(200, {"Content-Type": "text/html"}, b"body")
+    assert not hasattr(response, "__dict__")
+    with pytest.raises(TypeError):
+        response.headers["Content-Type"] = "application/json"
+
+
+def test_from_client_response(mocker):
+    client_response = mocker.Mock(
+        status=404, headers={"Content-Type": "text/plain"}, url="http://a.b"
+    )
+    response = CachedResponse.from_client_response(client_response, b"oops")
+    assert response.status == 404
+    assert response.url == "http://a.b"
+    assert response.headers["content-type"] == "text/plain"
+
+
+def test_size():
+    response = CachedResponse(200, {"Content-Type": "text/html"}, b"body")
+    assert response.size == len("Content-Type") + len("text/html") + 4
+
+
+@pytest.mark.asyncio
+async def test_memoize_text_json(mocker):
+    response = CachedResponse(200, {}, b'{"items": [1, 2]}')
+    assert await response.text(memoize=True) == '{"items": [1, 2]}'
+    response._body = b"changed"
+    # decoded text is memoized, body is not decoded again
+    assert await response.text() == '{"items": [1, 2]}'
+    assert await response.text(encoding="ascii") == "changed"
+
+    loads = mocker.Mock(side_effect=json.loads)
+    shared_value = await response.json(loads=loads, memoize="shared")
+    assert await response.json(loads=loads, memoize="shared") is shared_value
+    copied_value = await response.json(loads=loads, memoize="copy")
+    assert copied_value == shared_value
+    assert copied_value is not shared_value
+    assert loads.call_count == 1
+
+    # headers may change charset, so memoized values are dropped
+    response.update_headers({"Content-Type": "text/plain"})
+    assert await response.text() == "changed"
+
+
+@pytest.mark.asyncio
+async def test_memoized_size(tmp_path):
+    body = b'{"items": [1, 2]}'
+    response = CachedResponse(200, {}, body)
+    size = response.size
+    await response.text(memoize=True)
+    assert response.size == size + len(body)
+    await response.json(memoize="shared")
+    await response.json(loads=lambda text: None, memoize="shared")
+    assert response.size == size + 2 * len(body)
+    response.set_body(body)
+    assert response.size == size
+
+    # body in spill file is not memoized
+    path = tmp_path / "spill"
+    path.write_bytes(body)
+    response.set_body(b"", str(path), len(body))
+    size = response.size
+    await response.text(memoize=True)
+    assert await response.json(memoize="shared") == {"items": [1, 2]}
+    assert response.size == size
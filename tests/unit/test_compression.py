@@ -0,0 +1,82 @@
+import gzip
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from acachecontrol.cache import AsyncCache
+from acachecontrol.cached_response import CachedResponse
+from acachecontrol.compression import LZMACodec, ZlibCodec, get_codec
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("codec", [ZlibCodec(), LZMACodec()])
+async def test_compress_body(codec):
+    body = b'{"items": [' + b'{"name": "item"}, ' * 100 + b"{}]}"
+    response = CachedResponse(200, {"Content-Type": "application/json"}, body)
+    raw_size = response.size
+    assert not response.compress(codec, threshold=len(body) + 1)
+    assert response.compress(codec)
+
+    assert response.size < raw_size
+    assert response.raw_size == raw_size
+    assert response.body == body
+    assert await response.read() == body
+    assert len((await response.json())["items"]) == 101
+    chunks = [chunk async for chunk in response.iter_chunked(64)]
+    assert b"".join(chunks) == body
+
+
+@pytest.mark.asyncio
+async def test_compress_encoded_by_origin():
+    body = b"a" * 1000
+
+    async def handler(request):
+        return web.Response(
+            body=gzip.compress(body), headers={"Content-Encoding": "gzip"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    async with TestServer(app) as server:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(server.make_url("/")) as client_response:
+                response = CachedResponse.from_client_response(
+                    client_response, await client_response.read()
+                )
+
+    # aiohttp decodes body, but keeps Content-Encoding header
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.body == body
+    assert response.compress(ZlibCodec())
+    assert response.size < len(body)
+    assert await response.read() == body
+
+
+def test_compress_skipped():
+    codec = ZlibCodec()
+    # random data doesn't shrink
+    random_response = CachedResponse(200, {}, bytes(range(256)))
+    assert not random_response.compress(codec)
+    assert random_response.codec is None
+
+
+def test_cache_compression():
+    acache = AsyncCache(
+        config={"compression": "zlib", "compression_threshold": 100}
+    )
+    headers = {"Cache-Control": "max-age=60"}
+    acache.add(("GET", "small"), CachedResponse(200, {}, b"a" * 10), headers)
+    acache.add(("GET", "big"), CachedResponse(200, {}, b"a" * 1000), headers)
+
+    assert acache.cache[("GET", "small")].codec is None
+    assert acache.cache[("GET", "big")].codec is acache.codec
+    assert acache.raw_bytes == 1010
+    assert acache.total_bytes < 100
+
+    acache.delete(("GET", "big"))
+    assert acache.raw_bytes == acache.total_bytes == 10
+
+    with pytest.raises(ValueError):
+        get_codec("unknown")
@@ -0,0 +1,112 @@
+import pytest
+
+from acachecontrol.cache import AsyncCache
+from acachecontrol.cached_response import CachedResponse
+from acachecontrol.eviction import (
+    FrequencySketch,
+    LFUPolicy,
+    LRUPolicy,
+    SIEVEPolicy,
+    WTinyLFUPolicy,
+    get_eviction_policy,
+)
+
+
+def test_lru_policy():
+    policy = LRUPolicy()
+    for key in "abc":
+        policy.on_insert(key)
+    policy.on_access("a")
+    assert policy.victim() == "b"
+    policy.on_remove("b")
+    assert policy.victim() == "c"
+
+
+def test_lfu_policy():
+    policy = LFUPolicy()
+    for key in "abc":
+        policy.on_insert(key)
+    policy.on_access("a")
+    policy.on_access("a")
+    policy.on_access("b")
+    assert policy.victim() == "c"
+    policy.on_remove("c")
+    assert policy.victim() == "b"
+    policy.on_remove("b")
+    assert policy.victim() == "a"
+
+
+def test_sieve_policy():
+    policy = SIEVEPolicy()
+    for key in "abcd":
+        policy.on_insert(key)
+    policy.on_access("a")
+    policy.on_access("c")
+    # "a" is visited, so hand skips it and resets its mark
+    assert policy.victim() == "b"
+    policy.on_remove("b")
+    # "c" is visited, "d" is not
+    assert policy.victim() == "d"
+    policy.on_remove("d")
+    # hand wraps around to the oldest key, which is not visited anymore
+    assert policy.victim() == "a"
+
+
+def test_frequency_sketch():
+    sketch = FrequencySketch(width=64, sample_size=100)
+    for _ in range(5):
+        sketch.increment("hot")
+    sketch.increment("cold")
+    assert sketch.estimate("hot") >= 5
+    assert sketch.estimate("hot") > sketch.estimate("cold")
+
+    # counters are aged after sample_size increments
+    for _ in range(94):
+        sketch.increment("other")
+    assert sketch.estimate("hot") < 5
+
+
+@pytest.mark.parametrize(
+    "policy, hot_keys_survive",
+    [("lru", False), ("lfu", True), ("w-tinylfu", True)],
+)
+def test_scan_resistance(policy, hot_keys_survive):
+    capacity = 20
+    acache = AsyncCache(
+        config={"capacity": capacity, "eviction_policy": policy}
+    )
+    headers = {"Cache-Control": "max-age=604800"}
+    hot_keys = [("GET", f"hot_{index}") for index in range(capacity // 2)]
+    for key in hot_keys:
+        acache.add(key, CachedResponse(200, {}, b"hot"), headers)
+    for _ in range(3):
+        for key in hot_keys:
+            acache.get(key)
+
+    for index in range(10 * capacity):
+        acache.add(("GET", f"scan_{index}"), CachedResponse(200, {}, b""), {})
+
+    assert len(acache.cache) == capacity
+    survived = [key in acache.cache for key in hot_keys]
+    assert all(survived) is hot_keys_survive
+
+
+def test_get_eviction_policy():
+    assert isinstance(get_eviction_policy("SIEVE"), SIEVEPolicy)
+    policy = WTinyLFUPolicy()
+    assert get_eviction_policy(policy) is policy
+    assert isinstance(get_eviction_policy(LFUPolicy), LFUPolicy)
+    with pytest.raises(ValueError):
+        get_eviction_policy("random")
+
+
+def test_eviction_policy_out_of_sync():
+    # policy shared by mistake returns keys of the other cache
+    policy = LRUPolicy()
+    first_cache = AsyncCache(config={"capacity": 1, "eviction_policy": policy})
+    second_cache = AsyncCache(config={"capacity": 1, "eviction_policy": policy})
+    headers = {"Cache-Control": "max-age=60"}
+    first_cache.add(("GET", "a"), CachedResponse(200, {}, b""), headers)
+    second_cache.add(("GET", "b"), CachedResponse(200, {}, b""), headers)
+    second_cache.add(("GET", "c"), CachedResponse(200, {}, b""), headers)
+    assert len(second_cache.cache) == 2
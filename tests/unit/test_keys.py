@@ -0,0 +1,74 @@
+from acachecontrol.keys import KeyBuilder
+
+
+def test_canonical_url():
+    build_key = KeyBuilder()
+    expected_key = ("GET", "http://example.com/path?a=1&b=2&b=1")
+    assert build_key("GET", "http://example.com/path?b=2&a=1&b=1") == (
+        expected_key
+    )
+    assert (
+        build_key("GET", "HTTP://Example.COM:80/path?b=2&b=1#top", {"a": 1})
+        == expected_key
+    )
+    assert build_key("GET", "https://example.com:443") == (
+        "GET",
+        "https://example.com/",
+    )
+    assert build_key("GET", "https://example.com:8443") == (
+        "GET",
+        "https://example.com:8443/",
+    )
+    # encoded characters are kept, they may mean other resource
+    assert build_key("GET", "http://x.com/a%2Fb") == (
+        "GET",
+        "http://x.com/a%2Fb",
+    )
+    assert build_key("GET", "http://x.com/a%2Fb") != build_key(
+        "GET", "http://x.com/a/b"
+    )
+    assert build_key("GET", "http://x.com/a%2Bb?q=%2B&flag") == (
+        "GET",
+        "http://x.com/a%2Bb?flag&q=%2B",
+    )
+    assert build_key("GET", "http://x.com/?q=%2B") != build_key(
+        "GET", "http://x.com/?q=+"
+    )
+
+
+def test_params_are_part_of_key():
+    build_key = KeyBuilder()
+    url = "http://example.com/items"
+    assert build_key("GET", url, {"page": 1}) != build_key(
+        "GET", url, {"page": 2}
+    )
+    assert build_key("GET", url, {"page": 1}) == build_key(
+        "GET", url + "?page=1"
+    )
+
+
+def test_ignored_params():
+    build_key = KeyBuilder(ignored_params=("gclid", "utm_*"))
+    assert build_key(
+        "GET", "http://example.com/?utm_source=x&id=1&gclid=y&utm_medium=z"
+    ) == ("GET", "http://example.com/?id=1")
+
+
+def test_key_headers_and_digest():
+    build_key = KeyBuilder(key_headers=("Authorization",))
+    url = "http://example.com/"
+    assert build_key("GET", url, headers={"authorization": "Bearer 1"}) == (
+        "GET",
+        url,
+        "Bearer 1",
+    )
+    assert build_key("GET", url) == ("GET", url, None)
+
+    build_digest = KeyBuilder(key_headers=("Authorization",), digest=True)
+    key = build_digest("GET", url, headers={"Authorization": "Bearer 1"})
+    assert key[0] == "GET"
+    assert isinstance(key[1], bytes) and len(key[1]) == 16
+    assert key != build_digest("GET", url, headers={"Authorization": "x"})
+    assert key == build_digest(
+        "GET", "http://EXAMPLE.com", headers={"Authorization": "Bearer 1"}
+    )
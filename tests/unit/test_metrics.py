@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from acachecontrol.cache import AsyncCache
+from acachecontrol.metrics import CacheMetrics, Histogram
+from acachecontrol.request_context_manager import RequestContextManager
+
+from .test_request_context_manager import FakeSession, make_response
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1
+    assert histogram.quantile(1) == float("inf")
+    assert histogram.as_dict() == {
+        "buckets": {0.1: 2, 1: 3, float("inf"): 4},
+        "count": 4,
+        "sum": 2.65,
+    }
+    histogram.reset()
+    assert histogram.quantile(0.5) == 0
+
+
+def test_metrics_callback():
+    metrics = CacheMetrics()
+    events = []
+    metrics.add_callback(lambda name, value: events.append((name, value)))
+    metrics.inc("hits")
+    metrics.inc("misses")
+    metrics.observe("fetch_latency", 0.5)
+    assert events == [("hits", 1), ("misses", 1), ("fetch_latency", 0.5)]
+    assert metrics.hit_ratio == 0.5
+    assert metrics.as_dict()["fetch_latency"]["count"] == 1
+    metrics.reset()
+    assert metrics.as_dict()["hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_request_metrics(mocker):
+    cache = AsyncCache(config={"capacity": 1})
+    headers = {"Cache-Control": "max-age=60"}
+    first_response = make_response(mocker, 200, headers)
+
+    async def read():
+        # let concurrent request wait for this one
+        await asyncio.sleep(0)
+        return b"first"
+
+    first_response.read = read
+    session = FakeSession(
+        first_response,
+        make_response(mocker, 200, headers, b"second"),
+        make_response(mocker, 201, {}),
+    )
+
+    async def get(url):
+        async with RequestContextManager(session, cache, "GET", url) as resp:
+            return await resp.text()
+
+    await asyncio.gather(get("http://a.b/1"), get("http://a.b/1"))
+    await get("http://a.b/1")
+    await get("http://a.b/2")
+    async with RequestContextManager(session, cache, "POST", "http://a.b/1"):
+        pass
+
+    metrics = cache.metrics.as_dict()
+    assert metrics["misses"] == 2
+    assert metrics["coalesced"] == 1
+    assert metrics["hits"] == 1
+    assert metrics["evictions"] == 1
+    headers_size = len("Cache-Control" + "max-age=60")
+    assert metrics["bytes_stored"] == 2 * headers_size + len("firstsecond")
+    assert metrics["fetch_latency"]["count"] == 3
+    assert metrics["hit_latency"]["count"] == 1
+    # POST is not a miss, coalesced request didn't reach origin
+    assert cache.metrics.hit_ratio == 0.5
@@ -1,4 +1,13 @@
+import asyncio
+import math
+import time
+
+import pytest
+
+from acachecontrol.backends import SQLiteBackend
 from acachecontrol.cache import AsyncCache
+from acachecontrol.cached_response import CachedResponse
+from acachecontrol.exceptions import CacheException
 from acachecontrol.request_context_manager import RequestContextManager
 
 
@@ -8,12 +17,569 @@ def test_init(mocker):
     timeout = 10
     cache = AsyncCache()
     rcm = RequestContextManager(
-        mocker.Mock(), cache, method, url, timeout=timeout, allow_redirects=True
+        mocker.Mock(),
+        cache,
+        method,
+        url,
+        timeout=timeout,
+        allow_redirects=True,
     )
 
     assert rcm.method == method
     assert rcm.url == url
-    assert rcm.key == (method, url)
+    assert rcm.key == (method, "http://example.com/")
     assert rcm.params == {"timeout": timeout, "allow_redirects": True}
     assert rcm.cache == cache
     assert rcm.timeout == timeout
+
+
+@pytest.mark.asyncio
+async def test_failed_request_releases_key(mocker):
+    cache = AsyncCache()
+    session = mocker.Mock()
+    session.request.side_effect = ConnectionError("origin is down")
+    url = "http://example.com/"
+
+    with pytest.raises(ConnectionError):
+        async with RequestContextManager(session, cache, "GET", url):
+            pass
+    assert ("GET", url) not in cache._in_flight
+
+
+class FakeSession:
+    """Client session which returns given responses one by one."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **params):
+        self.requests.append((method, url, params))
+        return FakeRequest(self.responses.pop(0))
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    async def __aenter__(self):
+        return self.response
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def make_response(mocker, status, headers, body=b""):
+    response = mocker.Mock(status=status, headers=headers, url="http://a.b")
+    response.read = mocker.AsyncMock(return_value=body)
+    return response
+
+
+@pytest.mark.asyncio
+async def test_revalidate_not_modified(mocker, monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    cache = AsyncCache()
+    url = "http://example.com/"
+    cache.add(
+        ("GET", url),
+        CachedResponse(200, {"ETag": '"v1"', "X-Version": "1"}, b"content"),
+        {"Cache-Control": "max-age=10"},
+    )
+    session = FakeSession(
+        make_response(
+            mocker, 304, {"Cache-Control": "max-age=20", "X-Version": "2"}
+        )
+    )
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 15)
+    async with RequestContextManager(session, cache, "GET", url) as resp:
+        assert resp.status == 200
+        assert resp.headers["X-Version"] == "2"
+        assert await resp.text() == "content"
+
+    assert session.requests[0][2]["headers"]["If-None-Match"] == '"v1"'
+    entry = cache.cache[("GET", url)]
+    assert entry.max_age == 20
+    assert entry.created_at == current_timestamp + 15
+    assert cache.has_valid_entry(("GET", url))
+
+
+@pytest.mark.asyncio
+async def test_revalidate_modified(mocker):
+    cache = AsyncCache()
+    url = "http://example.com/"
+    cache.add(
+        ("GET", url),
+        CachedResponse(200, {"Last-Modified": "yesterday"}, b"old"),
+        {"Cache-Control": "no-cache"},
+    )
+    session = FakeSession(make_response(mocker, 200, {}, b"new"))
+
+    async with RequestContextManager(session, cache, "GET", url) as resp:
+        assert await resp.text() == "new"
+    request_headers = session.requests[0][2]["headers"]
+    assert request_headers["If-Modified-Since"] == "yesterday"
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate(mocker, monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    cache = AsyncCache()
+    url = "http://example.com/"
+    cache.add(
+        ("GET", url),
+        CachedResponse(200, {}, b"old"),
+        {"Cache-Control": "max-age=10, stale-while-revalidate=100"},
+    )
+    session = FakeSession(make_response(mocker, 200, {}, b"new"))
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 50)
+    for _ in range(2):
+        async with RequestContextManager(session, cache, "GET", url) as resp:
+            assert await resp.text() == "old"
+    await asyncio.sleep(0)
+
+    # only one background refresh for both requests
+    assert len(session.requests) == 1
+    assert await cache.get(("GET", url)).text() == "new"
+    assert cache.has_valid_entry(("GET", url))
+
+
+@pytest.mark.asyncio
+async def test_stale_if_error(mocker, monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    cache = AsyncCache(config={"stale_if_error": 100})
+    url = "http://example.com/"
+    cache.add(
+        ("GET", url),
+        CachedResponse(200, {}, b"old"),
+        {"Cache-Control": "max-age=10"},
+    )
+    session = FakeSession(make_response(mocker, 503, {}, b"unavailable"))
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 50)
+    async with RequestContextManager(session, cache, "GET", url) as resp:
+        assert resp.status == 200
+        assert await resp.text() == "old"
+
+    session = mocker.Mock()
+    session.request.side_effect = ConnectionError("origin is down")
+    async with RequestContextManager(session, cache, "GET", url) as resp:
+        assert await resp.text() == "old"
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 111)
+    with pytest.raises(ConnectionError):
+        async with RequestContextManager(session, cache, "GET", url):
+            pass
+    assert cache.metrics.counters["stale_hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_stale_if_error_not_served(mocker, monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    cache = AsyncCache(config={"stale_if_error": 100, "refresh_ahead": 0.5})
+    url = "http://example.com/"
+    cache.add(
+        ("GET", url),
+        CachedResponse(200, {}, b"old"),
+        {"Cache-Control": "max-age=10"},
+    )
+    session = mocker.Mock()
+    session.request.side_effect = ConnectionError("origin is down")
+
+    # no-cache request doesn't fall back to stored response
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 50)
+    with pytest.raises(ConnectionError):
+        async with RequestContextManager(
+            session, cache, "GET", url, no_cache=True
+        ):
+            pass
+
+    # fresh entry is not stale, failed refresh ahead serves nothing
+    cache.refresh(("GET", url), {"Cache-Control": "max-age=10"})
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 56)
+    for _ in range(2):
+        async with RequestContextManager(session, cache, "GET", url) as resp:
+            assert await resp.text() == "old"
+    await asyncio.sleep(0)
+    assert session.request.call_count == 2
+    assert cache.get_stale_if_error(("GET", url)) is None
+    assert cache.metrics.counters["stale_hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_vary_coalesced_requests(mocker):
+    cache = AsyncCache()
+    url = "http://example.com/"
+    headers = {"Cache-Control": "max-age=60", "Vary": "Accept-Language"}
+    session = FakeSession(
+        make_response(mocker, 200, headers, b"en"),
+        make_response(mocker, 200, headers, b"de"),
+    )
+
+    async def get(language):
+        async with RequestContextManager(
+            session, cache, "GET", url, headers={"Accept-Language": language}
+        ) as resp:
+            return await resp.text()
+
+    # waiter does its own request, as response of the first one varies
+    assert await asyncio.gather(get("en"), get("de"), get("en")) == [
+        "en",
+        "de",
+        "en",
+    ]
+    assert len(session.requests) == 2
+    assert await get("de") == "de"
+    assert len(session.requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_vary_restored_from_storage(mocker, tmp_path):
+    path = str(tmp_path / "cache.db")
+    url = "http://example.com/"
+    headers = {"Cache-Control": "max-age=60", "Vary": "Accept-Language"}
+    session = FakeSession(make_response(mocker, 200, headers, b"en"))
+
+    async def get(cache):
+        async with RequestContextManager(
+            session, cache, "GET", url, headers={"Accept-Language": "en"}
+        ) as resp:
+            return await resp.text()
+
+    cache = AsyncCache(storage=SQLiteBackend(path))
+    assert await get(cache) == "en"
+    await cache.close()
+
+    # variant is loaded from storage after restart without warming up
+    cache = AsyncCache(storage=SQLiteBackend(path))
+    assert await get(cache) == "en"
+    assert len(session.requests) == 1
+    await cache.close()
+
+
+class FakeContent:
+    def __init__(self, body):
+        self.body = body
+
+    async def iter_chunked(self, n):
+        for start in range(0, len(self.body), n):
+            yield self.body[start : start + n]
+
+
+@pytest.mark.asyncio
+async def test_stream_spill_file(mocker, tmp_path):
+    cache = AsyncCache(
+        config={"spill_threshold": 4, "spill_dir": str(tmp_path)}
+    )
+    url = "http://example.com/"
+    responses = []
+    for _ in range(2):
+        response = make_response(mocker, 200, {"Cache-Control": "max-age=60"})
+        response.content = FakeContent(b"streamed body")
+        responses.append(response)
+    session = FakeSession(*responses)
+
+    # body is not read till the end, so it is not cached
+    async with RequestContextManager(
+        session, cache, "GET", url, stream=True
+    ) as resp:
+        async for _ in resp.iter_chunked(5):
+            break
+    assert ("GET", url) not in cache.cache
+    assert ("GET", url) not in cache._in_flight
+    assert list(tmp_path.iterdir()) == []
+
+    async with RequestContextManager(
+        session, cache, "GET", url, stream=True
+    ) as resp:
+        chunks = [chunk async for chunk in resp.iter_chunked(5)]
+    assert chunks == [b"strea", b"med b", b"ody"]
+    assert len(list(tmp_path.iterdir())) == 1
+    # body in spill file doesn't take memory, only headers do
+    assert cache.total_bytes == len("Cache-Control" + "max-age=60")
+    assert cache.spilled_bytes == len(b"streamed body")
+
+    async with RequestContextManager(
+        session, cache, "GET", url, stream=True
+    ) as resp:
+        chunks = [chunk async for chunk in resp.iter_chunked(8)]
+        assert chunks == [b"streamed", b" body"]
+        assert await resp.text() == "streamed body"
+    assert len(session.requests) == 2
+
+    cache.delete(("GET", url))
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_hit_is_pinned():
+    cache = AsyncCache()
+    url = "http://example.com/"
+    cache.add(
+        ("GET", url),
+        CachedResponse(200, {}, b"cached"),
+        {"Cache-Control": "max-age=60"},
+    )
+    session = FakeSession()
+    async with RequestContextManager(session, cache, "GET", url) as resp:
+        cache.clear_cache()
+        assert await resp.text() == "cached"
+    assert session.requests == []
+
+
+@pytest.mark.asyncio
+async def test_hit_touches_storage(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = AsyncCache(storage=SQLiteBackend(path, max_entries=2))
+    headers = {"Cache-Control": "max-age=60"}
+    for url in ("http://example.com/1", "http://example.com/2"):
+        cache.add(("GET", url), CachedResponse(200, {}, b"cached"), headers)
+    session = FakeSession()
+    async with RequestContextManager(
+        session, cache, "GET", "http://example.com/1"
+    ):
+        pass
+    url = "http://example.com/3"
+    cache.add(("GET", url), CachedResponse(200, {}, b"cached"), headers)
+    await cache.close()
+
+    # storage evicts entry which wasn't used recently
+    storage = SQLiteBackend(path)
+    assert [key for key, _ in storage.most_recently_used(10)] == [
+        ("GET", "http://example.com/3"),
+        ("GET", "http://example.com/1"),
+    ]
+    storage.close()
+
+
+@pytest.mark.asyncio
+async def test_refresh_ahead(mocker, monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    cache = AsyncCache(
+        config={"refresh_ahead": 0.5, "max_background_refreshes": 1}
+    )
+    for url in ("http://example.com/1", "http://example.com/2"):
+        cache.add(
+            ("GET", url),
+            CachedResponse(200, {"ETag": '"v1"'}, b"content"),
+            {"Cache-Control": "max-age=10"},
+        )
+    session = FakeSession(
+        make_response(mocker, 304, {"Cache-Control": "max-age=10"})
+    )
+
+    async def get(url):
+        async with RequestContextManager(session, cache, "GET", url) as resp:
+            return await resp.text()
+
+    # entries are not refreshed before half of their max-age
+    assert await get("http://example.com/1") == "content"
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 6)
+    # the second hit refreshes the entry, other one waits for its turn
+    for url in ("http://example.com/1", "http://example.com/2") * 2:
+        assert await get(url) == "content"
+    assert ("GET", "http://example.com/1") in cache._in_flight
+    await asyncio.sleep(0)
+
+    assert len(session.requests) == 1
+    assert session.requests[0][2]["headers"]["If-None-Match"] == '"v1"'
+    entry = cache.cache[("GET", "http://example.com/1")]
+    assert entry.created_at == current_timestamp + 6
+    assert entry.hits == 0
+    assert cache._refreshing_ahead == set()
+    assert cache.metrics.counters["refreshes_ahead"] == 1
+
+
+@pytest.mark.asyncio
+async def test_request_cache_control(mocker, monkeypatch):
+    current_timestamp = time.time()
+    monkeypatch.setattr(time, "time", lambda: current_timestamp)
+    cache = AsyncCache()
+    url = "http://example.com/"
+    cache.add(
+        ("GET", url),
+        CachedResponse(200, {}, b"cached"),
+        {"Cache-Control": "max-age=10"},
+    )
+    session = FakeSession(
+        make_response(mocker, 200, {"Cache-Control": "max-age=10"}, b"new"),
+    )
+
+    async def get(**params):
+        async with RequestContextManager(
+            session, cache, "GET", url, **params
+        ) as resp:
+            return resp.status, await resp.text()
+
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 5)
+    assert await get(headers={"Cache-Control": "min-fresh=4"}) == (
+        200,
+        "cached",
+    )
+    monkeypatch.setattr(time, "time", lambda: current_timestamp + 15)
+    assert await get(headers={"Cache-Control": "max-stale=10"}) == (
+        200,
+        "cached",
+    )
+    assert await get(max_stale=math.inf, only_if_cached=True) == (
+        200,
+        "cached",
+    )
+    assert await get(max_stale=3, only_if_cached=True) == (504, "")
+    assert session.requests == []
+
+    assert await get(
+        headers={"Cache-Control": "no-cache"}, max_stale=math.inf
+    ) == (200, "new")
+    assert len(session.requests) == 1
+    assert await get(min_fresh=20, only_if_cached=True) == (504, "")
+
+
+@pytest.mark.asyncio
+async def test_unsafe_method_invalidates(mocker):
+    cache = AsyncCache()
+    for url in (
+        "http://example.com/items",
+        "http://example.com/items/1",
+        "http://other.com/items/1",
+    ):
+        cache.add(
+            ("GET", url),
+            CachedResponse(200, {}, b"cached"),
+            {"Cache-Control": "max-age=60"},
+        )
+    session = FakeSession(
+        make_response(mocker, 500, {}),
+        make_response(
+            mocker,
+            201,
+            {
+                "Location": "/items/1",
+                "Content-Location": "http://other.com/items/1",
+            },
+        ),
+    )
+
+    url = "http://example.com/items"
+    async with RequestContextManager(session, cache, "POST", url) as resp:
+        assert resp.status == 500
+    assert len(cache.cache) == 3
+
+    async with RequestContextManager(session, cache, "POST", url) as resp:
+        assert resp.status == 201
+    # location of other origin is not invalidated
+    assert list(cache.cache) == [("GET", "http://other.com/items/1")]
+
+
+@pytest.mark.asyncio
+async def test_stream_too_big(mocker, tmp_path):
+    cache = AsyncCache(
+        config={
+            "spill_threshold": 4,
+            "spill_dir": str(tmp_path),
+            "max_entry_bytes": 10,
+        }
+    )
+    url = "http://example.com/"
+    responses = []
+    for _ in range(2):
+        response = make_response(mocker, 200, {"Cache-Control": "max-age=60"})
+        response.content = FakeContent(b"streamed body")
+        responses.append(response)
+    session = FakeSession(*responses)
+
+    async with RequestContextManager(
+        session, cache, "GET", url, stream=True
+    ) as resp:
+        chunks = [chunk async for chunk in resp.iter_chunked(5)]
+        assert chunks == [b"strea", b"med b", b"ody"]
+        with pytest.raises(CacheException):
+            await resp.read()
+    assert len(cache.cache) == 0
+    assert ("GET", url) not in cache._in_flight
+    assert list(tmp_path.iterdir()) == []
+
+    # body read at once is returned, but not cached either
+    async with RequestContextManager(
+        session, cache, "GET", url, stream=True
+    ) as resp:
+        assert await resp.read() == b"streamed body"
+    assert len(cache.cache) == 0
+    assert cache.spilled_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_spill_budget(mocker, tmp_path):
+    cache = AsyncCache(
+        config={
+            "spill_threshold": 4,
+            "spill_dir": str(tmp_path),
+            "max_spill_bytes": 20,
+        }
+    )
+    for path in ("/1", "/2"):
+        response = make_response(mocker, 200, {"Cache-Control": "max-age=60"})
+        response.content = FakeContent(b"streamed body")
+        async with RequestContextManager(
+            FakeSession(response),
+            cache,
+            "GET",
+            "http://example.com" + path,
+            stream=True,
+        ) as resp:
+            await resp.read()
+
+    # the first entry is evicted to keep spill files within budget
+    assert list(cache.cache) == [("GET", "http://example.com/2")]
+    assert cache.spilled_bytes == len(b"streamed body")
+
+
+@pytest.mark.asyncio
+async def test_min_fresh_ignores_stale_while_revalidate(mocker):
+    cache = AsyncCache()
+    url = "http://example.com/"
+    cache.add(
+        ("GET", url),
+        CachedResponse(200, {}, b"cached"),
+        {"Cache-Control": "max-age=60, stale-while-revalidate=600"},
+    )
+    session = FakeSession(
+        make_response(mocker, 200, {"Cache-Control": "max-age=60"}, b"new"),
+        make_response(mocker, 200, {"Cache-Control": "max-age=60"}, b"new"),
+    )
+
+    for params in (
+        {"min_fresh": 100},
+        {"headers": {"Cache-Control": "min-fresh=100"}},
+    ):
+        async with RequestContextManager(
+            session, cache, "GET", url, **params
+        ) as resp:
+            assert await resp.text() == "new"
+    assert len(session.requests) == 2
+    assert cache.metrics.counters["stale_hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_memoized_text_counts_against_max_bytes():
+    body = b"a" * 100
+    cache = AsyncCache(config={"max_bytes": 250, "memoize_text": True})
+    headers = {"Cache-Control": "max-age=60"}
+    for url in ("http://example.com/1", "http://example.com/2"):
+        cache.add(("GET", url), CachedResponse(200, {}, body), headers)
+    session = FakeSession()
+    async with RequestContextManager(
+        session, cache, "GET", "http://example.com/2"
+    ) as resp:
+        assert await resp.text() == "a" * 100
+        assert await resp.text() == "a" * 100
+
+    # the other entry is evicted to fit memoized text
+    assert list(cache.cache) == [("GET", "http://example.com/2")]
+    assert cache.total_bytes == 200
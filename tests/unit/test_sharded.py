@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from acachecontrol.cached_response import CachedResponse
+from acachecontrol.eviction import LRUPolicy
+from acachecontrol.request_context_manager import RequestContextManager
+from acachecontrol.sharded import ShardedAsyncCache
+
+from .test_request_context_manager import FakeSession
+
+
+def test_shards():
+    cache = ShardedAsyncCache(config={"capacity": 30}, shards=4)
+    assert [shard.capacity for shard in cache.shards] == [8, 8, 8, 8]
+    for i in range(8):
+        cache.add(
+            ("GET", f"http://example.com/{i}"),
+            CachedResponse(200, {}, b"body"),
+            {"Cache-Control": "max-age=60"},
+        )
+    assert len(cache) == 8
+    assert cache.total_bytes == 8 * len(b"body")
+    assert cache.get_fresh(("GET", "http://example.com/1")) is not None
+
+    # variants are kept in the shard of their primary key
+    key = ("GET", "http://example.com/1")
+    assert cache._shard(key + (("en",),)) is cache._shard(key)
+
+    assert cache.invalidate_prefix("http://example.com/1") == 1
+    assert cache.invalidate_host("example.com") == 7
+
+    cache.clear_cache()
+    assert len(cache) == 0
+
+
+def test_shards_eviction_policy():
+    with pytest.raises(ValueError):
+        ShardedAsyncCache({"eviction_policy": LRUPolicy()}, shards=2)
+
+    cache = ShardedAsyncCache(
+        {"capacity": 4, "eviction_policy": LRUPolicy}, shards=2
+    )
+    for i in range(20):
+        cache.add(
+            ("GET", f"http://example.com/{i}"),
+            CachedResponse(200, {}, b"body"),
+            {"Cache-Control": "max-age=60"},
+        )
+    assert len(cache) <= 4
+    policies = [shard.eviction_policy for shard in cache.shards]
+    assert policies[0] is not policies[1]
+
+
+def test_coalesced_across_event_loops():
+    cache = ShardedAsyncCache()
+    url = "http://example.com/"
+
+    class SlowResponse:
+        status = 200
+        headers = {"Cache-Control": "max-age=60"}
+        url = "http://example.com/"
+
+        async def read(self):
+            time.sleep(0.1)  # let other threads register as waiters
+            return b"content"
+
+    session = FakeSession(SlowResponse())
+    results = []
+
+    async def get():
+        async with RequestContextManager(session, cache, "GET", url) as resp:
+            return await resp.text()
+
+    def run():
+        results.append(asyncio.run(get()))
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["content"] * 4
+    assert len(session.requests) == 1
+    assert cache.metrics.counters["misses"] == 1
+    assert (
+        cache.metrics.counters["coalesced"] + cache.metrics.counters["hits"]
+        == 3
+    )